@@ -1,3 +1,4 @@
 from .bittorrent import BitTorrent, Mode
 from .communication_manager import CommunicationManager
-from .entities import Peer, Torrent
+from .peer_listener import PeerListener
+from .entities import FsyncPolicy, Peer, Torrent
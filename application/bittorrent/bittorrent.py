@@ -2,12 +2,21 @@ import asyncio
 import threading
 import time
 from enum import Enum
+from typing import Dict, Optional, Tuple
 
-from .entities import PieceObject
-from .entities import Torrent, FileMode
+import numpy as np
+
+from .entities import BufferPool, ContentCache, DiskWriter, FsyncPolicy, PieceObject, PiecePicker, PieceTable, Storage
+from .entities import Recheck, ResumeData, RESUME_SAVE_INTERVAL
+from .entities import Torrent
 from .communication_manager import CommunicationManager
+from .peer_listener import PeerListener, PEER_LISTENER
 
 TIMEOUT = 4.0
+# 受信中のピースのバッファに使うメモリの上限 (バイト)
+BUFFER_POOL_SIZE = 64 * 2 ** 20
+# 書き込んだピースをいつfsyncするか. BitTorrentごとにfsync_policyで変更できる
+FSYNC_POLICY = FsyncPolicy.NONE
 
 
 class Mode(Enum):
@@ -17,7 +26,8 @@ class Mode(Enum):
 
 
 class BitTorrent:
-    def __init__(self, torrent_metadata: Torrent, file_path, mode):
+    def __init__(self, torrent_metadata: Torrent, file_path, mode, content_cache: Optional[ContentCache] = None,
+                 listener: Optional[PeerListener] = None, fsync_policy: FsyncPolicy = FSYNC_POLICY):
         self.mode = mode
 
         self.torrent_metadata = torrent_metadata
@@ -25,29 +35,46 @@ class BitTorrent:
         self.info_hash_hex = torrent_metadata.info_hash_hex
         # 1ピースのサイズ
         self.piece_length = self.torrent_metadata.info.piece_length
-        # ピース数 の計算
-        # シングルファイルと複数ファイルで計算方法が変わる. 複数ファイルの場合、ファイルのサイズの合計値が全体のデータサイズになる.
-        if self.torrent_metadata.file_mode == FileMode.single_file:
-            if self.torrent_metadata.info.length % self.piece_length == 0:
-                self.number_of_pieces = int(self.torrent_metadata.info.length / self.piece_length)
-            else:
-                self.number_of_pieces = int(self.torrent_metadata.info.length / self.piece_length) + 1
-        else:
-            length: int = 0
-            for file in self.torrent_metadata.info.files:
-                length += file.length
-            self.number_of_pieces = int(length / self.piece_length)
 
         self.file_path = file_path
-
-        self.pieces = [PieceObject(index, size, hash_, self.file_path) for index, size, hash_ in
-                       self._generate_piece_info()]
+        self.content_cache: Optional[ContentCache] = None
+        if self.mode == Mode.Proxy:
+            # Proxyはピースを file_path のキャッシュディレクトリに1ピースずつ保存し、容量を超えたら古いものから削除する
+            # 複数のトレントで同じキャッシュを共有する場合は content_cache を渡す
+            self.content_cache = content_cache if content_cache is not None else ContentCache(file_path)
+            self.storage = self.content_cache.storage(torrent_metadata)
+        else:
+            # ピースの範囲をトレントのファイル (シングルファイル/複数ファイル) に対応付けて読み書きする
+            self.storage = Storage.from_torrent(file_path, torrent_metadata)
+        # 再起動時にハッシュを計算せずに取得済みのピースを復元するためのデータ
+        self.resume_path = ResumeData.path_for(file_path, self.info_hash_hex)
+        # 既存のファイルを検証している間の進捗 (検証したピース数, 検証するピース数)
+        self.recheck_progress: Tuple[int, int] = (0, 0)
+        # 検証済みのピースを書き込むキュー. ディスクが遅い場合はピースの要求を止める
+        self.disk_writer = DiskWriter(self.storage, fsync_policy=fsync_policy)
+        # 複数ファイルの場合、ファイルのサイズの合計値が全体のデータサイズになる.
+        self.total_length: int = self.storage.total_length
+        self.number_of_pieces = (self.total_length + self.piece_length - 1) // self.piece_length
+
+        # Pieceは初めて参照された時に生成する
+        self.pieces = PieceTable(self.number_of_pieces, self._create_piece)
+        # 少なくとも1ピースは受信できるようにする
+        self.buffer_pool = BufferPool(max(BUFFER_POOL_SIZE, self.piece_length))
+        self.piece_picker = PiecePicker(self.number_of_pieces)
+        # 受信済みのブロックをディスクに書いてバッファを手放した、途中まで受信したピース -> ブロックの状態
+        self.parked_pieces: Dict[int, bytes] = {}
+        # 取得済みのピース. Peer.bit_fieldと同じ形式でパックしたuint8配列
+        self.bit_field = np.zeros((self.number_of_pieces + 7) // 8, dtype=np.uint8)
 
         self.comm_mgr = CommunicationManager(self)
+        # 他のピアからの接続を受け付ける待ち受け. 省略時はプロセス内の全てのトレントで共有する
+        self.listener = listener if listener is not None else PEER_LISTENER
 
         self.healthy = True
 
     async def run(self):
+        resume_task = asyncio.create_task(self._save_resume_data_periodically())
+        await self.listener.register(self.comm_mgr)
         try:
             if self.mode == Mode.BitTorrent:
                 await self.bittorrent_handle()
@@ -59,21 +86,35 @@ class BitTorrent:
             pass
         finally:
             self.healthy = False
-            self.comm_mgr.healthy = False
+            self.listener.unregister(self.comm_mgr)
+            await self.comm_mgr.close()
+            resume_task.cancel()
+            await self.disk_writer.close()
+            await self.save_resume_data(flush_partial=True)
+            self.storage.close()
+            if self.content_cache is not None:
+                self.content_cache.flush()
 
         print('finished.')
 
     async def bittorrent_handle(self):
+        valid, partial_pieces, changed = await self.load_resume_data()
+        # レジュームデータが無いか、保存後に変更されたファイルにかかるピースだけ、既存のファイルのハッシュを検証する
+        self.bit_field |= valid
+        if changed.any():
+            self.bit_field |= await self.recheck(changed)
+        # 未取得の全ピースをダウンロード対象にする. 各ピアのパイプラインがピースピッカーからレアなピース順に要求する
+        self.piece_picker.want_all(self.missing_piece_mask())
+        await self.restore_partial_pieces(partial_pieces)
         await self.comm_mgr.run()
-        while not self.all_pieces_completed() and self.healthy:
-            for piece in self.pieces.copy():
-                try:
-                    await self.request_piece(piece.piece_index)
-                except Exception as e:
-                    pass
 
     async def proxy_handle(self):
-        pass
+        # キャッシュディレクトリに残っているピースを検証して取得済みにする. ピースは要求されたものだけを取得する
+        # レジュームデータで変更が無いと分かっているピースはハッシュを計算しない
+        valid, partial_pieces, _ = await self.load_resume_data()
+        await self.load_content_cache(trusted=valid)
+        await self.restore_partial_pieces(partial_pieces)
+        await self.comm_mgr.run()
 
     async def client_handle(self):
         pass
@@ -90,6 +131,7 @@ class BitTorrent:
 
         if time.time() - piece.last_seen <= TIMEOUT:
             raise Exception("Already requested.")
+        piece.last_seen = time.time()
 
         return await self.comm_mgr.request_piece_from_peer(piece)
 
@@ -99,21 +141,165 @@ class BitTorrent:
 
         # ピースが完了している場合、直接そのデータを返す
         if piece.is_full:
+            self._touch_content_cache(piece_index)
             return await piece.get_data()
 
-        # 最初のピアに対してピースのデータを要求
-        await self.request_piece(piece_index)
+        # 既に誰かが待っているピースは要求済みなので、その完了を一緒に待つ
+        if not piece.is_waited():
+            await self.request_piece(piece_index)
 
-        # ピースが完了するまで待機
-        while not piece.is_full:
-            await asyncio.sleep(0.5)
+        # ピースの検証と書き込みが完了するまで待機. ハッシュが一致しない場合はPieceHashMismatchが送出される
+        await piece.wait_complete()
 
         return await piece.get_data()
 
     # CommunicationManagerから呼び出される関数
-    def handle_received_block(self, piece_index: int, block_offset: int, data: bytes):
-        """CommunicationManagerによって受信されたブロックデータをピースに保存します。"""
-        self.pieces[piece_index].set_block(block_offset, data)
+    def handle_received_block(self, piece_index: int, block_offset: int, data: bytes) -> bool:
+        """CommunicationManagerによって受信されたブロックデータをピースに保存します。保存した場合にTrueを返します"""
+        if self.has_piece(piece_index):
+            return False
+        return self.pieces[piece_index].set_block(block_offset, data)
+
+    async def piece_completed(self, piece: PieceObject):
+        """ピースの検証が完了した時にPieceから呼び出されます"""
+        piece_index = piece.piece_index
+        self.bit_field[piece_index >> 3] |= 0x80 >> (piece_index & 7)
+        self.piece_picker.discard(piece_index)
+        # 取得済みのピースは保持しない. 再び参照された場合はbit_fieldからis_fullの状態で生成される
+        self.pieces.release(piece_index)
+        evicted = []
+        if self.content_cache is not None:
+            evicted = self.content_cache.add(self.info_hash_hex, piece_index, piece.piece_size)
+        await self.comm_mgr.piece_completed(piece_index)
+        if evicted:
+            # 上限を超えて取り除いたピースのファイルはスレッドで削除する
+            await asyncio.get_running_loop().run_in_executor(None, self.content_cache.delete, evicted)
+
+    async def piece_failed(self, piece: PieceObject, error: Exception):
+        """ピースのハッシュが一致しなかった場合や書き込みに失敗した場合にPieceから呼び出されます"""
+        await self.comm_mgr.piece_failed(piece.piece_index, error)
+
+    async def load_content_cache(self, trusted: Optional[np.ndarray] = None):
+        """キャッシュディレクトリのピースをスレッドで検証し、有効なものを取得済みにします"""
+        if self.content_cache is None:
+            return
+        valid = await asyncio.get_running_loop().run_in_executor(
+            None, self.content_cache.load, self.torrent_metadata, self._piece_evicted, trusted)
+        for piece_index in valid:
+            self.bit_field[piece_index >> 3] |= 0x80 >> (piece_index & 7)
+            self.piece_picker.discard(piece_index)
+            self.pieces.release(piece_index)
+
+    async def load_resume_data(self) -> Tuple[np.ndarray, Dict[int, bytes], np.ndarray]:
+        """
+        レジュームデータを読み込み、変更されていないファイルにかかる取得済みのピース (パックしたビットフィールド) と
+        途中まで受信したピースのブロックの状態、ハッシュを検証し直す必要があるピース (bool配列) を返します。
+        レジュームデータが無いか別のトレントのものである場合は、全てのピースを検証し直します
+        """
+        loop = asyncio.get_running_loop()
+        resume_data = await loop.run_in_executor(None, ResumeData.load, self.resume_path)
+        if resume_data is None or resume_data.info_hash_hex != self.info_hash_hex:
+            return np.zeros_like(self.bit_field), {}, np.ones(self.number_of_pieces, dtype=bool)
+        return await loop.run_in_executor(None, resume_data.valid_pieces, self.storage, self.number_of_pieces)
+
+    async def recheck(self, candidates: Optional[np.ndarray] = None) -> np.ndarray:
+        """ディスク上のファイルをピースのハッシュと並列に照合し、一致したピースのビットフィールドを返します"""
+        recheck = Recheck(self.storage, self.torrent_metadata.info.pieces)
+        return await recheck.run(candidates, on_progress=self._update_recheck_progress)
+
+    def _update_recheck_progress(self, checked: int, total: int):
+        self.recheck_progress = (checked, total)
+
+    async def restore_partial_pieces(self, partial_pieces: Dict[int, bytes]):
+        """
+        途中まで受信したピースをダウンロード対象にします。
+        受信済みのブロックはディスクにあるので、ピースピッカーに選ばれた時にunpark_piece()で読み込んで再開します
+        """
+        for piece_index, block_map in partial_pieces.items():
+            if self.has_piece(piece_index):
+                continue
+            self.parked_pieces[piece_index] = block_map
+            self.piece_picker.want(piece_index)
+
+    async def park_piece(self, piece: PieceObject):
+        """
+        接続中のどのピアも持っていない途中まで受信したピースを手放します。
+        受信済みのブロックをディスクに書き込んでバッファをプールに返し、ピースをダウンロード対象に戻します。
+        ブロックの状態はレジュームデータにも保存され、再び選ばれた時にunpark_piece()で再開します
+        """
+        piece_index = piece.piece_index
+        full_blocks = piece.get_full_blocks()
+        try:
+            for block_offset, block_size in full_blocks:
+                await self.storage.write_piece(
+                    piece_index, memoryview(piece.buffer)[block_offset:block_offset + block_size], block_offset)
+        except OSError as e:
+            # 書き込めなかった場合はブロックを取得し直す
+            print(f'failed to save blocks of piece {piece_index}: {e}')
+            full_blocks = []
+        # 書き込み中に再び要求された場合はそのまま続ける
+        if piece_index in self.comm_mgr.wanted_pieces:
+            return
+        block_map = piece.release_blocks()
+        if full_blocks:
+            self.parked_pieces[piece_index] = block_map
+        self.piece_picker.want(piece_index)
+
+    async def unpark_piece(self, piece: PieceObject):
+        """park_piece()で手放したピースの受信済みのブロックをディスクから読み込み、ダウンロードを再開します"""
+        block_map = self.parked_pieces.pop(piece.piece_index, None)
+        if block_map is None:
+            return
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, self.storage.read, piece.piece_index * self.piece_length, piece.piece_size)
+        # バッファを確保できなかった場合は最初から取得する
+        piece.restore_blocks(block_map, data)
+
+    async def save_resume_data(self, flush_partial: bool = False):
+        """
+        取得済みのピースとファイルの状態をレジュームデータとして保存します。
+        flush_partialがTrueの場合 (終了時) は、途中まで受信したピースのブロックもディスクに書き込んで記録します。
+        """
+        partial_pieces = {}
+        if flush_partial:
+            for piece in self.pieces.active():
+                if piece.is_full or piece.buffer is None or not piece.completed_blocks:
+                    continue
+                for block_offset, block_size in piece.get_full_blocks():
+                    await self.storage.write_piece(
+                        piece.piece_index, memoryview(piece.buffer)[block_offset:block_offset + block_size], block_offset)
+                partial_pieces[piece.piece_index] = piece.get_block_map()
+        # 手放したピースのブロックは書き込み済み
+        for piece_index, block_map in self.parked_pieces.items():
+            if not self.has_piece(piece_index):
+                partial_pieces.setdefault(piece_index, block_map)
+
+        # ファイルの状態より先にビットフィールドを記録する. 記録したピースは全て書き込み済み
+        bit_field = self.bit_field.tobytes()
+        loop = asyncio.get_running_loop()
+        resume_data = await loop.run_in_executor(
+            None, ResumeData.capture, self.storage, self.info_hash_hex, bit_field, partial_pieces)
+        await loop.run_in_executor(None, resume_data.save, self.resume_path)
+
+    async def _save_resume_data_periodically(self):
+        while True:
+            await asyncio.sleep(RESUME_SAVE_INTERVAL)
+            try:
+                await self.save_resume_data()
+            except OSError as e:
+                print(f'failed to save resume data: {e}')
+            if self.content_cache is not None:
+                # キャッシュディレクトリの索引への追加・削除・参照時刻をまとめて書き込む
+                await asyncio.get_running_loop().run_in_executor(None, self.content_cache.flush)
+
+    def _piece_evicted(self, piece_index: int):
+        """キャッシュディレクトリから削除されたピースを未取得に戻します"""
+        self.bit_field[piece_index >> 3] &= ~(0x80 >> (piece_index & 7)) & 0xff
+        self.pieces.release(piece_index)
+
+    def _touch_content_cache(self, piece_index: int):
+        if self.content_cache is not None:
+            self.content_cache.touch(self.info_hash_hex, piece_index)
 
     def receive_block_data(self, piece_index: int, block_offset: int, data: bytes):
         """ピアからのブロックデータを受信し、対応するピースにデータを設定する"""
@@ -123,21 +309,29 @@ class BitTorrent:
     async def get_piece_data(self, piece_index: int) -> bytes:
         """指定されたピースのデータを取得する。ピースが完了していない場合はエラーを返す。"""
         piece = self.pieces[piece_index]
+        self._touch_content_cache(piece_index)
         return await piece.get_data()
 
-    def all_pieces_completed(self) -> bool:
-        for piece in self.pieces:
-            if not piece.is_full:
-                return False
+    def get_peer_rates(self) -> list[dict]:
+        """接続中の各ピアの受信レートなどを返します (グラフ表示用)"""
+        return self.comm_mgr.get_peer_rates()
 
-        return True
+    def has_piece(self, piece_index: int) -> bool:
+        return bool(self.bit_field[piece_index >> 3] & (0x80 >> (piece_index & 7)))
 
-    def _generate_piece_info(self):
-        piece_hashes = [self.torrent_metadata.info.pieces[i:i + 20] for i in
-                        range(0, len(self.torrent_metadata.info.pieces), 20)]
-        piece_size = self.torrent_metadata.info.piece_length
-        num_pieces = len(piece_hashes)
+    def missing_piece_mask(self) -> np.ndarray:
+        """まだ取得していないピースを0/1で表した配列を返します"""
+        return 1 - np.unpackbits(self.bit_field, count=self.number_of_pieces)
 
-        for index in range(num_pieces):
-            size = piece_size if index != num_pieces - 1 else self.torrent_metadata.info.length % piece_size
-            yield index, size, piece_hashes[index]
+    def all_pieces_completed(self) -> bool:
+        return not self.missing_piece_mask().any()
+
+    def _create_piece(self, piece_index: int) -> PieceObject:
+        piece_hash = self.torrent_metadata.info.pieces[piece_index * 20:(piece_index + 1) * 20]
+        piece_size = self.storage.piece_size(piece_index)
+        piece = PieceObject(piece_index, piece_size, piece_hash, self.storage, self.buffer_pool,
+                            self.disk_writer)
+        piece.is_full = self.has_piece(piece_index)
+        piece.on_complete = self.piece_completed
+        piece.on_failed = self.piece_failed
+        return piece
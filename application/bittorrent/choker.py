@@ -0,0 +1,118 @@
+import random
+import time
+from typing import Dict, Optional, Tuple
+
+from .entities.peer import Peer
+from .utils import Timer
+
+# 受信レート (シード中は送信レート) の上位から、同時にUnChokeするピアの数. 別にオプティミスティックアンチョークを1つ持つ
+UNCHOKE_SLOTS = 4
+# チョークを見直す間隔 (秒). レートはこの間隔で受信・送信したバイト数から求める
+RECHOKE_INTERVAL = 10
+# オプティミスティックアンチョークの対象を入れ替える間隔 (見直しの回数)
+OPTIMISTIC_UNCHOKE_ROUNDS = 3
+# 接続してからこの時間 (秒) 以内のピアは、オプティミスティックアンチョークに選ばれる確率をNEW_PEER_WEIGHT倍にする
+NEW_PEER_TIME = RECHOKE_INTERVAL * OPTIMISTIC_UNCHOKE_ROUNDS * 3
+NEW_PEER_WEIGHT = 3
+
+
+class Choker(object):
+    """
+    BEP 3 のチョークアルゴリズム。RECHOKE_INTERVALごとに、Interestedなピアのうち
+    直近の間隔でこちらへ多く送ってくれたピア (シード中はこちらから多く受け取ったピア) の上位UNCHOKE_SLOTSをUnChokeします。
+    ダウンロード中はsnubbedなピアを上位に選びません。
+    それとは別に、OPTIMISTIC_UNCHOKE_ROUNDS回ごとにChokeしているピアから1つをランダムに選んでUnChokeし、
+    より速いピアを見つけられるようにします。新しく接続したピアは選ばれやすくします。
+    Choke/UnChokeは状態が変わるピアにだけ送ります。
+    """
+
+    def __init__(self, comm_mgr):
+        self.comm_mgr = comm_mgr
+        self.optimistic: Optional[Peer] = None
+        # 直近の間隔のレート (bytes/s)
+        self.rates: Dict[Peer, float] = {}
+        # 前回計測した時点の各ピアの (受信したバイト数, 送信したバイト数)
+        self._counters: Dict[Peer, Tuple[int, int]] = {}
+        self._measured_at = time.monotonic()
+        self._round = 0
+        self._timer: Optional[Timer] = None
+
+    def start(self):
+        """定期的な見直しを開始します. 既に開始している場合は何もしません"""
+        if self._timer is None:
+            self._measured_at = time.monotonic()
+            self._timer = self.comm_mgr.timers.call_later(RECHOKE_INTERVAL, self._tick)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def peer_removed(self, peer: Peer):
+        self.rates.pop(peer, None)
+        self._counters.pop(peer, None)
+        if peer is self.optimistic:
+            self.optimistic = None
+        self.rechoke()
+
+    def _tick(self):
+        self._timer = None
+        if not self.comm_mgr.healthy:
+            return
+        self._measure()
+        self._round += 1
+        if self._round % OPTIMISTIC_UNCHOKE_ROUNDS == 0:
+            self.optimistic = None
+        self.rechoke()
+        self._timer = self.comm_mgr.timers.call_later(RECHOKE_INTERVAL, self._tick)
+
+    def _measure(self):
+        """前回の計測から各ピアが受信・送信したバイト数からレートを求めます"""
+        now = time.monotonic()
+        elapsed = max(now - self._measured_at, 1e-3)
+        seeding = self.comm_mgr.bittorrent.all_pieces_completed()
+        counters = {}
+        rates = {}
+        for peer in self.comm_mgr.peers:
+            downloaded, uploaded = self._counters.get(peer, (0, 0))
+            transferred = peer.uploaded - uploaded if seeding else peer.downloaded - downloaded
+            rates[peer] = transferred / elapsed
+            counters[peer] = (peer.downloaded, peer.uploaded)
+        self.rates = rates
+        self._counters = counters
+        self._measured_at = now
+
+    def rechoke(self):
+        """
+        直近のレートからUnChokeするピアを選び直します。
+        ピアの関心が変わった時や切断された時にも呼び出され、空いた枠をすぐに割り当てます
+        """
+        peers = [peer for peer in self.comm_mgr.peers if peer.healthy]
+        seeding = self.comm_mgr.bittorrent.all_pieces_completed()
+        interested = [peer for peer in peers if peer.is_interested()]
+
+        # レートが同じ場合は、既にUnChokeしているピアを優先して無駄な切り替えを避ける
+        candidates = [peer for peer in interested if peer is not self.optimistic and (seeding or not peer.snubbed)]
+        candidates.sort(key=lambda peer: (self.rates.get(peer, 0.0), peer.am_unchoking()), reverse=True)
+        unchoked = set(candidates[:UNCHOKE_SLOTS])
+
+        if self.optimistic is not None and not (self.optimistic in peers and self.optimistic.is_interested()):
+            self.optimistic = None
+        if self.optimistic is None:
+            self.optimistic = self._pick_optimistic([peer for peer in interested if peer not in unchoked])
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for peer in peers:
+            if peer in unchoked:
+                peer.unchoke()
+            else:
+                peer.choke()
+
+    @staticmethod
+    def _pick_optimistic(peers: list) -> Optional[Peer]:
+        if not peers:
+            return None
+        now = time.monotonic()
+        weights = [NEW_PEER_WEIGHT if now - peer.connected_at < NEW_PEER_TIME else 1 for peer in peers]
+        return random.choices(peers, weights)[0]
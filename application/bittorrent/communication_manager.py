@@ -1,12 +1,18 @@
 import asyncio
 import logging
 import random
+from typing import Optional
 
-from .entities.peer import Peer
+from .entities.peer import Peer, PiecePeerIndex, InvalidHandshakeException
 from .entities.peer.message import Message, Handshake, KeepAlive, Choke, UnChoke, Interested, NotInterested, Have, \
-    BitField, Request, Piece, Cancel, Port
+    BitField, Request, Piece, Cancel, Port, ProtocolError
 from .entities import Tracker
-from .entities import PieceObject
+from .entities import PieceObject, PieceHashMismatch, PiecePicker
+from .choker import Choker
+from .connection_manager import ConnectionManager
+from .download_scheduler import DownloadScheduler
+from .uploader import Uploader
+from .utils import Timer, TimerWheel
 
 logger = logging.getLogger()
 handler = logging.StreamHandler()
@@ -17,6 +23,18 @@ logger.setLevel(logging.DEBUG)
 
 MAX_PEER_CONNECT = 50
 
+# 1ピースをこの時間 (秒) 以内に受信できるピアには、ピース単位で排他的にブロックを割り当てる
+WHOLE_PIECE_THRESHOLD = 5
+# 受信レートが最速のピアのこの割合に満たないピアは低速とみなし、レアなピースのみ新たに要求させる
+SLOW_PEER_RATIO = 0.1
+# 低速なピアが新たに要求を開始できるピースの保有ピア数の上限
+RARE_PIECE_AVAILABILITY = 2
+# 取得したピースのHaveをまとめて送る間隔 (秒)
+HAVE_BATCH_INTERVAL = 0.5
+# ハッシュが一致しなかったピースにこの回数ブロックを送ったピアは切断し、再び接続しない
+# ピース全体を1つのピアから受信していた場合は1回で切断する
+MAX_HASH_FAILURES = 5
+
 
 class PeersNotExist(Exception):
     pass
@@ -26,88 +44,330 @@ class CommunicationManager:
     def __init__(self, bittorrent):
         self.bittorrent = bittorrent
         self.peers: list[Peer] = []
+        # 要求を開始したダウンロード中のピース. 各ピアのパイプラインはまずここからブロックを補充する
+        self.wanted_pieces: dict[int, PieceObject] = {}
+        self.piece_picker: PiecePicker = bittorrent.piece_picker
+        # ピース -> そのピースを持ち、ブロックを要求できるピア
+        self.piece_peers = PiecePeerIndex(bittorrent.number_of_pieces)
+        # 高速なピアに排他的に割り当てたピース
+        self.piece_owners: dict[int, Peer] = {}
+        # 接続中のピアのうち最も高い受信レート. 低速なピアの判定に使う
+        self.fastest_rate = 0.0
+        # 残りのブロックが全て要求済みになった後のエンドゲームモード
+        self.endgame = False
+        # イベントが起きたピアのパイプラインを補充するスケジューラ
+        self.scheduler = DownloadScheduler(self)
+        # 全てのピアのRequestのタイムアウトやキープアライブを管理するタイマー
+        self.timers = TimerWheel()
+        # 接続先の候補を保持し、MAX_PEER_CONNECTまで並列に接続する
+        self.connections = ConnectionManager(self, MAX_PEER_CONNECT)
+        # ピアから受け付けたRequestにブロックを返す
+        self.uploader = Uploader(self)
+        # 定期的にレートの高いピアを選んでUnChokeする
+        self.choker = Choker(self)
+        # ピース -> そのピースにブロックを送ったピア. ハッシュが一致しなかった時に原因のピアを特定する
+        self.piece_contributors: dict[int, set[Peer]] = {}
+        # 壊れたデータを送ったため接続しないピアのIPアドレス
+        self.banned: set[str] = set()
+        # まだHaveを送っていない取得済みのピースと、それらを送るタイマー
+        self._pending_haves: list[int] = []
+        self._have_timer: Optional[Timer] = None
 
         self.healthy = True
 
     async def run(self):
-        """すべてのピアとの通信を監視し続けます"""
+        """トラッカーからピアを追加し、healthyがFalseになるまでスケジューラを動かします"""
         await self.add_peers_from_tracker()
-
-        while self.healthy:
-            await self.listener()
-            await asyncio.sleep(1)
-
-    async def listener(self):
-        """ピアからのメッセージを非同期に処理します"""
-        # KeepAliveとトラッカーからピアの追加
-        # await self.add_peers_from_tracker()
-        # await self.remove_unhealthy_peer()
-
-        # イテレート中の変更時にエラーを回避するためにcopy()
-        for peer in self.peers.copy():
-            logger.debug(f"ip: {peer.ip}")
-            try:
-                payload = await peer.reader.read(4096)
-                if not payload:
-                    continue
-
-                peer.read_buffer += payload
-
-                async for msg in peer.get_messages():
-                    await self._process_new_message(msg, peer)
-
-            except Exception as e:
-                logger.error(e)
-                await self.remove_peer(peer)
+        await self.scheduler.start()
 
     async def add_peers_from_tracker(self):
+        """トラッカーから取得したピアを接続先の候補に加えます. 接続はバックグラウンドで並列に行われます"""
         tracker = Tracker(self.bittorrent.torrent_metadata)
-        new_peer_candidates: dict = tracker.get_peers_from_trackers()
-        for peer_candidate in new_peer_candidates.values():
-            def equivalence_detection():
-                for _peer in self.peers:
-                    if _peer.ip == peer_candidate.ip:
-                        return True
-                return False
-
-            if equivalence_detection():
-                continue
-
-            peer = Peer(self.bittorrent.info_hash, self.bittorrent.number_of_pieces, peer_candidate.ip,
-                        peer_candidate.port)
-            if await peer.connect():
-                logger.debug("add new peer" + peer.ip)
-                self.peers.append(peer)
+        # トラッカーへの問い合わせはブロッキングなのでスレッドで行う
+        new_peer_candidates: dict = await asyncio.get_running_loop().run_in_executor(
+            None, tracker.get_peers_from_trackers)
+        self.connections.add_candidates(
+            (peer_candidate.ip, peer_candidate.port) for peer_candidate in new_peer_candidates.values())
 
-            if len(self.peers) >= MAX_PEER_CONNECT:
+    async def request_piece_from_peer(self, piece: PieceObject):
+        """ピースをダウンロード中のピースに加え、そのピースを持つピアのパイプラインを補充します"""
+        self.piece_picker.discard(piece.piece_index)
+        await self.bittorrent.unpark_piece(piece)
+        self.wanted_pieces[piece.piece_index] = piece
+
+        ready_peers = self.piece_peers.peers_having(piece.piece_index)
+        random.shuffle(ready_peers)
+        for peer in ready_peers:
+            self.scheduler.wake(peer)
+
+    async def fill_requests(self, peers: list[Peer]):
+        """スケジューラから呼び出され、各ピアのパイプラインを補充します"""
+        self.fastest_rate = max((peer.download_rate for peer in self.peers), default=0.0)
+        for peer in peers:
+            await self._fill_requests(peer)
+
+    async def _fill_requests(self, peer: Peer):
+        """
+        ピアのパイプラインに空きがある限りブロックを要求します。
+        ダウンロード中のピースを優先し、足りなければピースピッカーからレアなピースを選んで要求を開始します。
+        高速なピアが開始したピースはそのピアに排他的に割り当て、低速なピアにはレアなピースのみ開始させます。
+        """
+        if not (peer.is_unchoked() and peer.am_interested()):
+            return
+        # 書き込み待ちが溜まっている間は要求しない. 書き込みが終わるとpiece_completed()から再開する
+        if self.bittorrent.disk_writer.is_full():
+            return
+
+        slow = self._is_slow_peer(peer)
+        fast = not slow and self._is_fast_peer(peer)
+
+        for piece in list(self.wanted_pieces.values()):
+            if not peer.can_request():
                 return
-
-    def _get_random_peer_having_piece(self, piece_index: int) -> Peer:
-        ready_peer = []
+            if piece.is_full:
+                del self.wanted_pieces[piece.piece_index]
+                continue
+            owner = self.piece_owners.get(piece.piece_index)
+            if owner is not None and owner is not peer:
+                continue
+            if peer.has_piece(piece.piece_index):
+                await self._request_blocks(peer, piece)
+
+        # バッファプールに空きがない間は新しいピースを開始しない
+        while peer.can_request() and self.bittorrent.buffer_pool.can_acquire(self.bittorrent.piece_length):
+            max_availability = RARE_PIECE_AVAILABILITY if slow else None
+            piece_index = self.piece_picker.pick_piece(peer.bit_field, max_availability)
+            if piece_index is None:
+                break
+            piece = self.bittorrent.pieces[piece_index]
+            # 手放したピースは受信済みのブロックを読み込んでから要求する
+            await self.bittorrent.unpark_piece(piece)
+            self.wanted_pieces[piece_index] = piece
+            if fast:
+                self.piece_owners[piece_index] = peer
+            await self._request_blocks(peer, piece)
+
+        if peer.can_request() and self._update_endgame():
+            await self._request_endgame_blocks(peer)
+
+    def _update_endgame(self) -> bool:
+        """新たに要求できるブロックが残っておらず、全て要求済みかどうかを判定してエンドゲームモードを更新します"""
+        self.endgame = bool(self.wanted_pieces) and len(self.piece_picker) == 0 and not any(
+            piece.has_free_block() for piece in self.wanted_pieces.values() if not piece.is_full)
+        return self.endgame
+
+    async def _request_endgame_blocks(self, peer: Peer):
+        """エンドゲームモードで、他のピアに要求中のブロックをこのピアにも重複して要求します"""
+        for piece in list(self.wanted_pieces.values()):
+            if piece.is_full or not peer.has_piece(piece.piece_index):
+                continue
+            for piece_index, block_offset, block_size in piece.get_pending_blocks():
+                if not peer.can_request():
+                    return
+                if not peer.has_requested(piece_index, block_offset):
+                    await peer.request_block(piece_index, block_offset, block_size)
+
+    async def _cancel_duplicate_requests(self, piece_index: int, block_offset: int, block_length: int):
+        """エンドゲームモードで受信済みになったブロックを、他のピアへのRequestからCancelします"""
         for peer in self.peers.copy():
-            if peer.is_eligible() and peer.is_unchoked() and peer.am_interested() and peer.has_piece(piece_index):
-                ready_peer.append(peer)
+            await peer.cancel_request(piece_index, block_offset, block_length)
 
-        return random.choice(ready_peer) if ready_peer else None
+    def _is_fast_peer(self, peer: Peer) -> bool:
+        return peer.download_rate * WHOLE_PIECE_THRESHOLD >= self.bittorrent.piece_length
 
-    async def request_piece_from_peer(self, piece: PieceObject):
-        for block_index in range(len(piece.blocks)):
-            peer = self._get_random_peer_having_piece(piece.piece_index)
-            if not peer:
-                raise PeersNotExist('Peer is not Exist')
+    def _is_slow_peer(self, peer: Peer) -> bool:
+        return peer.snubbed or 0 < peer.download_rate < self.fastest_rate * SLOW_PEER_RATIO
+
+    def _release_ownership(self, peer: Peer):
+        """ピアに排他的に割り当てていたピースを、他のピアも要求できるようにします"""
+        for piece_index in [index for index, owner in self.piece_owners.items() if owner is peer]:
+            del self.piece_owners[piece_index]
 
-            block = piece.blocks[block_index]
-            block_offset = block.block_size * block_index
-            await peer.request_block(piece.piece_index, block_offset, block.block_size)
+    @staticmethod
+    async def _request_blocks(peer: Peer, piece: PieceObject):
+        while peer.can_request():
+            block = piece.get_empty_block()
+            if block is None:
+                return
+            await peer.request_block(*block)
+
+    def _release_requests(self, requests: list[tuple[int, int]]):
+        """応答が得られなかったRequestのブロックを戻し、他のピアに割り当て直すためにスケジューラを起こします"""
+        for piece_index, block_offset in requests:
+            if not self.bittorrent.has_piece(piece_index):
+                self.bittorrent.pieces[piece_index].free_block(block_offset)
+        if requests:
+            self.scheduler.wake()
+
+    async def _update_interest(self, peer: Peer):
+        """自分が持っていないピースをピアが持っているかどうかをビット演算で判定し、Interested/NotInterestedを送ります"""
+        lacking = peer.bit_field & ~self.bittorrent.bit_field
+        await peer.set_interested(bool(lacking.any()))
+        self.piece_peers.update(peer)
+
+    async def piece_completed(self, piece_index: int):
+        """
+        ピースの取得が完了した時に呼び出され、ダウンロード中のピースから外して各ピアへの関心を更新します。
+        ピースのバッファが空いたので、各ピアのパイプラインの補充も予約します。
+        """
+        self.wanted_pieces.pop(piece_index, None)
+        self.piece_owners.pop(piece_index, None)
+        self.piece_contributors.pop(piece_index, None)
+        for peer in self.peers.copy():
+            await self._update_interest(peer)
+        self.scheduler.wake()
+        self._pending_haves.append(piece_index)
+        if self._have_timer is None:
+            self._have_timer = self.timers.call_later(HAVE_BATCH_INTERVAL, self._send_haves)
+
+    async def piece_failed(self, piece_index: int, error: Exception):
+        """
+        ピースの検証や書き込みに失敗し、全てのブロックが未取得に戻った時に呼び出されます。
+        ハッシュが一致しなかった場合、ピース全体を1つのピアから受信していればそのピアを切断します。
+        複数のピアから受信していた場合は原因を特定できないので、失敗の少ないピア1つにピースを割り当てて取得し直させ、
+        再び一致しなければそのピアを切断します。失敗がMAX_HASH_FAILURESに達したピアも切断します。
+        最後のブロックの受信で起こされた補充は既に終わっているので、スケジューラを起こして要求し直します
+        """
+        contributors = self.piece_contributors.pop(piece_index, set())
+        if isinstance(error, PieceHashMismatch):
+            self.piece_owners.pop(piece_index, None)
+            for peer in contributors:
+                peer.hash_failures += 1
+                if len(contributors) == 1 or peer.hash_failures >= MAX_HASH_FAILURES:
+                    await self.ban_peer(peer)
+            suspects = [peer for peer in contributors if peer in self.peers]
+            if suspects:
+                random.shuffle(suspects)
+                self.piece_owners[piece_index] = min(suspects, key=lambda peer: peer.hash_failures)
+        else:
+            logger.error(f"cannot save piece {piece_index}: {error!r}")
+        self.scheduler.wake()
+
+    async def _park_unavailable_pieces(self):
+        """
+        接続中のどのピアも持っていない、途中まで受信したピースのバッファを手放します。
+        手放さないとバッファプールの予算が空かず、新しいピースを開始できなくなります.
+        空いたバッファで新しいピースを開始するためにスケジューラを起こします
+        """
+        parked = False
+        for piece in list(self.wanted_pieces.values()):
+            piece_index = piece.piece_index
+            if self.piece_picker.availability[piece_index] or piece.buffer is None or piece.is_full \
+                    or piece.is_complete() or piece.get_pending_blocks():
+                continue
+            del self.wanted_pieces[piece_index]
+            self.piece_owners.pop(piece_index, None)
+            await self.bittorrent.park_piece(piece)
+            parked = True
+        if parked:
+            self.scheduler.wake()
+
+    async def ban_peer(self, peer: Peer):
+        """壊れたデータを送ったピアを切断し、同じIPアドレスには接続せず、接続も受け付けないようにします"""
+        logger.info(f"ban {peer.ip}:{peer.port}: {peer.hash_failures} hash failures")
+        self.banned.add(peer.ip)
+        self.connections.ban(peer.ip)
+        await self.remove_peer(peer)
+
+    def _send_haves(self):
+        """
+        タイマーから呼び出され、HAVE_BATCH_INTERVALの間に取得したピースのHaveをまとめて各ピアへ送ります。
+        同じ間隔に積まれたHaveは送信タスクが1回の書き込みにまとめます。ピアが既に持っているピースは送りません
+        """
+        self._have_timer = None
+        pieces, self._pending_haves = self._pending_haves, []
+        for peer in self.peers:
+            for piece_index in pieces:
+                if not peer.has_piece(piece_index):
+                    peer.send_queue.put_nowait(Have(piece_index))
+
+    def _is_valid_request(self, request: Request) -> bool:
+        """取得済みのピースの範囲内のブロックを要求しているかどうかを返します"""
+        if not 0 <= request.piece_index < self.bittorrent.number_of_pieces:
+            return False
+        if not self.bittorrent.has_piece(request.piece_index):
+            return False
+        return 0 <= request.block_offset and \
+            request.block_offset + request.block_length <= self.bittorrent.storage.piece_size(request.piece_index)
+
+    def _requests_expired(self, peer: Peer, requests: list[tuple[int, int]]):
+        """
+        ピアのRequestがタイムアウトした時や、ピアがsnubbedになった時にタイマーから呼び出されます。
+        解放したブロックは他のピアに割り当て直されます。
+        """
+        if peer.snubbed:
+            logger.debug(f"snubbed: {peer.ip}")
+            self._release_ownership(peer)
+        self._release_requests(requests)
+
+    def get_peer_rates(self) -> list[dict]:
+        """接続中の各ピアの受信レート (bytes/s)、RTTなどを返します"""
+        return [peer.get_stats() for peer in self.peers]
 
     async def add_peer(self, peer: Peer):
-        """ピアをリストに追加します"""
+        """ピアをリストに追加し、ピアの受信タスクからメッセージを受け取れるようにします"""
         self.peers.append(peer)
+        self.piece_peers.add(peer)
+        peer.start(self._process_new_message, self.remove_peer, self.timers, self._requests_expired,
+                   self.uploader.wake)
+        # 取得済みのピースがあれば、ハンドシェイクの直後にBitFieldで知らせる
+        if self.bittorrent.bit_field.any():
+            await peer.send_message(BitField(self.bittorrent.bit_field))
+        self.scheduler.start()
+        self.scheduler.wake(peer)
+        self.choker.start()
+
+    async def accept_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                          handshake: Handshake) -> bool:
+        """
+        PeerListenerが受け付けた接続をピアとして追加します。
+        接続数がMAX_PEER_CONNECTに達している場合や、既に接続しているピアの場合はFalseを返します。
+        """
+        if not self.healthy or len(self.peers) >= MAX_PEER_CONNECT or self.has_peer_id(handshake.peer_id):
+            return False
+        ip, port = writer.get_extra_info('peername')[:2]
+        if ip in self.banned:
+            return False
+        peer = Peer(self.bittorrent.info_hash, self.bittorrent.number_of_pieces, ip, port)
+        try:
+            peer.accept(reader, writer, handshake)
+        except InvalidHandshakeException:
+            return False
+        logger.debug(f"accept new peer {ip}:{port}")
+        await self.add_peer(peer)
+        return True
+
+    def has_peer_id(self, peer_id: bytes) -> bool:
+        """同じpeer_idのピアと既に接続しているかどうかを返します"""
+        return any(peer.peer_id == peer_id for peer in self.peers)
 
     async def remove_peer(self, peer: Peer):
         """指定されたピアとの通信を終了し、ピアをリストから削除します"""
+        if peer in self.peers:
+            self.peers.remove(peer)
+            self.piece_peers.remove(peer)
+            self.piece_picker.remove_peer(peer.piece_mask())
+        self.scheduler.discard(peer)
+        self._release_requests(peer.clear_requests())
+        self._release_ownership(peer)
         await peer.close()
-        self.peers.remove(peer)
+        await self._park_unavailable_pieces()
+        self.choker.peer_removed(peer)
+        self.connections.peer_removed(peer)
+
+    async def close(self):
+        """
+        新しい接続と再接続を止め、全てのピアとの通信を終了します。
+        ピアの受信・送信タスクを止めてソケットを閉じ、タイマーを全て取り消します
+        """
+        self.healthy = False
+        self.connections.close()
+        for peer in self.peers.copy():
+            await self.remove_peer(peer)
+        self.scheduler.stop()
+        self.uploader.close()
+        self.choker.close()
+        self.timers.close()
 
     async def remove_unhealthy_peer(self):
         for peer in self.peers.copy():
@@ -129,40 +389,72 @@ class CommunicationManager:
         elif isinstance(new_message, Choke):
             logger.debug("Choke")
             await peer.handle_choke()
+            self.piece_peers.update(peer)
+            # Chokeされると送信済みのRequestは破棄される
+            self._release_requests(peer.clear_requests())
+            self._release_ownership(peer)
 
         elif isinstance(new_message, UnChoke):
             logger.debug("UnChoke")
             await peer.handle_unchoke()
+            self.piece_peers.update(peer)
+            self.scheduler.wake(peer)
 
         elif isinstance(new_message, Interested):
             logger.debug("Interested")
             await peer.handle_interested()
+            self.choker.rechoke()
 
         elif isinstance(new_message, NotInterested):
             logger.debug("NotInterested")
             await peer.handle_not_interested()
+            self.choker.rechoke()
 
         elif isinstance(new_message, Have):
             logger.debug("Have")
+            # 範囲外のピースを知らせるピアは、受信ループが切断する
+            if not 0 <= new_message.piece_index < self.bittorrent.number_of_pieces:
+                raise ProtocolError('have {} out of {} pieces'.format(new_message.piece_index,
+                                                                      self.bittorrent.number_of_pieces))
+            if not peer.has_piece(new_message.piece_index):
+                self.piece_picker.increment(new_message.piece_index)
             await peer.handle_have(new_message)
+            await self._update_interest(peer)
+            self.piece_peers.add_piece(peer, new_message.piece_index)
+            self.scheduler.wake(peer)
 
         elif isinstance(new_message, BitField):
             logger.debug("BitField")
+            if len(new_message.bitfield_as_bytes) != len(peer.bit_field):
+                raise ProtocolError('bitfield of {} bytes for {} pieces'.format(len(new_message.bitfield_as_bytes),
+                                                                             self.bittorrent.number_of_pieces))
+            self.piece_picker.remove_peer(peer.piece_mask())
             await peer.handle_bitfield(new_message)
+            self.piece_picker.add_peer(peer.piece_mask())
+            self.piece_peers.update(peer, refresh=True)
+            await self._update_interest(peer)
+            self.scheduler.wake(peer)
 
         elif isinstance(new_message, Request):
-            logger.debug("Request")
-            await peer.handle_request(new_message)
+            if self._is_valid_request(new_message) and await peer.handle_request(new_message):
+                self.uploader.wake(peer)
 
-        if isinstance(new_message, Piece):
+        elif isinstance(new_message, Piece):
             piece_index = new_message.piece_index
             block_offset = new_message.block_offset
             data = new_message.block
-            self.bittorrent.handle_received_block(piece_index, block_offset, data)
+            if not peer.block_received(piece_index, block_offset, new_message.block_length):
+                # 要求していない、またはタイムアウトやCancelで取り消したブロックは使わない
+                return
+            if self.bittorrent.handle_received_block(piece_index, block_offset, data):
+                self.piece_contributors.setdefault(piece_index, set()).add(peer)
+            if self.endgame:
+                await self._cancel_duplicate_requests(piece_index, block_offset, new_message.block_length)
+            self.scheduler.wake(peer)
 
         elif isinstance(new_message, Cancel):
             logger.debug("Cancel")
-            await peer.handle_cancel()
+            await peer.handle_cancel(new_message)
 
         elif isinstance(new_message, Port):
             logger.debug("Port")
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from .entities.peer import Peer
+from .utils import Timer
+
+logger = logging.getLogger()
+
+# 同時に接続を試みる (ハンドシェイク待ちを含む) ピアの数
+MAX_CONCURRENT_CONNECTS = 16
+# 接続に失敗したアドレスを再び試すまでの待ち時間 (秒). 失敗するたびに倍にし、上限で止める
+CONNECT_BACKOFF_BASE = 5
+CONNECT_BACKOFF_MAX = 600
+# この回数続けて失敗したアドレスは候補から外す
+MAX_CONNECT_FAILURES = 8
+
+
+class PeerCandidate(object):
+    """接続先の候補となるアドレスと、接続に失敗した回数"""
+    __slots__ = ('ip', 'port', 'failures', 'retry_at', 'peer')
+
+    def __init__(self, ip: str, port: int):
+        self.ip = ip
+        self.port = port
+        self.failures = 0
+        # 次に接続を試せる時刻 (time.monotonic())
+        self.retry_at = 0.0
+        # 接続中のピア
+        self.peer: Optional[Peer] = None
+
+    def backoff(self) -> float:
+        return min(CONNECT_BACKOFF_BASE * 2 ** (self.failures - 1), CONNECT_BACKOFF_MAX)
+
+
+class ConnectionManager(object):
+    """
+    接続先の候補のアドレスを保持し、接続数がMAX_PEER_CONNECTに達するまで並列に接続するクラス。
+    接続はMAX_CONCURRENT_CONNECTSまで同時に試み、ハンドシェイクでinfo_hashを確認できたピアだけを追加します。
+    失敗したアドレスは指数的に間隔を空けて再び試し、ピアが切断されると別の候補から補充します。
+    """
+
+    def __init__(self, comm_mgr, max_peers: int):
+        self.comm_mgr = comm_mgr
+        self.max_peers = max_peers
+        self.candidates: Dict[Tuple[str, int], PeerCandidate] = {}
+        self._connecting: Set[Tuple[str, int]] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+        # 最も早く再試行できる候補の時刻に補充を行うタイマー
+        self._retry_timer: Optional[Timer] = None
+        self._retry_at = 0.0
+
+        # 接続の試行回数と失敗回数 (統計用)
+        self.attempts = 0
+        self.failures = 0
+
+    def add_candidates(self, addresses: Iterable[Tuple[str, int]]):
+        """候補のアドレスを追加し、空きがあれば接続を始めます"""
+        for ip, port in addresses:
+            if ip in self.comm_mgr.banned:
+                continue
+            if (ip, port) not in self.candidates:
+                self.candidates[(ip, port)] = PeerCandidate(ip, port)
+        self.top_up()
+
+    def ban(self, ip: str):
+        """IPアドレスの候補を全て取り除きます"""
+        for address in [address for address in self.candidates if address[0] == ip]:
+            del self.candidates[address]
+
+    def peer_removed(self, peer: Peer):
+        """ピアが切断された時に呼び出され、そのアドレスを後で再び試せるようにして別の候補から補充します"""
+        candidate = self.candidates.get((peer.ip, peer.port))
+        if candidate is not None and candidate.peer is peer:
+            candidate.peer = None
+            self._failed(candidate)
+        self.top_up()
+
+    def top_up(self):
+        """接続中と接続を試みているピアの数がmax_peersに達するまで、試せる候補への接続を始めます"""
+        if not self.comm_mgr.healthy:
+            return
+        connected = {(peer.ip, peer.port) for peer in self.comm_mgr.peers}
+        free = self.max_peers - len(connected) - len(self._connecting)
+        if free <= 0:
+            return
+        now = time.monotonic()
+        # 失敗の少ない候補から試す. 一度も失敗していない新しい候補が、再試行中の候補より優先される
+        for candidate in sorted(self.candidates.values(), key=lambda c: c.failures):
+            if free <= 0:
+                break
+            address = (candidate.ip, candidate.port)
+            if candidate.peer is not None or address in connected or address in self._connecting:
+                continue
+            if candidate.retry_at > now:
+                self._schedule_retry(candidate.retry_at)
+                continue
+            self._connecting.add(address)
+            task = asyncio.create_task(self._connect(candidate))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            free -= 1
+
+    def close(self):
+        """接続中のタスクと再試行のタイマーを止めます"""
+        if self._retry_timer is not None:
+            self._retry_timer.cancel()
+            self._retry_timer = None
+        for task in self._tasks:
+            task.cancel()
+
+    async def _connect(self, candidate: PeerCandidate):
+        peer: Optional[Peer] = None
+        try:
+            async with self._semaphore:
+                self.attempts += 1
+                peer = Peer(self.comm_mgr.bittorrent.info_hash, self.comm_mgr.bittorrent.number_of_pieces,
+                            candidate.ip, candidate.port)
+                if not await peer.connect():
+                    peer = None
+        finally:
+            self._connecting.discard((candidate.ip, candidate.port))
+
+        if peer is None:
+            self.failures += 1
+            self._failed(candidate)
+        elif candidate.ip in self.comm_mgr.banned:
+            # 接続している間にIPアドレスがbanされた
+            await peer.close()
+        elif self.comm_mgr.has_peer_id(peer.peer_id):
+            # 相手から既に接続されているか、別のアドレスで接続している. すぐに接続し直さないよう失敗として間隔を空ける
+            await peer.close()
+            self._failed(candidate)
+        elif self.comm_mgr.healthy:
+            logger.debug(f"add new peer {candidate.ip}:{candidate.port}")
+            candidate.failures = 0
+            candidate.peer = peer
+            await self.comm_mgr.add_peer(peer)
+        else:
+            await peer.close()
+        # 失敗した場合は空いた枠を別の候補で埋める
+        self.top_up()
+
+    def _failed(self, candidate: PeerCandidate):
+        """候補の失敗回数を増やし、次に試せる時刻を決めます. 失敗が続く候補は外します"""
+        address = (candidate.ip, candidate.port)
+        # ban() で既に外された候補は再び試さない
+        if self.candidates.get(address) is not candidate:
+            return
+        candidate.failures += 1
+        if candidate.failures >= MAX_CONNECT_FAILURES:
+            self.candidates.pop(address, None)
+            return
+        candidate.retry_at = time.monotonic() + candidate.backoff()
+        self._schedule_retry(candidate.retry_at)
+
+    def _schedule_retry(self, retry_at: float):
+        if self._retry_timer is not None and not self._retry_timer.cancelled() and self._retry_at <= retry_at:
+            return
+        if self._retry_timer is not None:
+            self._retry_timer.cancel()
+        self._retry_at = retry_at
+        self._retry_timer = self.comm_mgr.timers.call_later(retry_at - time.monotonic(), self._retry)
+
+    def _retry(self):
+        self._retry_timer = None
+        self.top_up()
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from typing import Optional
+
+from .entities.peer import Peer
+
+logger = logging.getLogger()
+
+
+class DownloadScheduler(object):
+    """
+    ピアのパイプラインへのRequestの補充を、意味のあるイベントが起きた時だけ行うスケジューラ。
+    Unchoke・BitField/Have・ブロックの受信・ピアの追加・ピースの完了でwake()されたピアを補充し、
+    Requestのタイムアウトやsnubbedの判定はタイマーホイールが行い、解放したブロックがあればwake()されます。
+    イベントが無い間は一切起きません。
+    """
+
+    def __init__(self, comm_mgr):
+        self.comm_mgr = comm_mgr
+        # 補充を予約したピア. 予約された順に補充する
+        self._dirty: dict[Peer, None] = {}
+        self._refill_all = False
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        # 起床した回数 (統計用)
+        self.wakeups = 0
+
+    def wake(self, peer: Optional[Peer] = None):
+        """ピアのパイプラインの補充を予約します. peerを省略すると接続中の全てのピアを補充します"""
+        if peer is None:
+            self._refill_all = True
+        else:
+            self._dirty[peer] = None
+        self._wakeup.set()
+
+    def discard(self, peer: Peer):
+        self._dirty.pop(peer, None)
+
+    def start(self) -> asyncio.Task:
+        """スケジューラのタスクを開始します. 既に動作している場合はそのタスクを返します"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    def stop(self):
+        self._wakeup.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self):
+        while self.comm_mgr.healthy:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            self.wakeups += 1
+
+            if self._refill_all:
+                self._refill_all = False
+                self._dirty.clear()
+                peers = self.comm_mgr.peers.copy()
+            else:
+                peers = [peer for peer in self._dirty if peer in self.comm_mgr.peers]
+                self._dirty.clear()
+            try:
+                await self.comm_mgr.fill_requests(peers)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # 1回の補充の失敗でスケジューラを止めない. 次にwake()された時にまた補充する
+                logger.exception("fill requests failed")
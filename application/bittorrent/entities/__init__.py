@@ -1,5 +1,7 @@
 from .peer import Peer, Message, Handshake, KeepAlive, Choke, UnChoke, Interested, NotInterested, Have, BitField, Request, Piece, Cancel, Port
 from .piece import State
 from .piece import Piece as PieceObject
+from .piece import BufferPool, PieceHashMismatch, PiecePicker, PieceTable
+from .storage import ContentCache, DiskWriter, FsyncPolicy, Recheck, ResumeData, RESUME_SAVE_INTERVAL, Storage
 from .tracker import Tracker
 from .torrent import Torrent, FileMode
@@ -1,2 +1,3 @@
-from .peer import Peer
+from .peer import Peer, InvalidHandshakeException, LISTEN_PORT, peer_id
+from .piece_peer_index import PiecePeerIndex
 from .message import Message, Handshake, KeepAlive, Choke, UnChoke, Interested, NotInterested, Have, BitField, Request, Piece, Cancel, Port, UdpTrackerConnection, UdpTrackerAnnounce, UdpTrackerAnnounceOutput
\ No newline at end of file
@@ -1,58 +1,53 @@
-from struct import unpack, pack
+from struct import Struct, unpack, pack
+from typing import Optional
 import random
 import socket
-import bitstring
 
 HANDSHAKE_PROTOCOL = b'BitTorrent protocol'
 HANDSHAKE_PROTOCOL_LEN = len(HANDSHAKE_PROTOCOL)
 LENGTH_PREFIX = 4
 
+# 事前にコンパイルしたフォーマット. メッセージごとにフォーマット文字列を解析しないようにする
+LENGTH_STRUCT = Struct('>I')
+HEADER_STRUCT = Struct('>IB')
+HAVE_STRUCT = Struct('>IBI')
+REQUEST_STRUCT = Struct('>IBIII')
+PIECE_HEADER_STRUCT = Struct('>IBII')
+HANDSHAKE_STRUCT = Struct('>B{}s8s20s20s'.format(HANDSHAKE_PROTOCOL_LEN))
 
-class WrongMessageException(Exception):
-    pass
+# 読み出し位置がこの値を超えたら受信バッファの先頭を詰める
+DECODER_COMPACT_THRESHOLD = 2 ** 16
+# この長さ以上のPieceのブロックは送信バッファにコピーせず、そのままトランスポートに渡す
+ZERO_COPY_BLOCK_SIZE = 2 ** 12
+# 受信するPieceのブロック長の上限. 一般的なクライアントが受け付けるRequestのブロック長の上限と同じ
+MAX_BLOCK_LENGTH = 2 ** 17
+# ピース数が分からない場合に受け付けるペイロード長の上限
+MAX_PAYLOAD_LENGTH = 2 ** 20 + 9
 
 
-class MessageDispatcher:
-    def __init__(self, payload: bytes):
-        self.payload = payload
-
-    def dispatch(self) -> 'Message':
-        payload_length, message_id = unpack('>IB', self.payload[:5])
+class WrongMessageException(Exception):
+    pass
 
-        map_id_to_message = {
-            0: Choke,
-            1: UnChoke,
-            2: Interested,
-            3: NotInterested,
-            4: Have,
-            5: BitField,
-            6: Request,
-            7: Piece,
-            8: Cancel,
-            9: Port
-        }
 
-        if message_id not in map_id_to_message:
-            raise WrongMessageException('Wrong message id')
+class ProtocolError(Exception):
+    pass
 
-        return map_id_to_message[message_id].from_bytes(self.payload)
 
 class Message:
+    total_length = -1
+
     def to_bytes(self) -> bytes:
         raise NotImplementedError()
 
+    def pack_into(self, buffer: bytearray, offset: int):
+        """bufferのoffsetの位置にメッセージを書き込みます. bufferにはtotal_length分の領域が必要です"""
+        data = self.to_bytes()
+        buffer[offset:offset + len(data)] = data
+
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Message':
         raise NotImplementedError()
 
-    @staticmethod
-    def _pack(format_string: str, *args) -> bytes:
-        return pack(format_string, *args)
-
-    @staticmethod
-    def _unpack(format_string: str, data: bytes) -> tuple:
-        return unpack(format_string, data)
-
 
 class UdpTrackerConnection(Message):
     def __init__(self):
@@ -74,8 +69,9 @@ class UdpTrackerConnection(Message):
 
 
 class UdpTrackerAnnounce(Message):
-    def __init__(self, info_hash: bytes, conn_id: bytes, peer_id: bytes):
+    def __init__(self, info_hash: bytes, conn_id: bytes, peer_id: bytes, port: int = 6881):
         super().__init__()
+        self.port = port
         self.peer_id = peer_id
         self.conn_id = conn_id
         self.info_hash = info_hash
@@ -91,7 +87,7 @@ class UdpTrackerAnnounce(Message):
         ip = pack('>I', 0)
         key = pack('>I', 0)
         num_want = pack('>i', -1)
-        port = pack('>h', 8000)
+        port = pack('>H', self.port)
 
         msg = (conn_id + self.action + self.trans_id + self.info_hash + self.peer_id + downloaded +
                left + uploaded + event + ip + key + num_want + port)
@@ -144,18 +140,14 @@ class Handshake(Message):
 
     def to_bytes(self) -> bytes:
         reserved = b'\x00' * 8
-        handshake = pack(">B{}s8s20s20s".format(HANDSHAKE_PROTOCOL_LEN),
-                         HANDSHAKE_PROTOCOL_LEN,
-                         HANDSHAKE_PROTOCOL,
-                         reserved,
-                         self.info_hash,
-                         self.peer_id)
-        return handshake
+        return HANDSHAKE_STRUCT.pack(HANDSHAKE_PROTOCOL_LEN, HANDSHAKE_PROTOCOL, reserved, self.info_hash,
+                                     self.peer_id)
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Handshake':
-        pstrlen, = unpack(">B", payload[:1])
-        pstr, reserved, info_hash, peer_id = unpack(">{}s8s20s20s".format(pstrlen), payload[1:cls.total_length])
+        if len(payload) < cls.total_length or payload[0] != HANDSHAKE_PROTOCOL_LEN:
+            raise ValueError("Invalid protocol")
+        pstrlen, pstr, reserved, info_hash, peer_id = HANDSHAKE_STRUCT.unpack_from(payload)
         if pstr != HANDSHAKE_PROTOCOL:
             raise ValueError("Invalid protocol")
         return cls(info_hash, peer_id)
@@ -166,82 +158,57 @@ class KeepAlive(Message):
     total_length = 4
 
     def to_bytes(self) -> bytes:
-        return self._pack(">I", self.payload_length)
+        return LENGTH_STRUCT.pack(self.payload_length)
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        LENGTH_STRUCT.pack_into(buffer, offset, self.payload_length)
 
     @classmethod
     def from_bytes(cls, payload: bytes):
-        payload_length, = cls._unpack(">I", payload[:cls.total_length])
+        payload_length, = LENGTH_STRUCT.unpack_from(payload)
         if payload_length != 0:
             raise WrongMessageException("Not a keep alive message")
         return KeepAlive()
 
 
-class Choke(Message):
-    message_id = 0
-    chokes_me = True
+class _NoPayloadMessage(Message):
+    """ペイロードを持たない (長さ1, IDのみの) メッセージの共通実装"""
+    message_id = -1
     payload_length = 1
     total_length = 5
 
     def to_bytes(self) -> bytes:
-        return self._pack(">IB", self.payload_length, self.message_id)
+        return HEADER_STRUCT.pack(self.payload_length, self.message_id)
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        HEADER_STRUCT.pack_into(buffer, offset, self.payload_length, self.message_id)
 
     @classmethod
     def from_bytes(cls, payload: bytes):
-        payload_length, message_id = cls._unpack(">IB", payload[:cls.total_length])
+        payload_length, message_id = HEADER_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
-            raise WrongMessageException("Not a choke message")
-        return Choke()
+            raise WrongMessageException("Not a {} message".format(cls.__name__))
+        return cls()
 
 
-class UnChoke(Message):
-    message_id = 1
-    chokes_me = False
-    payload_length = 1
-    total_length = 5
+class Choke(_NoPayloadMessage):
+    message_id = 0
+    chokes_me = True
 
-    def to_bytes(self) -> bytes:
-        return self._pack(">IB", self.payload_length, self.message_id)
 
-    @classmethod
-    def from_bytes(cls, payload: bytes):
-        payload_length, message_id = cls._unpack(">IB", payload[:cls.total_length])
-        if message_id != cls.message_id:
-            raise WrongMessageException("Not an UnChoke message")
-        return UnChoke()
+class UnChoke(_NoPayloadMessage):
+    message_id = 1
+    chokes_me = False
 
 
-class Interested(Message):
+class Interested(_NoPayloadMessage):
     message_id = 2
     interested = True
-    payload_length = 1
-    total_length = 4 + payload_length
-
-    def to_bytes(self) -> bytes:
-        return self._pack(">IB", self.payload_length, self.message_id)
-
-    @classmethod
-    def from_bytes(cls, payload: bytes):
-        payload_length, message_id = cls._unpack(">IB", payload[:cls.total_length])
-        if message_id != cls.message_id:
-            raise WrongMessageException("Not an interested message")
-        return Interested()
 
 
-class NotInterested(Message):
+class NotInterested(_NoPayloadMessage):
     message_id = 3
     interested = False
-    payload_length = 1
-    total_length = 5
-
-    def to_bytes(self) -> bytes:
-        return self._pack(">IB", self.payload_length, self.message_id)
-
-    @classmethod
-    def from_bytes(cls, payload: bytes):
-        payload_length, message_id = cls._unpack(">IB", payload[:cls.total_length])
-        if message_id != cls.message_id:
-            raise WrongMessageException("Not a Non Interested message")
-        return NotInterested()
 
 
 class Have(Message):
@@ -253,11 +220,14 @@ class Have(Message):
         self.piece_index = piece_index
 
     def to_bytes(self) -> bytes:
-        return self._pack(">IBI", self.payload_length, self.message_id, self.piece_index)
+        return HAVE_STRUCT.pack(self.payload_length, self.message_id, self.piece_index)
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        HAVE_STRUCT.pack_into(buffer, offset, self.payload_length, self.message_id, self.piece_index)
 
     @classmethod
     def from_bytes(cls, payload: bytes):
-        payload_length, message_id, piece_index = cls._unpack(">IBI", payload[:cls.total_length])
+        payload_length, message_id, piece_index = HAVE_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Have message")
         return Have(piece_index)
@@ -268,23 +238,29 @@ class BitField(Message):
     payload_length = -1  # This will be determined later based on the bitfield
     total_length = -1  # This will be determined later based on the payload_length
 
-    def __init__(self, bitfield: 'bitstring.BitArray'):
-        self.bitfield = bitfield
-        self.bitfield_as_bytes = bitfield.tobytes()
+    def __init__(self, bitfield):
+        """
+        :param bitfield: MSBが先頭のピースになるようにパックしたビットフィールド (bytes, bytearray, uint8のndarrayなど)
+        """
+        self.bitfield_as_bytes = bitfield.tobytes() if hasattr(bitfield, 'tobytes') else bytes(bitfield)
+        self.bitfield = self.bitfield_as_bytes
         self.bitfield_length = len(self.bitfield_as_bytes)
         self.payload_length = 1 + self.bitfield_length
         self.total_length = 4 + self.payload_length
 
     def to_bytes(self) -> bytes:
-        return self._pack(">IB{}s".format(self.bitfield_length), self.payload_length, self.message_id, self.bitfield_as_bytes)
+        return HEADER_STRUCT.pack(self.payload_length, self.message_id) + self.bitfield_as_bytes
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        HEADER_STRUCT.pack_into(buffer, offset, self.payload_length, self.message_id)
+        buffer[offset + 5:offset + self.total_length] = self.bitfield_as_bytes
 
     @classmethod
     def from_bytes(cls, payload: bytes):
-        payload_length, message_id = cls._unpack(">IB", payload[:5])
-        bitfield_length = payload_length - 1
-        raw_bitfield, = cls._unpack(">{}s".format(bitfield_length), payload[5:5 + bitfield_length])
-        bitfield = bitstring.BitArray(bytes=bytes(raw_bitfield))
-        return BitField(bitfield)
+        payload_length, message_id = HEADER_STRUCT.unpack_from(payload)
+        if message_id != cls.message_id:
+            raise WrongMessageException("Not a BitField message")
+        return BitField(bytes(payload[5:4 + payload_length]))
 
 
 class Request(Message):
@@ -298,11 +274,16 @@ class Request(Message):
         self.block_length = block_length
 
     def to_bytes(self) -> bytes:
-        return self._pack(">IBIII", self.payload_length, self.message_id, self.piece_index, self.block_offset, self.block_length)
+        return REQUEST_STRUCT.pack(self.payload_length, self.message_id, self.piece_index, self.block_offset,
+                                   self.block_length)
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        REQUEST_STRUCT.pack_into(buffer, offset, self.payload_length, self.message_id, self.piece_index,
+                                 self.block_offset, self.block_length)
 
     @classmethod
     def from_bytes(cls, payload: bytes):
-        payload_length, message_id, piece_index, block_offset, block_length = cls._unpack(">IBIII", payload[:cls.total_length])
+        payload_length, message_id, piece_index, block_offset, block_length = REQUEST_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Request message")
         return Request(piece_index, block_offset, block_length)
@@ -317,20 +298,28 @@ class Piece(Message):
         self.block_length = block_length
         self.piece_index = piece_index
         self.block_offset = block_offset
+        # MessageDecoderから生成された場合は受信バッファを参照するmemoryview
         self.block = block
         self.payload_length = 9 + block_length
         self.total_length = 4 + self.payload_length
 
     def to_bytes(self) -> bytes:
-        return self._pack(">IBII{}s".format(self.block_length), self.payload_length, self.message_id, self.piece_index, self.block_offset, self.block)
+        return PIECE_HEADER_STRUCT.pack(self.payload_length, self.message_id, self.piece_index,
+                                        self.block_offset) + bytes(self.block)
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        PIECE_HEADER_STRUCT.pack_into(buffer, offset, self.payload_length, self.message_id, self.piece_index,
+                                      self.block_offset)
+        buffer[offset + PIECE_HEADER_STRUCT.size:offset + self.total_length] = self.block
 
     @classmethod
     def from_bytes(cls, payload: bytes):
-        block_length = len(payload) - 13
-        payload_length, message_id, piece_index, block_offset, block = cls._unpack(">IBII{}s".format(block_length), payload[:13 + block_length])
+        payload_length, message_id, piece_index, block_offset = PIECE_HEADER_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Piece message")
-        return Piece(block_length, piece_index, block_offset, block)
+        # memoryviewが渡された場合、ブロックはコピーされない
+        block = payload[PIECE_HEADER_STRUCT.size:4 + payload_length]
+        return Piece(len(block), piece_index, block_offset, block)
 
 
 class Cancel(Message):
@@ -345,17 +334,16 @@ class Cancel(Message):
         self.block_length = block_length
 
     def to_bytes(self) -> bytes:
-        return self._pack(">IBIII",
-                    self.payload_length,
-                    self.message_id,
-                    self.piece_index,
-                    self.block_offset,
-                    self.block_length)
+        return REQUEST_STRUCT.pack(self.payload_length, self.message_id, self.piece_index, self.block_offset,
+                                   self.block_length)
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        REQUEST_STRUCT.pack_into(buffer, offset, self.payload_length, self.message_id, self.piece_index,
+                                 self.block_offset, self.block_length)
 
     @classmethod
     def from_bytes(cls, payload: bytes):
-        payload_length, message_id, piece_index, block_offset, block_length = cls._unpack(">IBIII",
-                                                                                     payload[:cls.total_length])
+        payload_length, message_id, piece_index, block_offset, block_length = REQUEST_STRUCT.unpack_from(payload)
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Cancel message")
 
@@ -372,16 +360,159 @@ class Port(Message):
         self.listen_port = listen_port
 
     def to_bytes(self) -> bytes:
-        return self._pack(">IBI",
-                    self.payload_length,
-                    self.message_id,
-                    self.listen_port)
+        return HAVE_STRUCT.pack(self.payload_length, self.message_id, self.listen_port)
+
+    def pack_into(self, buffer: bytearray, offset: int):
+        HAVE_STRUCT.pack_into(buffer, offset, self.payload_length, self.message_id, self.listen_port)
 
     @classmethod
     def from_bytes(cls, payload: bytes):
-        payload_length, message_id, listen_port = cls._unpack(">IBI", payload[:cls.total_length])
+        payload_length, message_id, listen_port = HAVE_STRUCT.unpack_from(payload)
 
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Port message")
 
         return Port(listen_port)
+
+
+# メッセージIDからクラスへの静的ディスパッチテーブル (インデックス = message_id)
+MESSAGE_TYPES = (Choke, UnChoke, Interested, NotInterested, Have, BitField, Request, Piece, Cancel, Port)
+
+
+class MessageDecoder:
+    """
+    受信したバイト列を蓄積し、完全なメッセージを順に取り出すストリーミングデコーダ。
+    バッファはbytearrayと読み出し位置で管理し、Pieceのブロックは受信バッファを参照するmemoryviewとして返します。
+    ペイロード長は、ピース数が分かる場合は MAX_BLOCK_LENGTH のPieceとBitFieldの大きい方、
+    分からない場合は MAX_PAYLOAD_LENGTH までに制限し、超える長さを受け取った時点でProtocolErrorを送出します。
+    """
+    def __init__(self, expect_handshake: bool = True, number_of_pieces: Optional[int] = None):
+        self._buffer = bytearray()
+        self._offset = 0
+        self.expect_handshake = expect_handshake
+        if number_of_pieces is None:
+            self.max_payload_length = MAX_PAYLOAD_LENGTH
+        else:
+            self.max_payload_length = max(PIECE_HEADER_STRUCT.size - LENGTH_PREFIX + MAX_BLOCK_LENGTH,
+                                          (number_of_pieces + 7) // 8 + 1)
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def feed(self, data: bytes):
+        """受信したデータをバッファに追加します"""
+        if self._offset == len(self._buffer):
+            # 全て消費済みのバッファは返却済みのmemoryviewが参照している可能性があるため、再利用せず作り直す
+            self._buffer = bytearray(data)
+            self._offset = 0
+            return
+
+        try:
+            if self._offset >= DECODER_COMPACT_THRESHOLD:
+                del self._buffer[:self._offset]
+                self._offset = 0
+            self._buffer += data
+        except BufferError:
+            # 返却済みのmemoryviewがバッファを参照しているため、未消費の部分だけを新しいバッファへ移す
+            with memoryview(self._buffer) as view:
+                buffer = bytearray(view[self._offset:])
+            buffer += data
+            self._buffer = buffer
+            self._offset = 0
+
+    def next_message(self) -> Optional[Message]:
+        """
+        バッファから次のメッセージを取り出します。完全なメッセージが無い場合はNoneを返します。
+        未知のメッセージIDの場合はそのメッセージを読み飛ばした上でWrongMessageExceptionを送出します。
+        ペイロード長が上限を超える場合は、データが揃うのを待たずにProtocolErrorを送出します。
+        以降のデータはメッセージの境界が分からないため、呼び出し側は接続を切ってください
+        """
+        buffer = self._buffer
+        offset = self._offset
+        available = len(buffer) - offset
+
+        if self.expect_handshake and available > 0:
+            if buffer[offset] != HANDSHAKE_PROTOCOL_LEN:
+                self.expect_handshake = False
+            elif available < Handshake.total_length:
+                return None
+            else:
+                self.expect_handshake = False
+                self._offset = offset + Handshake.total_length
+                return Handshake.from_bytes(memoryview(buffer)[offset:self._offset])
+
+        if available < LENGTH_PREFIX:
+            return None
+
+        payload_length, = LENGTH_STRUCT.unpack_from(buffer, offset)
+        if payload_length == 0:
+            self._offset = offset + LENGTH_PREFIX
+            return KeepAlive()
+        if payload_length > self.max_payload_length:
+            raise ProtocolError('payload length {} exceeds {}'.format(payload_length, self.max_payload_length))
+
+        end = offset + LENGTH_PREFIX + payload_length
+        if end > len(buffer):
+            return None
+        self._offset = end
+
+        message_id = buffer[offset + LENGTH_PREFIX]
+        if message_id >= len(MESSAGE_TYPES):
+            raise WrongMessageException('Wrong message id')
+
+        return MESSAGE_TYPES[message_id].from_bytes(memoryview(buffer)[offset:end])
+
+
+class MessageEncoder:
+    """
+    送信するメッセージを再利用可能なbytearrayへ直接パックするエンコーダ。
+    ZERO_COPY_BLOCK_SIZE以上のPieceはヘッダのみをパックし、ブロックはflush_chunks()で参照のまま返します
+    """
+    def __init__(self, capacity: int = 2 ** 16):
+        self._buffer = bytearray(capacity)
+        self._length = 0
+        # バッファにコピーしなかったブロック: (直前までのバッファの位置, ブロック)
+        self._blocks = []
+        self._block_bytes = 0
+        self.message_count = 0
+
+    def __len__(self):
+        return self._length + self._block_bytes
+
+    def encode(self, message: Message):
+        """メッセージをバッファの末尾に書き込みます"""
+        if isinstance(message, Piece) and message.block_length >= ZERO_COPY_BLOCK_SIZE:
+            end = self._reserve(PIECE_HEADER_STRUCT.size)
+            PIECE_HEADER_STRUCT.pack_into(self._buffer, self._length, message.payload_length, message.message_id,
+                                          message.piece_index, message.block_offset)
+            self._blocks.append((end, message.block))
+            self._block_bytes += message.block_length
+        else:
+            end = self._reserve(message.total_length)
+            message.pack_into(self._buffer, self._length)
+        self._length = end
+        self.message_count += 1
+
+    def _reserve(self, length: int) -> int:
+        end = self._length + length
+        if end > len(self._buffer):
+            self._buffer.extend(bytes(max(end - len(self._buffer), len(self._buffer))))
+        return end
+
+    def flush_chunks(self) -> list:
+        """書き込まれたデータを、バッファの区間のbytesとコピーしなかったブロックを交互に並べたリストで取り出します"""
+        chunks = []
+        start = 0
+        with memoryview(self._buffer) as view:
+            for end, block in self._blocks:
+                if end > start:
+                    chunks.append(view[start:end].tobytes())
+                chunks.append(block)
+                start = end
+            if self._length > start:
+                chunks.append(view[start:self._length].tobytes())
+        self._length = 0
+        self._blocks = []
+        self._block_bytes = 0
+        self.message_count = 0
+        return chunks
@@ -1,12 +1,59 @@
-from typing import Optional
+from typing import Optional, Callable, Awaitable, Dict, Tuple, List
 import asyncio
-import bitstring
-import struct
+import math
+import random
+import string
 import time
 
-from .message import Handshake, KeepAlive, Interested, Request,MessageDispatcher, WrongMessageException, UnChoke
-
-peer_id = "-AZ2200-6wfG2wk6wWLc"
+import numpy as np
+
+from ..piece import BLOCK_SIZE
+from ...utils import Timer, TimerWheel
+from .message import Message, Handshake, KeepAlive, Choke, UnChoke, Interested, NotInterested, Request, Piece, \
+    Cancel, WrongMessageException, MessageDecoder, MessageEncoder
+
+# クライアント名 (Azureus形式) にプロセスごとに無作為な12文字を付けたpeer_id.
+# 固定の値にすると、このクライアントの別のインスタンスとの接続を自分自身への接続として切断してしまう
+peer_id = '-AZ2200-' + ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+# 他のピアからの接続を受け付けるポート. トラッカーにもこのポートを通知する
+LISTEN_PORT = 6881
+
+# 受信タスクが1回のreadで読み込む最大バイト数
+READ_SIZE = 2 ** 16
+
+# 送信タスクが1回の書き込みにまとめる最大バイト数. これを超えるか送信キューが空になった時点で書き出す
+SEND_FLUSH_THRESHOLD = 2 ** 16
+
+# リクエストパイプライン: 1ピアあたりに同時に送信済みにしておくRequest数の範囲
+MIN_REQUEST_QUEUE = 2
+MAX_REQUEST_QUEUE = 250
+INITIAL_REQUEST_QUEUE = 4
+# 帯域遅延積に対するキュー長の倍率. 1より大きくすることで帯域に余裕がある間はキュー長が増え続ける
+REQUEST_QUEUE_FACTOR = 2
+# 応答の無いRequestを破棄するまでの時間 (秒)
+REQUEST_TIMEOUT = 5
+# 受信レートを計測する間隔 (秒) と指数移動平均の係数
+RATE_INTERVAL = 0.5
+RATE_ALPHA = 0.5
+# RTTの指数移動平均の係数 (TCPのSRTTと同じ1/8)
+RTT_ALPHA = 0.125
+# Requestを送っているのにこの時間 (秒) データが届かないピアはsnubbedとみなす
+SNUB_TIMEOUT = 15
+# この時間 (秒) 何も送信していなければKeepAliveを送る (BEP 3 の2分)
+KEEPALIVE_INTERVAL = 120
+# この時間 (秒) 何も受信していないピアは切断する
+PEER_IDLE_TIMEOUT = 300
+# 接続とハンドシェイクの受信それぞれのタイムアウト (秒)
+CONNECT_TIMEOUT = 5
+# ピアから受け付けるRequestの数とブロック長の上限. 超えたRequestは無視する
+MAX_UPLOAD_REQUESTS = 500
+MAX_UPLOAD_BLOCK_SIZE = 2 ** 17
+# 送信キューに積んだまま書き出していないブロックの上限 (バイト). 超えている間はストレージから読み込まない
+UPLOAD_QUEUE_SIZE = 2 ** 18
+
+
+class InvalidHandshakeException(Exception):
+    pass
 
 
 class Peer:
@@ -21,7 +68,11 @@ class Peer:
 
         self.info_hash = info_hash
         self.has_handshacked = False
-        self.bit_field = bitstring.BitArray(number_of_pieces)
+        # ハンドシェイクで受け取った相手のpeer_id
+        self.peer_id: Optional[bytes] = None
+        self.number_of_pieces = number_of_pieces
+        # ピアが保有するピース. BitFieldメッセージと同じ並び (MSBが先頭のピース) でパックしたuint8配列
+        self.bit_field = np.zeros((number_of_pieces + 7) // 8, dtype=np.uint8)
 
         self.last_call = time.time()
         self.healthy = False
@@ -32,34 +83,226 @@ class Peer:
             'peer_interested' : False,
         }
 
-        self.read_buffer = b''
+        # 送信済みで応答待ちのRequest. key: (piece_index, block_offset), value: 送信時刻
+        self.outstanding_requests: Dict[Tuple[int, int], float] = {}
+        self.max_outstanding_requests = INITIAL_REQUEST_QUEUE
+        # 受信レート (bytes/s) と最小RTT (s). キュー長は帯域遅延積から決まる
+        self.download_rate = 0.0
+        self.min_rtt = math.inf
+        # RTTの平滑値 (s)
+        self.rtt = 0.0
+        # 最後にブロックを受信した時刻. 応答待ちのRequestが無い間はRequestを送り始めた時刻
+        self.last_data_time = time.monotonic()
+        self.snubbed = False
+        # 最後にキュー長を半分にした時刻. それより前に送ったRequestのタイムアウトでは再び半分にしない
+        self._backoff_time = 0.0
+        self._rate_bytes = 0
+        self._rate_start = time.monotonic()
+        # 受信したブロックの合計 (バイト)
+        self.downloaded = 0
+        # ブロックを送ったピースのハッシュが一致しなかった回数
+        self.hash_failures = 0
+        # start()した時刻. 新しく接続したピアをオプティミスティックアンチョークで優先するのに使う
+        self.connected_at = time.monotonic()
+
+        # ピース数から、受け付けるメッセージの長さの上限が決まる
+        self.decoder = MessageDecoder(number_of_pieces=number_of_pieces)
+        self.encoder = MessageEncoder()
+
+        # 送信待ちのメッセージ. 送信タスクが順に書き出す
+        self.send_queue: asyncio.Queue = asyncio.Queue()
+        self.receive_task: Optional[asyncio.Task] = None
+        self.send_task: Optional[asyncio.Task] = None
+        # 書き込み回数と書き込んだメッセージ数. messages_per_flush()で1回あたりのメッセージ数を確認できる
+        self.flush_count = 0
+        self.flushed_messages = 0
+        # 最後にデータを受信・送信した時刻. キープアライブとアイドルなピアの切断に使う
+        self.last_received = time.monotonic()
+        self.last_sent = time.monotonic()
+
+        # Requestのタイムアウト、snubbedの判定、キープアライブはタイマーホイールで管理する
+        self.timers: Optional[TimerWheel] = None
+        self._request_timers: Dict[Tuple[int, int], Timer] = {}
+        self._snub_timer: Optional[Timer] = None
+        self._keepalive_timer: Optional[Timer] = None
+        # タイムアウトやsnubbedで取り除いたRequestを受け取るコールバック
+        self._handle_expired: Optional[Callable[['Peer', List[Tuple[int, int]]], None]] = None
+
+        # ピアから受け付けて、まだ読み込んでいないRequest. key: (piece_index, block_offset, block_length)
+        self.upload_requests: Dict[Tuple[int, int, int], None] = {}
+        # 送信キューに積んだPieceのRequest. 書き出す前にCancelやChokeで取り除かれたものは送らない
+        self._upload_sending = set()
+        self.upload_queued_bytes = 0
+        # 送信したブロックの合計 (バイト)
+        self.uploaded = 0
+        # 送信キューに空きができた時に、次のブロックの読み込みを依頼するコールバック
+        self._handle_upload_ready: Optional[Callable[['Peer'], None]] = None
 
     def __hash__(self):
-        return '{}:{}:{}'.format(self.info_hash, self.ip, self.port)
+        return hash((self.info_hash, self.ip, self.port))
 
-    async def connect(self):
+    async def connect(self, timeout: float = CONNECT_TIMEOUT) -> bool:
+        """
+        ピアに接続してハンドシェイクを交換します。相手のハンドシェイクのinfo_hashが一致した場合にTrueを返します。
+        接続とハンドシェイクの受信はそれぞれtimeout秒で打ち切ります。
+        """
         try:
-            self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
-            await self.do_handshake()
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), timeout)
+            await self.do_handshake(timeout)
             return True
         except Exception as e:
-            print(e)
+            print(f"connect {self.ip}:{self.port}: {e!r}")
+            if self.writer:
+                self.writer.close()
 
         return False
 
+    def start(self, handle_message: Callable[[Message, 'Peer'], Awaitable],
+              handle_close: Callable[['Peer'], Awaitable],
+              timers: Optional[TimerWheel] = None,
+              handle_expired: Optional[Callable[['Peer', List[Tuple[int, int]]], None]] = None,
+              handle_upload_ready: Optional[Callable[['Peer'], None]] = None):
+        """
+        ピア専用の受信タスクと送信タスクを開始します。
+        timersは複数のピアで共有するタイマーホイールで、handle_expiredはタイムアウトしたRequestを受け取ります。
+        handle_upload_readyは、受け付けたRequestがあり送信キューに空きができた時に呼び出されます。
+        """
+        self.healthy = True
+        self.connected_at = time.monotonic()
+        self.timers = timers if timers is not None else TimerWheel()
+        self._handle_expired = handle_expired
+        self._handle_upload_ready = handle_upload_ready
+        self.receive_task = asyncio.create_task(self._receive_loop(handle_message, handle_close))
+        self.send_task = asyncio.create_task(self._send_loop())
+        self._keepalive_timer = self.timers.call_later(KEEPALIVE_INTERVAL, self._keepalive)
+
     async def close(self):
+        """受信・送信タスクとタイマーをキャンセルし、接続を閉じます"""
+        self.healthy = False
+        self.clear_requests()
+        self.clear_upload_requests()
+        for timer in (self._snub_timer, self._keepalive_timer):
+            if timer is not None:
+                timer.cancel()
+        self._snub_timer = self._keepalive_timer = None
+        current_task = asyncio.current_task()
+        tasks = [task for task in (self.receive_task, self.send_task) if task and task is not current_task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
         if self.writer:
             self.writer.close()
-            await self.writer.wait_closed()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _receive_loop(self, handle_message, handle_close):
+        """ピアからデータを受信し続け、デコードしたメッセージをhandle_messageに渡します"""
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                self.last_received = time.monotonic()
+                self.feed(data)
+                async for msg in self.get_messages():
+                    await handle_message(msg, self)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(e)
+
+        # 接続が切れた、またはエラーが発生した場合
+        await handle_close(self)
+
+    async def _send_loop(self):
+        """送信キューに溜まったメッセージをまとめて、1回の書き込みでピアへ書き出します"""
+        try:
+            while True:
+                self._encode(await self.send_queue.get())
+                while not self.send_queue.empty() and len(self.encoder) < SEND_FLUSH_THRESHOLD:
+                    self._encode(self.send_queue.get_nowait())
+                if not len(self.encoder):
+                    # 取り消されたブロックだけだった
+                    continue
+
+                self.flush_count += 1
+                self.flushed_messages += self.encoder.message_count
+                # ブロックはコピーせずにトランスポートへ渡す
+                self.writer.writelines(self.encoder.flush_chunks())
+                self.last_sent = time.monotonic()
+                await self.writer.drain()
+                if self.upload_requests and self._handle_upload_ready is not None:
+                    self._handle_upload_ready(self)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(e)
+            self.healthy = False
+
+    def _encode(self, message: Message):
+        if isinstance(message, Piece):
+            key = (message.piece_index, message.block_offset, message.block_length)
+            self.upload_queued_bytes -= message.block_length
+            if key not in self._upload_sending:
+                return
+            self._upload_sending.discard(key)
+            self.uploaded += message.block_length
+        self.encoder.encode(message)
 
     def is_eligible(self):
         now = time.time()
         return (now - self.last_call) > 0  # 0.001
 
-    async def do_handshake(self):
-        handshake = Handshake(self.info_hash, peer_id=bytes(peer_id, 'utf-8'))
-        self.writer.write(handshake.to_bytes())
-        await self.writer.drain()
+    async def do_handshake(self, timeout: float = CONNECT_TIMEOUT):
+        """ハンドシェイクを送信し、相手のハンドシェイクを受信して検証します. 送信タスクの開始前に呼び出します"""
+        self.writer.write(Handshake(self.info_hash, peer_id=bytes(peer_id, 'utf-8')).to_bytes())
+        await self.receive_handshake(timeout)
+
+    async def receive_handshake(self, timeout: float = CONNECT_TIMEOUT):
+        """
+        相手のハンドシェイクを受信し、info_hashが一致しない場合や自分自身に接続した場合は
+        InvalidHandshakeExceptionを送出します
+        """
+        data = await asyncio.wait_for(self.reader.readexactly(Handshake.total_length), timeout)
+        try:
+            handshake = Handshake.from_bytes(data)
+        except ValueError as e:
+            raise InvalidHandshakeException(str(e))
+        self._check_handshake(handshake)
+
+    def accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handshake: Handshake):
+        """
+        相手から接続されたピアとして、受信済みのハンドシェイクを検証して自分のハンドシェイクを返します。
+        送信タスクの開始前に呼び出します
+        """
+        self.reader, self.writer = reader, writer
+        self._check_handshake(handshake)
+        self.writer.write(Handshake(self.info_hash, peer_id=bytes(peer_id, 'utf-8')).to_bytes())
+
+    def _check_handshake(self, handshake: Handshake):
+        if handshake.info_hash != self.info_hash:
+            raise InvalidHandshakeException("info_hash mismatch")
+        if handshake.peer_id == bytes(peer_id, 'utf-8'):
+            raise InvalidHandshakeException("connected to self")
+        self.peer_id = handshake.peer_id
+        self.has_handshacked = True
+        # 以降の受信データはハンドシェイクを含まない
+        self.decoder.expect_handshake = False
+
+    async def send_message(self, message: Message):
+        """メッセージを送信キューに追加します. 実際の書き込みは送信タスクが行います"""
+        self.send_queue.put_nowait(message)
+
+    def messages_per_flush(self) -> float:
+        """1回の書き込みあたりの平均メッセージ数を返します"""
+        return self.flushed_messages / self.flush_count if self.flush_count else 0.0
+
+    def feed(self, data: bytes):
+        """ピアから受信したデータをデコーダに渡します"""
+        self.decoder.feed(data)
 
     async def _read_block(self, length: int) -> bytes:
         try:
@@ -68,47 +311,191 @@ class Peer:
             return b''
 
     async def request_block(self, piece_index: int, block_offset: int, block_length: int):
-        msg = Request(piece_index, block_offset, block_length)
-        self.writer.write(msg.to_bytes())
-        await self.writer.drain()
+        now = time.monotonic()
+        if not self.outstanding_requests:
+            self.last_data_time = now
+            if self._rate_bytes == 0:
+                # アイドル時間を受信レートに含めない
+                self._rate_start = now
+        key = (piece_index, block_offset)
+        self.outstanding_requests[key] = now
+        if self.timers is not None:
+            self._request_timers[key] = self.timers.call_later(REQUEST_TIMEOUT, self._request_expired, key)
+            if self._snub_timer is None and not self.snubbed:
+                self._snub_timer = self.timers.call_later(self.last_data_time + SNUB_TIMEOUT - now, self._check_snubbed)
+        await self.send_message(Request(piece_index, block_offset, block_length))
+
+    async def cancel_request(self, piece_index: int, block_offset: int, block_length: int) -> bool:
+        """応答待ちのRequestであればパイプラインから取り除いてCancelを送信し、Trueを返します"""
+        if self.outstanding_requests.pop((piece_index, block_offset), None) is None:
+            return False
+        self._cancel_request_timer((piece_index, block_offset))
+        await self.send_message(Cancel(piece_index, block_offset, block_length))
+        return True
+
+    def has_requested(self, piece_index: int, block_offset: int) -> bool:
+        return (piece_index, block_offset) in self.outstanding_requests
+
+    def can_request(self) -> bool:
+        """パイプラインに空きがあるかどうかを返します"""
+        return len(self.outstanding_requests) < self.max_outstanding_requests
+
+    def block_received(self, piece_index: int, block_offset: int, block_length: int) -> bool:
+        """
+        受信したブロックに対応するRequestをパイプラインから取り除き、RTTと受信レートを更新します。
+        このピアに要求していたブロックであればTrueを返します。
+        """
+        now = time.monotonic()
+        self.last_data_time = now
+        self.snubbed = False
+        sent_time = self.outstanding_requests.pop((piece_index, block_offset), None)
+        if sent_time is not None:
+            self._cancel_request_timer((piece_index, block_offset))
+            rtt = now - sent_time
+            self.min_rtt = min(self.min_rtt, rtt)
+            self.rtt = RTT_ALPHA * rtt + (1 - RTT_ALPHA) * self.rtt if self.rtt else rtt
+
+        self.downloaded += block_length
+        self._rate_bytes += block_length
+        elapsed = now - self._rate_start
+        if elapsed >= RATE_INTERVAL:
+            sample = self._rate_bytes / elapsed
+            if self.download_rate:
+                self.download_rate = RATE_ALPHA * sample + (1 - RATE_ALPHA) * self.download_rate
+            else:
+                self.download_rate = sample
+            self._rate_bytes = 0
+            self._rate_start = now
+            self._update_request_queue()
+
+        return sent_time is not None
+
+    def _cancel_request_timer(self, key: Tuple[int, int]):
+        timer = self._request_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _request_expired(self, key: Tuple[int, int]):
+        """
+        タイマーから呼び出され、REQUEST_TIMEOUTを過ぎたRequestを取り除きます。
+        キュー長は、前回半分にした後に送ったRequestがタイムアウトした場合のみ半分にします。
+        """
+        self._request_timers.pop(key, None)
+        sent_time = self.outstanding_requests.pop(key, None)
+        if sent_time is None:
+            return
+        if sent_time >= self._backoff_time:
+            self.max_outstanding_requests = max(MIN_REQUEST_QUEUE, self.max_outstanding_requests // 2)
+            self._backoff_time = time.monotonic()
+        if self._handle_expired is not None:
+            self._handle_expired(self, [key])
+
+    def _check_snubbed(self):
+        """
+        タイマーから呼び出され、応答待ちのRequestがあるのにSNUB_TIMEOUTの間データが届いていない場合にsnubbedとします。
+        snubbedになったピアはパイプラインを1つに絞り、応答待ちのRequestを全て取り除きます。
+        データが届いていた場合は、最後に受信した時刻から数え直します。
+        """
+        self._snub_timer = None
+        if self.snubbed or not self.outstanding_requests:
+            return
+        remaining = self.last_data_time + SNUB_TIMEOUT - time.monotonic()
+        if remaining > 0:
+            self._snub_timer = self.timers.call_later(remaining, self._check_snubbed)
+            return
+        self.snubbed = True
+        self.download_rate = 0.0
+        self.max_outstanding_requests = 1
+        requests = self.clear_requests()
+        if self._handle_expired is not None:
+            self._handle_expired(self, requests)
+
+    def _keepalive(self):
+        """
+        タイマーから呼び出され、PEER_IDLE_TIMEOUTの間何も受信していないピアを切断します。
+        そうでなければ、KEEPALIVE_INTERVALの間何も送信していない場合にKeepAliveを送ります。
+        """
+        self._keepalive_timer = None
+        now = time.monotonic()
+        if now - self.last_received >= PEER_IDLE_TIMEOUT:
+            self.healthy = False
+            # 接続を閉じると、受信タスクが切断として処理してhandle_closeを呼び出す
+            if self.writer:
+                self.writer.close()
+            return
+        if now - self.last_sent >= KEEPALIVE_INTERVAL:
+            self.send_queue.put_nowait(KeepAlive())
+            self.last_sent = now
+        next_time = min(self.last_sent + KEEPALIVE_INTERVAL, self.last_received + PEER_IDLE_TIMEOUT)
+        self._keepalive_timer = self.timers.call_later(next_time - now, self._keepalive)
+
+    def get_stats(self) -> dict:
+        """ピアの受信レートなどの統計情報を返します"""
+        return {
+            'ip': self.ip,
+            'port': self.port,
+            'download_rate': self.download_rate,
+            'rtt': self.rtt,
+            'min_rtt': self.min_rtt if self.min_rtt != math.inf else None,
+            'outstanding_requests': len(self.outstanding_requests),
+            'max_outstanding_requests': self.max_outstanding_requests,
+            'snubbed': self.snubbed,
+            'peer_choking': self.is_choking(),
+            'am_interested': self.am_interested(),
+            'messages_per_flush': self.messages_per_flush(),
+            'am_choking': self.am_choking(),
+            'uploaded': self.uploaded,
+            'upload_requests': len(self.upload_requests),
+        }
+
+    def clear_requests(self) -> List[Tuple[int, int]]:
+        """応答待ちのRequestを全て取り除いて返します (Chokeや切断時)"""
+        requests = list(self.outstanding_requests)
+        self.outstanding_requests.clear()
+        for timer in self._request_timers.values():
+            timer.cancel()
+        self._request_timers.clear()
+        return requests
+
+    def _update_request_queue(self):
+        """受信レートと最小RTTから求めた帯域遅延積をもとにキュー長を調整します"""
+        if self.min_rtt == math.inf:
+            return
+        bdp_blocks = self.download_rate * self.min_rtt / BLOCK_SIZE
+        queue = math.ceil(bdp_blocks * REQUEST_QUEUE_FACTOR)
+        self.max_outstanding_requests = max(MIN_REQUEST_QUEUE, min(MAX_REQUEST_QUEUE, queue))
 
     async def send_interested(self):
-        msg = Interested().to_bytes()
-        self.writer.write(msg)
-        await self.writer.drain()
-
-    async def get_messages(self) :
-        # read_bufferに4バイト以上のデータが存在し、接続が健全な間は処理を続ける
-        while len(self.read_buffer) > 4:
-            # ハンドシェイク処理またはキープアライブ処理を行う場合は無視
-            if (not self.has_handshacked and self._handle_handshake()) or self._handle_keep_alive() :
-               continue
-
-            # メッセージのペイロード長を取得（先頭4バイト)
-            payload_length, = struct.unpack(">I", self.read_buffer[:4])
-            total_length = payload_length + 4
-            print(total_length)
-            # read_buffer内のデータが足りない場合はループを抜ける
-            if len(self.read_buffer) < total_length :
-                break
-            else :
-                # 完全なメッセージをペイロードとして取り出す
-                payload = self.read_buffer[:total_length]
-                # read_bufferから取り出した分を削除
-                self.read_buffer = self.read_buffer[total_length :]
-
-            try :
-                print(payload)
-                # 取得したペイロードからメッセージを分解・処理
-                received_message = MessageDispatcher(payload).dispatch()
-                print(received_message)
-                if received_message :
-                    yield received_message
-            except WrongMessageException as e :
+        await self.send_message(Interested())
+
+    async def get_messages(self):
+        """受信済みのデータから完全なメッセージを順に取り出します。ハンドシェイクとキープアライブはここで処理します"""
+        while True:
+            try:
+                received_message = self.decoder.next_message()
+            except WrongMessageException as e:
                 print(e)
+                continue
+
+            if received_message is None:
+                break
+
+            if isinstance(received_message, Handshake):
+                self.has_handshacked = True
+                continue
+
+            if isinstance(received_message, KeepAlive):
+                self.last_call = time.time()
+                continue
+
+            yield received_message
 
     def has_piece(self, index):
-        return self.bit_field[index]
+        return bool(self.bit_field[index >> 3] & (0x80 >> (index & 7)))
+
+    def piece_mask(self) -> np.ndarray:
+        """ピアが保有しているピースを0/1で表した、ピース数と同じ長さの配列を返します"""
+        return np.unpackbits(self.bit_field, count=self.number_of_pieces)
 
     def am_choking(self):
         return self.state['am_choking']
@@ -128,31 +515,6 @@ class Peer:
     def am_interested(self) :
         return self.state['am_interested']
 
-    def _handle_handshake(self) :
-        try :
-            handshake_message = Handshake.from_bytes(self.read_buffer)
-            self.has_handshacked = True
-            self.read_buffer = self.read_buffer[handshake_message.total_length :]
-            return True
-        except Exception :
-            self.healthy = False
-
-        return False
-
-    def _handle_keep_alive(self):
-        try:
-            keep_alive = KeepAlive.from_bytes(self.read_buffer)
-        except WrongMessageException:
-            return False
-        """
-        except Exception:
-            logger.exception("Error KeepALive, (need at least 4 bytes : {})".format(len(self.read_buffer)))
-            return False
-        """
-
-        self.read_buffer = self.read_buffer[KeepAlive.total_length:]
-        return True
-
     async def handle_choke(self):
         self.state['peer_choking'] = True
 
@@ -161,54 +523,109 @@ class Peer:
 
     async def handle_interested(self) :
         self.state['peer_interested'] = True
-        if self.am_choking():
-            unchoke = UnChoke().to_bytes()
-            self.writer.write(unchoke)
-            await self.writer.drain()
 
     async def handle_not_interested(self) :
         self.state['peer_interested'] = False
 
+    def choke(self):
+        """状態が変わる場合のみChokeを送信します. 受け付けたRequestは全て破棄します"""
+        if self.am_choking():
+            return
+        self.state['am_choking'] = True
+        self.clear_upload_requests()
+        self.send_queue.put_nowait(Choke())
+
+    def unchoke(self):
+        """状態が変わる場合のみUnChokeを送信します"""
+        if not self.am_choking():
+            return
+        self.state['am_choking'] = False
+        self.send_queue.put_nowait(UnChoke())
+
+    async def set_interested(self, interested: bool):
+        """状態が変わる場合のみInterested/NotInterestedを送信します"""
+        if self.state['am_interested'] == interested:
+            return
+        self.state['am_interested'] = interested
+        await self.send_message(Interested() if interested else NotInterested())
+
     async def handle_have(self, have) :
         """
         :type have: message.Have
         """
-        self.bit_field[have.piece_index] = True
-
-        if self.is_choking() and not self.state['am_interested']:
-            interested = Interested().to_bytes()
-            self.writer.write(interested)
-            await self.writer.drain()
-            self.state['am_interested'] = True
+        if have.piece_index < self.number_of_pieces:
+            self.bit_field[have.piece_index >> 3] |= 0x80 >> (have.piece_index & 7)
 
     async def handle_bitfield(self, bitfield) :
         """
         :type bitfield: message.BitField
         """
-        self.bit_field = bitfield.bitfield
-
-        if self.is_choking() and not self.state['am_interested']:
-            interested = Interested().to_bytes()
-            self.writer.write(interested)
-            await self.writer.drain()
-            self.state['am_interested'] = True
-
-    # TODO: 未実装
-    async def handle_request(self, request) :
+        received = np.frombuffer(bitfield.bitfield_as_bytes, dtype=np.uint8)[:len(self.bit_field)]
+        bit_field = np.zeros_like(self.bit_field)
+        bit_field[:len(received)] = received
+        # ピース数を超える末尾の余りビットは無視する
+        spare_bits = len(bit_field) * 8 - self.number_of_pieces
+        if spare_bits:
+            bit_field[-1] &= (0xff << spare_bits) & 0xff
+        self.bit_field = bit_field
+
+    async def handle_request(self, request) -> bool:
         """
+        Chokeしていないピアからの、上限を超えないRequestを受け付けてTrueを返します。
+        ピースを保有しているかどうかは呼び出し側で確認します。
         :type request: message.Request
         """
-        if self.is_interested() and self.is_unchoked():
-            return request
+        key = (request.piece_index, request.block_offset, request.block_length)
+        if self.am_choking() or not 0 < request.block_length <= MAX_UPLOAD_BLOCK_SIZE:
+            return False
+        if len(self.upload_requests) >= MAX_UPLOAD_REQUESTS or key in self.upload_requests \
+                or key in self._upload_sending:
+            return False
+        self.upload_requests[key] = None
+        return True
 
     @staticmethod
     async def handle_piece(message) :
         piece = (message.piece_index, message.block_offset, message.block)
         return piece
 
-    # TODO: 未実装
-    async def handle_cancel(self):
-        pass
+    async def handle_cancel(self, cancel):
+        """
+        まだ送信していないブロックのRequestを取り除きます。送信キューに積んだブロックも書き出す前なら送りません
+        :type cancel: message.Cancel
+        """
+        key = (cancel.piece_index, cancel.block_offset, cancel.block_length)
+        self.upload_requests.pop(key, None)
+        self._upload_sending.discard(key)
+
+    def next_upload(self) -> Optional[Tuple[int, int, int]]:
+        """次に読み込むRequestを返します. 送信キューに空きが無い場合や受け付けたRequestが無い場合はNoneを返します"""
+        if not self.healthy or not self.upload_requests or self.upload_queued_bytes >= UPLOAD_QUEUE_SIZE:
+            return None
+        return next(iter(self.upload_requests))
+
+    def send_block(self, key: Tuple[int, int, int], block) -> bool:
+        """
+        読み込んだブロックを送信キューに積みます。読み込み中に取り除かれたRequestであればFalseを返します。
+        blockはコピーされずに送信タスクへ渡されます
+        """
+        if key not in self.upload_requests:
+            return False
+        del self.upload_requests[key]
+        piece_index, block_offset, block_length = key
+        self._upload_sending.add(key)
+        self.upload_queued_bytes += block_length
+        self.send_queue.put_nowait(Piece(block_length, piece_index, block_offset, block))
+        return True
+
+    def drop_upload(self, key: Tuple[int, int, int]):
+        """送信できなくなったRequestを取り除きます"""
+        self.upload_requests.pop(key, None)
+
+    def clear_upload_requests(self):
+        """受け付けたRequestと、送信キューに積んでまだ書き出していないブロックを全て破棄します (Chokeや切断時)"""
+        self.upload_requests.clear()
+        self._upload_sending.clear()
 
     # TODO: 未実装
     async def handle_port_request(self):
@@ -0,0 +1,76 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .peer import Peer
+
+# インデックスに登録できるピアの最大数 (ピースごとのビットマスクの幅)
+MAX_INDEXED_PEERS = 64
+
+
+class PiecePeerIndex(object):
+    """
+    ピースのインデックスから、そのピースを持ちブロックを要求できる (Unchokeされ、Interestedを送っている) ピアを引く索引。
+    各ピアにスロット番号を割り当て、ピースごとにスロットのビットマスクを保持します。
+    """
+    def __init__(self, number_of_pieces: int):
+        self.number_of_pieces = number_of_pieces
+        self._masks = np.zeros(number_of_pieces, dtype=np.uint64)
+        self._slots: List[Optional[Peer]] = [None] * MAX_INDEXED_PEERS
+        self._slot_of: Dict[Peer, int] = {}
+        # スロットごとに、現在ブロックを要求できる状態として索引に反映されているかどうか
+        self._ready = [False] * MAX_INDEXED_PEERS
+
+    def add(self, peer: Peer):
+        """ピアにスロットを割り当てます. 空きが無い場合は索引に登録しません"""
+        if peer in self._slot_of:
+            return
+        for slot, slot_peer in enumerate(self._slots):
+            if slot_peer is None:
+                self._slots[slot] = peer
+                self._slot_of[peer] = slot
+                self.update(peer)
+                return
+
+    def remove(self, peer: Peer):
+        """ピアを索引から取り除きます"""
+        slot = self._slot_of.pop(peer, None)
+        if slot is None:
+            return
+        self._clear(slot)
+        self._slots[slot] = None
+
+    def update(self, peer: Peer, refresh: bool = False):
+        """
+        ピアの状態 (Choke/UnChoke, Interested) の変化を反映します。
+        BitFieldを受信した場合はrefresh=Trueとし、保有ピースを反映し直します。
+        """
+        slot = self._slot_of.get(peer)
+        if slot is None:
+            return
+        ready = peer.is_unchoked() and peer.am_interested()
+        if self._ready[slot] and (refresh or not ready):
+            self._clear(slot)
+        if ready and not self._ready[slot]:
+            self._masks |= peer.piece_mask().astype(np.uint64) << np.uint64(slot)
+            self._ready[slot] = True
+
+    def add_piece(self, peer: Peer, piece_index: int):
+        """ピアがピースを取得したことを反映します (Have受信時)"""
+        slot = self._slot_of.get(peer)
+        if slot is not None and self._ready[slot]:
+            self._masks[piece_index] |= np.uint64(1 << slot)
+
+    def peers_having(self, piece_index: int) -> List[Peer]:
+        """ピースを持ち、ブロックを要求できるピアを返します"""
+        mask = int(self._masks[piece_index])
+        peers = []
+        while mask:
+            lowest = mask & -mask
+            peers.append(self._slots[lowest.bit_length() - 1])
+            mask ^= lowest
+        return peers
+
+    def _clear(self, slot: int):
+        self._masks &= np.uint64(~(1 << slot) & 0xFFFFFFFFFFFFFFFF)
+        self._ready[slot] = False
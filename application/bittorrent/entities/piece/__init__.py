@@ -1,2 +1,5 @@
 from .block import Block, BLOCK_SIZE, State
-from .piece import Piece
+from .buffer_pool import BufferPool
+from .piece import Piece, PieceHashMismatch
+from .piece_picker import PiecePicker
+from .piece_table import PieceTable
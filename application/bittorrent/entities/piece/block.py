@@ -11,6 +11,8 @@ class State(Enum):
 
 
 class Block:
+    __slots__ = ('state', 'block_size', 'data', 'last_seen')
+
     def __init__(self, state: State = State.FREE, block_size: int = BLOCK_SIZE,
                  data: bytes = b'', last_seen: float = 0):
         self.state: State = state
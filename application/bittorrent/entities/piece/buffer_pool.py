@@ -0,0 +1,57 @@
+from typing import Dict, List, Optional
+
+
+class BufferPool(object):
+    """
+    ピースのデータを受信するためのbytearrayを再利用するプール。
+    確保済みのバッファ (使用中 + 待機中) の合計サイズを budget 以下に抑えます。
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        # 確保済みのバッファの合計サイズ
+        self.allocated = 0
+        # 使用中のバッファの合計サイズ
+        self.in_use = 0
+        # サイズごとの待機中のバッファ
+        self._free: Dict[int, List[bytearray]] = {}
+
+    def acquire(self, size: int) -> Optional[bytearray]:
+        """
+        size バイトのバッファを返します。
+        予算を超える場合はNoneを返すので、呼び出し側は新しいピースの取得を見送ります。
+        """
+        free = self._free.get(size)
+        if free:
+            buffer = free.pop()
+        else:
+            if self.allocated + size > self.budget:
+                self._evict(self.allocated + size - self.budget)
+                if self.allocated + size > self.budget:
+                    return None
+            buffer = bytearray(size)
+            self.allocated += size
+        self.in_use += size
+        return buffer
+
+    def can_acquire(self, size: int) -> bool:
+        """size バイトのバッファを確保できるかどうかを返します"""
+        return bool(self._free.get(size)) or self.in_use + size <= self.budget
+
+    def release(self, buffer: bytearray):
+        """使い終わったバッファをプールに戻します"""
+        self.in_use -= len(buffer)
+        self._free.setdefault(len(buffer), []).append(buffer)
+
+    def detach(self, buffer: bytearray):
+        """使用中のバッファをプールに戻さずに、予算の計算から外します. バッファは呼び出し側が所有し続けます"""
+        self.in_use -= len(buffer)
+        self.allocated -= len(buffer)
+
+    def _evict(self, size: int):
+        """待機中のバッファを size バイト以上破棄します"""
+        for free in self._free.values():
+            while free and size > 0:
+                buffer_size = len(free.pop())
+                self.allocated -= buffer_size
+                size -= buffer_size
@@ -1,98 +1,271 @@
-import math
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Callable, Awaitable
 import hashlib
-import time
 import asyncio
-import aiofiles
 
-from .block import Block, BLOCK_SIZE, State
+from .block import BLOCK_SIZE, State
+from .buffer_pool import BufferPool
 
-PENDING_TIME = 5
+# ブロック受信時にイベントループ上でハッシュする最大のバイト数
+HASH_INLINE_SIZE = 4 * BLOCK_SIZE
+# 順不同で揃ったピースの残りをハッシュするスレッド数. hashlibはハッシュ中にGILを解放する
+HASH_THREADS = 2
+HASH_EXECUTOR = ThreadPoolExecutor(max_workers=HASH_THREADS, thread_name_prefix='piece-hash')
+
+# block_statesに格納するブロックの状態 (State.value)
+FREE = State.FREE.value
+PENDING = State.PENDING.value
+FULL = State.FULL.value
+
+
+class PieceHashMismatch(Exception):
+    pass
 
 
 class Piece(object):
-    def __init__(self, piece_index: int, piece_size: int, piece_hash: str, file_path):
-        self.state = State.FREE
+    """
+    ピースとそのブロックの状態を管理するクラス。
+    ブロックごとのオブジェクトは作らず、状態をbytearrayで保持します。
+    受信したブロックは、最初の要求時にプールから確保したピースサイズのbytearrayに直接書き込みます。
+    SHA-1は先頭から連続して揃ったブロックを受信のたびに計算し、残りはスレッドプールで計算します。
+    """
+    __slots__ = ('piece_index', 'piece_size', 'piece_hash', 'is_full', 'storage', 'disk_writer', 'number_of_blocks',
+                 'block_states', 'buffer', 'buffer_pool', 'completed_blocks', 'hasher',
+                 'hashed_length', 'last_seen', 'on_complete', 'on_failed', 'completion')
 
+    def __init__(self, piece_index: int, piece_size: int, piece_hash: bytes, storage,
+                 buffer_pool: Optional[BufferPool] = None, disk_writer=None):
         self.piece_index = piece_index
         self.piece_size = piece_size
         self.piece_hash = piece_hash
 
         self.is_full: bool = False
-        # pieceが保管されているディレクトリのパス
-        self.file_path = file_path + '/' + str(piece_index)
+        # ピースを読み書きするStorage. disk_writerがある場合、書き込みはそのキューを通す
+        self.storage = storage
+        self.disk_writer = disk_writer
+
+        self.number_of_blocks: int = (piece_size + BLOCK_SIZE - 1) // BLOCK_SIZE
 
-        self.number_of_blocks: int = int(math.ceil(float(piece_size) / BLOCK_SIZE))
+        # ブロックの状態 (FREE/PENDING/FULL). 要求中のブロックのタイムアウトは、要求したピアのタイマーが解放する
+        self.block_states = bytearray(self.number_of_blocks)
+        # ピースのデータ. ブロックを要求し始めるまでは確保しない
+        self.buffer: Optional[bytearray] = None
+        self.buffer_pool = buffer_pool
+        # FULLのブロック数. is_complete()をO(1)で判定する
+        self.completed_blocks = 0
+        # 先頭から hashed_length バイトまでを hasher に入力済み
+        self.hasher = hashlib.sha1()
+        self.hashed_length = 0
 
-        self.blocks: List[Block] = [Block() for _ in range(self.number_of_blocks)]
-        if self.piece_size % BLOCK_SIZE != 0:
-            self.blocks[-1].block_size = self.piece_size % BLOCK_SIZE
+        # 最後にピース単位で要求した時刻
+        self.last_seen = 0.0
 
-        self.last_seen = time.time()
+        # ハッシュの検証に成功した時に呼び出されるコールバック
+        self.on_complete: Optional[Callable[['Piece'], Awaitable]] = None
+        # ハッシュの不一致や書き込みの失敗でピースを初期化した時に、その例外と共に呼び出されるコールバック
+        self.on_failed: Optional[Callable[['Piece', Exception], Awaitable]] = None
+        # ピースの完了を待つ全員で共有するFuture. wait_complete()で初めて待たれた時に生成する
+        self.completion: Optional[asyncio.Future] = None
+
+    def block_size(self, block_index: int) -> int:
+        """ブロックのサイズを返します. 最後のブロックのみ BLOCK_SIZE より小さい場合があります"""
+        return min(BLOCK_SIZE, self.piece_size - block_index * BLOCK_SIZE)
 
     def reset(self):
         """ピースの状態を初期化します"""
         self.is_full = False
-        for block in self.blocks:
-            block.state = State.FREE
-            block.data = b''
+        self.block_states[:] = bytes(self.number_of_blocks)
+        self.completed_blocks = 0
+        self.hasher = hashlib.sha1()
+        self.hashed_length = 0
+        self.last_seen = 0.0
+
+    def is_waited(self) -> bool:
+        """ピースの完了を待っている呼び出し元がいるかどうかを返します"""
+        return self.completion is not None and not self.completion.done()
+
+    async def wait_complete(self):
+        """
+        ピースの検証とディスクへの書き込みが完了するまで待ちます。
+        ハッシュが一致しなかった場合はPieceHashMismatch、書き込みに失敗した場合はOSErrorを送出します。
+        同じピースを待つ全員が1つのFutureを共有し、待っている側がキャンセルされてもFutureはキャンセルされません。
+        """
+        if self.is_full:
+            return
+        if not self.is_waited():
+            self.completion = asyncio.get_running_loop().create_future()
+        await asyncio.shield(self.completion)
+
+    def _resolve(self, exception: Optional[BaseException] = None):
+        """完了を待っている全員を起こします"""
+        if not self.is_waited():
+            return
+        if exception is None:
+            self.completion.set_result(None)
+        else:
+            self.completion.set_exception(exception)
+            # 待っている側が全てキャンセルされていても、未取得の例外として警告しない
+            self.completion.exception()
+
+    def _acquire_buffer(self) -> bool:
+        """ピースのバッファを確保します. プールの予算を超える場合はFalseを返します"""
+        if self.buffer is None:
+            if self.buffer_pool is None:
+                self.buffer = bytearray(self.piece_size)
+            else:
+                self.buffer = self.buffer_pool.acquire(self.piece_size)
+        return self.buffer is not None
+
+    def _release_buffer(self):
+        """ピースのバッファをプールに返却します"""
+        if self.buffer is not None and self.buffer_pool is not None:
+            self.buffer_pool.release(self.buffer)
+        self.buffer = None
+
+    def _detach_buffer(self):
+        """キャッシュに渡したバッファを、プールに返さずに手放します"""
+        if self.buffer is not None and self.buffer_pool is not None:
+            self.buffer_pool.detach(self.buffer)
+        self.buffer = None
 
     def is_complete(self) -> bool:
         """すべてのブロックが完全であるかどうかを確認します"""
-        return all(block.state == State.FULL for block in self.blocks)
+        return self.completed_blocks == self.number_of_blocks
 
     def get_empty_block(self):
-        if self.is_full:
+        if self.is_full or not self._acquire_buffer():
             return None
 
-        for block_index, block in enumerate(self.blocks):
-            if block.state == State.PENDING:
-                if time.time() - block.last_seen > 4:
-                    block.state = State.FREE
-                    block.last_seen = time.time()
-
-            if block.state == State.FREE:
-                self.blocks[block_index].state = State.PENDING
-                self.blocks[block_index].last_seen = time.time()
-                return self.piece_index, block_index * BLOCK_SIZE, block.block_size
+        block_index = self.block_states.find(FREE)
+        if block_index < 0:
+            return None
 
-        return None
+        self.block_states[block_index] = PENDING
+        return self.piece_index, block_index * BLOCK_SIZE, self.block_size(block_index)
 
     def get_missing_block(self) -> int:
         """まだ受信していない最初のブロックのインデックスを返します"""
-        for index, block in enumerate(self.blocks):
-            if block.state == State.FREE:
-                return index
-        return -1  # すべてのブロックが存在する場合
-
-    def update_block_status(self):  # if block is pending for too long : set it free
-        for i, block in enumerate(self.blocks):
-            if block.state == State.PENDING and (time.time() - block.last_seen) > PENDING_TIME:
-                self.blocks[i] = Block()
-
-    def set_block(self, offset: int, data: bytes):
-        """指定されたオフセットに対応するインデックスのブロックにデータを設定します"""
-        block_index = int(offset / BLOCK_SIZE)
-        if self.blocks[block_index].state != State.FULL:
-            self.blocks[block_index].data = data
-            self.blocks[block_index].state = State.FULL
-            if self.is_complete():
-                asyncio.create_task(self._validate_and_save())
-
-    async def get_data(self) -> bytes :
-        """ピースの完全なバイナリデータを返します。Lazy Loadingを使用。"""
+        return self.block_states.find(FREE)  # すべてのブロックが存在する場合は-1
+
+    def get_pending_blocks(self) -> List[tuple]:
+        """要求済みで未受信のブロックを (piece_index, block_offset, block_size) のリストで返します"""
+        pending = []
+        block_index = self.block_states.find(PENDING)
+        while block_index >= 0:
+            pending.append((self.piece_index, block_index * BLOCK_SIZE, self.block_size(block_index)))
+            block_index = self.block_states.find(PENDING, block_index + 1)
+        return pending
+
+    def has_free_block(self) -> bool:
+        """まだ誰にも要求していないブロックがあるかどうかを返します"""
+        return FREE in self.block_states
+
+    def free_block(self, offset: int):
+        """要求中のブロックを未取得の状態に戻します (Requestのタイムアウトやピアの切断時)"""
+        block_index = offset // BLOCK_SIZE
+        if self.block_states[block_index] == PENDING:
+            self.block_states[block_index] = FREE
+
+    def get_block_map(self) -> bytes:
+        """受信済みのブロックをFULL、それ以外をFREEとしたブロックごとの状態を返します (レジュームデータ用)"""
+        return bytes(FULL if state == FULL else FREE for state in self.block_states)
+
+    def get_full_blocks(self) -> List[tuple]:
+        """受信済みのブロックを (block_offset, block_size) のリストで返します"""
+        full = []
+        block_index = self.block_states.find(FULL)
+        while block_index >= 0:
+            full.append((block_index * BLOCK_SIZE, self.block_size(block_index)))
+            block_index = self.block_states.find(FULL, block_index + 1)
+        return full
+
+    def release_blocks(self) -> bytes:
+        """
+        受信済みのブロックを破棄してバッファをプールに返し、破棄する前のブロックの状態を返します。
+        ブロックを要求できるピアがいないピースを手放す時に使います. 受信済みのブロックは先にディスクへ書き込み、
+        restore_blocks()で再開します
+        """
+        block_map = self.get_block_map()
+        self.reset()
+        self._release_buffer()
+        return block_map
+
+    def restore_blocks(self, block_map: bytes, data) -> bool:
+        """
+        レジュームデータのブロックの状態と、ディスクから読み込んだピースのデータから受信済みのブロックを復元します。
+        ハッシュはピースが揃った時に検証されるため、ディスクの内容が壊れていても取得し直されます。
+        """
+        if self.is_full or len(block_map) != self.number_of_blocks or len(data) != self.piece_size:
+            return False
+        if not self._acquire_buffer():
+            return False
+        self.reset()
+        memoryview(self.buffer)[:] = data
+        for block_index, state in enumerate(block_map):
+            if state == FULL:
+                self.block_states[block_index] = FULL
+                self.completed_blocks += 1
+        if self.is_complete():
+            # 全て揃っている場合は受信時と同じように検証する
+            asyncio.create_task(self._validate_and_save())
+        else:
+            self._update_hash()
+        return True
+
+    def set_block(self, offset: int, data: bytes) -> bool:
+        """
+        指定されたオフセットに対応するインデックスのブロックにデータを設定します。
+        要求中のブロックと位置と長さが一致するデータのみ受け付け、受け付けた場合にTrueを返します
+        """
+        if self.is_full or self.buffer is None or offset % BLOCK_SIZE:
+            return False
+        block_index = offset // BLOCK_SIZE
+        if not 0 <= block_index < self.number_of_blocks or self.block_states[block_index] != PENDING \
+                or len(data) != self.block_size(block_index):
+            return False
+        # バッファのオフセットに直接コピーする. dataは受信バッファのmemoryviewでも良い
+        memoryview(self.buffer)[offset:offset + len(data)] = data
+        self.block_states[block_index] = FULL
+        self.completed_blocks += 1
+        self._update_hash()
+        if self.is_complete():
+            asyncio.create_task(self._validate_and_save())
+        return True
+
+    async def get_data(self) -> bytes:
+        """ピースの完全なバイナリデータを返します. キャッシュに無い場合はディスクから読み込みます"""
         if not self.is_full:
             raise ValueError("Piece is not complete.")
+        return await self.storage.read_piece(self.piece_index)
 
-        offset = self.piece_index * self.piece_size
-        async with aiofiles.open(self.file_path, "rb") as file:
-            await file.seek(offset)
-            return await file.read(self.piece_size)
+    def _update_hash(self):
+        """先頭から連続してFULLになっているブロックをハッシュに入力します"""
+        block_index = self.hashed_length // BLOCK_SIZE
+        if block_index >= self.number_of_blocks or self.block_states[block_index] != FULL:
+            return
+        free = self.block_states.find(FREE, block_index)
+        pending = self.block_states.find(PENDING, block_index)
+        end = min(i for i in (free, pending, self.number_of_blocks) if i >= 0)
+        # 穴が埋まって長く連続した場合も、1回に計算する量は HASH_INLINE_SIZE までにする
+        # 計算しきれなかった残りは、ピースが揃った時にスレッドプールで計算する
+        end = min(end * BLOCK_SIZE, self.piece_size, self.hashed_length + HASH_INLINE_SIZE)
+        self.hasher.update(memoryview(self.buffer)[self.hashed_length:end])
+        self.hashed_length = end
 
-    def _validate_piece(self) -> bool:
+    def _finish_hash(self) -> bytes:
+        """まだ入力していない残りをハッシュに入力してダイジェストを返します"""
+        self.hasher.update(memoryview(self.buffer)[self.hashed_length:])
+        self.hashed_length = self.piece_size
+        return self.hasher.digest()
+
+    async def _validate_piece(self) -> bool:
         """ピースが完全であり、ハッシュが一致するかどうかを確認します"""
-        concatenated_data = b''.join([block.data for block in self.blocks])
-        if hashlib.sha1(concatenated_data).digest() == self.piece_hash:
+        if self.hashed_length == self.piece_size:
+            digest = self.hasher.digest()
+        else:
+            # イベントループを止めないように、残りはスレッドで計算する
+            digest = await asyncio.get_running_loop().run_in_executor(HASH_EXECUTOR, self._finish_hash)
+        if digest == self.piece_hash:
             self.is_full = True
             return True
         self.reset()  # ピースのハッシュが一致しない場合はリセットします
@@ -100,17 +273,42 @@ class Piece(object):
 
     async def _validate_and_save(self):
         """ピースが完了したら、ハッシュを検証して、ディスクに保存します"""
-        if self._validate_piece():
+        if not await self._validate_piece():
+            error = PieceHashMismatch(f"piece {self.piece_index}")
+            self._resolve(error)
+            # 全てのブロックが未取得に戻ったので、取得し直すように知らせる
+            if self.on_failed:
+                await self.on_failed(self, error)
+            return
+        # 検証済みのピースは書き込みを待たずにキャッシュから読めるようにする.
+        # キャッシュはバッファをコピーせずに保持するので、バッファはプールに返さない
+        cached = self.storage.cache_piece(self.piece_index, self.buffer)
+        try:
             await self._write_to_disk()
-            for block in self.blocks:
-                block.data = b''  # メモリを解放するためにデータをクリア
+        except OSError as e:
+            # 書き込めなかったピースは取得し直す. タスクの例外は誰も受け取らないので、on_failedで知らせる
+            self.reset()
+            self.storage.uncache_piece(self.piece_index)
+            self._resolve(e)
+            if self.on_failed:
+                await self.on_failed(self, e)
+            return
+        finally:
+            # 書き込みが終わったらバッファを手放す
+            if cached:
+                self._detach_buffer()
+            else:
+                self._release_buffer()
+        # ディスクに保存してから完了を通知する. 解放したバッファで次のピースを開始できる
+        self._resolve()
+        if self.on_complete:
+            await self.on_complete(self)
 
     async def _write_to_disk(self):
-        """ピースのデータを指定されたファイルパスに保存します。"""
-        if not self.is_full :
+        """ピースのデータをStorageを通してファイルに保存します"""
+        if not self.is_full:
             raise ValueError("Piece is not complete.")
-
-        async with aiofiles.open(self.file_path, "r+b") as file :
-            offset = self.piece_index * self.piece_size
-            await file.seek(offset)
-            await file.write(self.get_data())
+        if self.disk_writer is not None:
+            await self.disk_writer.write(self.piece_index, self.buffer)
+        else:
+            await self.storage.write_piece(self.piece_index, self.buffer)
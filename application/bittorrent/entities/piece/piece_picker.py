@@ -0,0 +1,79 @@
+from typing import Optional
+import random
+
+import numpy as np
+
+
+class PiecePicker(object):
+    """
+    レアなピースから順にダウンロードするためのピースピッカー。
+    ピースごとの保有ピア数 (availability) を BitField/Have/ピアの切断に応じて差分で更新し、
+    ダウンロード対象のピースをBitFieldメッセージと同じ並びでパックしたビット列で管理します。
+    ピースを選ぶ時は、ピアのビットフィールドとの積から候補を求め、その中で保有ピア数が最も少ないものをNumPyでまとめて探します。
+    """
+    def __init__(self, number_of_pieces: int):
+        self.number_of_pieces = number_of_pieces
+        # ピースを保有しているピアの数
+        self.availability = np.zeros(number_of_pieces, dtype=np.int32)
+        # ダウンロード対象で、まだ要求を開始していないピース (MSBが先頭のピースになるようにパックしたuint8配列)
+        self._wanted = np.zeros((number_of_pieces + 7) // 8, dtype=np.uint8)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, piece_index: int):
+        return bool(self._wanted[piece_index >> 3] & (0x80 >> (piece_index & 7)))
+
+    def want_all(self, piece_mask: np.ndarray):
+        """0/1の配列で指定したピースをまとめてダウンロード対象に加えます"""
+        self._wanted |= np.packbits(piece_mask[:self.number_of_pieces].astype(np.bool_))
+        self._count = int(np.unpackbits(self._wanted).sum())
+
+    def want(self, piece_index: int):
+        """ピースをダウンロード対象に加えます (手放したピースを戻す時)"""
+        if piece_index in self:
+            return
+        self._wanted[piece_index >> 3] |= 0x80 >> (piece_index & 7)
+        self._count += 1
+
+    def discard(self, piece_index: int):
+        """ピースをダウンロード対象から外します (要求を開始した、または取得済みの場合)"""
+        if piece_index not in self:
+            return
+        self._wanted[piece_index >> 3] &= ~(0x80 >> (piece_index & 7)) & 0xff
+        self._count -= 1
+
+    def add_peer(self, piece_mask: np.ndarray):
+        """ピアが保有するピース (0/1の配列) の保有ピア数を増やします (BitField受信時)"""
+        self.availability += piece_mask
+
+    def remove_peer(self, piece_mask: np.ndarray):
+        """ピアが保有していたピース (0/1の配列) の保有ピア数を減らします (ピアの切断時)"""
+        self.availability -= piece_mask
+        np.maximum(self.availability, 0, out=self.availability)
+
+    def increment(self, piece_index: int):
+        """ピースの保有ピア数を1増やします (Have受信時)"""
+        self.availability[piece_index] += 1
+
+    def pick_piece(self, peer_bit_field: np.ndarray, max_availability: Optional[int] = None) -> Optional[int]:
+        """
+        ピアのビットフィールド (パックしたuint8配列) に含まれるピースのうち、保有ピア数が最も少ないものを選んで
+        ダウンロード対象から外し、返します。同じ保有ピア数のピースからは無作為に選びます。
+        max_availabilityを指定した場合は、保有ピア数がそれ以下のピースに限ります。
+        該当するピースが無い場合はNoneを返します。
+        """
+        candidates = self._wanted & peer_bit_field
+        if not candidates.any():
+            return None
+        # 候補以外の保有ピア数を最大値にして、最も少ない保有ピア数のピースを求める
+        mask = np.unpackbits(candidates, count=self.number_of_pieces).view(np.bool_)
+        counts = np.where(mask, self.availability, np.iinfo(np.int32).max)
+        least = counts.min()
+        if max_availability is not None and least > max_availability:
+            return None
+        rarest = np.flatnonzero(counts == least)
+        piece_index = int(rarest[random.randrange(len(rarest))])
+        self.discard(piece_index)
+        return piece_index
@@ -0,0 +1,42 @@
+from typing import Callable, Dict, Iterator
+
+from .piece import Piece
+
+
+class PieceTable(object):
+    """
+    ピースのインデックスからPieceを引くテーブル。
+    Pieceは初めて参照された時に生成し、取得が完了したものは解放できるため、
+    メモリ使用量はトレント全体ではなく処理中のピース数に比例します。
+    """
+    __slots__ = ('_factory', '_pieces', '_length')
+
+    def __init__(self, length: int, factory: Callable[[int], Piece]):
+        self._length = length
+        self._factory = factory
+        self._pieces: Dict[int, Piece] = {}
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, piece_index: int) -> Piece:
+        piece = self._pieces.get(piece_index)
+        if piece is None:
+            if not 0 <= piece_index < self._length:
+                raise IndexError('piece index out of range')
+            piece = self._factory(piece_index)
+            self._pieces[piece_index] = piece
+        return piece
+
+    def __iter__(self) -> Iterator[Piece]:
+        # 全てのピースを生成するため、大きなトレントでは避けること
+        for piece_index in range(self._length):
+            yield self[piece_index]
+
+    def active(self) -> Iterator[Piece]:
+        """生成済みのピースを返します"""
+        return iter(list(self._pieces.values()))
+
+    def release(self, piece_index: int):
+        """生成済みのピースを解放します. 次に参照された時に再び生成されます"""
+        self._pieces.pop(piece_index, None)
@@ -0,0 +1,7 @@
+from .file_cache import FileCache
+from .piece_cache import PieceCache, PIECE_CACHE
+from .storage import Storage, StorageFile, InvalidPathException
+from .disk_writer import DiskWriter, FsyncPolicy
+from .content_cache import ContentCache
+from .resume_data import ResumeData, RESUME_SAVE_INTERVAL
+from .recheck import Recheck
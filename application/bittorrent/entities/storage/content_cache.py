@@ -0,0 +1,221 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from ..torrent import Torrent
+from .recheck import Recheck
+from .storage import Storage
+
+# キャッシュディレクトリに保存するピースの合計サイズの上限 (バイト)
+CONTENT_CACHE_SIZE = 10 * 2 ** 30
+INDEX_FILE_NAME = 'index.sqlite3'
+
+
+class ContentCache(object):
+    """
+    Proxyが取得したピースを保存する永続的なキャッシュディレクトリ。
+    ピースは root_path/<info_hash_hex>/<piece_index> に1ファイルずつ保存し、どのピースがあるかをSQLiteの索引に記録します。
+    合計サイズが max_size を超えると、最も長く参照されていないピースから削除します。
+    再起動後は索引から復元し、load()でハッシュを検証したピースのみを利用します。
+    """
+
+    def __init__(self, root_path: str, max_size: int = CONTENT_CACHE_SIZE):
+        self.root_path = root_path
+        self.max_size = max_size
+        os.makedirs(root_path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # 索引への書き込みを直列化する. 書き込み中もadd()やtouch()を待たせないよう、_lockとは分ける
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root_path, INDEX_FILE_NAME), check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS pieces ('
+                         'info_hash TEXT NOT NULL, piece_index INTEGER NOT NULL, size INTEGER NOT NULL, '
+                         'last_access REAL NOT NULL, PRIMARY KEY (info_hash, piece_index))')
+        self._db.commit()
+
+        # (info_hash_hex, piece_index) -> size. 参照された順に並べる
+        self._pieces: 'OrderedDict[Tuple[str, int], int]' = OrderedDict()
+        for info_hash, piece_index, size in self._db.execute(
+                'SELECT info_hash, piece_index, size FROM pieces ORDER BY last_access'):
+            self._pieces[(info_hash, piece_index)] = size
+        self.size = sum(self._pieces.values())
+        # まだ索引に書き込んでいない参照時刻、追加 (size, 追加時刻)、削除
+        self._accessed: Dict[Tuple[str, int], float] = {}
+        self._added: Dict[Tuple[str, int], Tuple[int, float]] = {}
+        self._deleted: Set[Tuple[str, int]] = set()
+        # ピースを削除した時に呼び出すコールバック: info_hash_hex -> callback(piece_index)
+        self._listeners: Dict[str, Callable[[int], None]] = {}
+        self._storages: Dict[str, Storage] = {}
+
+        self.evictions = 0
+
+    def storage(self, torrent: Torrent) -> Storage:
+        """トレントのピースを1ピース1ファイルで保存するStorageを返します"""
+        info_hash_hex = torrent.info_hash_hex
+        if info_hash_hex not in self._storages:
+            piece_length = torrent.info.piece_length
+            total_length = sum(length for _, length in Storage.torrent_files(torrent))
+            files = []
+            for piece_index in range((total_length + piece_length - 1) // piece_length):
+                files.append(([info_hash_hex, str(piece_index)],
+                              min(piece_length, total_length - piece_index * piece_length)))
+            self._storages[info_hash_hex] = Storage(self.root_path, files, piece_length, preallocate=False,
+                                                    info_hash=torrent.info_hash)
+        return self._storages[info_hash_hex]
+
+    def load(self, torrent: Torrent, on_evict: Callable[[int], None] = None,
+             trusted: Optional[np.ndarray] = None) -> List[int]:
+        """
+        索引にあるトレントのピースをハッシュで検証し、有効なピースのインデックスを返します。
+        ファイルが無い、またはハッシュが一致しないピースは索引から削除します。
+        索引に書き込む前に停止した場合に残る、索引に無いピースのファイルもハッシュで検証し、有効なものは索引に加え、それ以外は削除します。
+        trusted (パックしたビットフィールド) に含まれるピースはレジュームデータで変更が無いと分かっているので、サイズのみ確認します。
+        ディスクを読むため、イベントループの外で呼び出してください。
+        """
+        info_hash_hex = torrent.info_hash_hex
+        if on_evict is not None:
+            self._listeners[info_hash_hex] = on_evict
+        storage = self.storage(torrent)
+
+        with self._lock:
+            indexed = [piece_index for (info_hash, piece_index) in self._pieces if info_hash == info_hash_hex]
+        unindexed = self._unindexed_files(info_hash_hex, set(indexed))
+
+        # サイズが正しいピースのうち、trustedに含まれないものと索引に無いものはハッシュを並列に検証する
+        sized = []
+        candidates = np.zeros(len(storage.files), dtype=bool)
+        for piece_index in indexed + sorted(unindexed):
+            try:
+                if piece_index < len(storage.files) and \
+                        os.path.getsize(storage.files[piece_index].path) == storage.piece_size(piece_index):
+                    sized.append(piece_index)
+                    if piece_index in unindexed or trusted is None or \
+                            not trusted[piece_index >> 3] & (0x80 >> (piece_index & 7)):
+                        candidates[piece_index] = True
+            except OSError:
+                pass
+        hashed = np.unpackbits(Recheck(storage, torrent.info.pieces).check(candidates), count=len(storage.files))
+
+        valid = [piece_index for piece_index in sized if not candidates[piece_index] or hashed[piece_index]]
+        invalid = [(info_hash_hex, piece_index) for piece_index in (set(indexed) | unindexed) - set(valid)]
+        now = time.time()
+        with self._lock:
+            for key in invalid:
+                self._forget(key)
+            for piece_index in unindexed.intersection(valid):
+                key = (info_hash_hex, piece_index)
+                size = storage.piece_size(piece_index)
+                self._pieces[key] = size
+                self.size += size
+                self._added[key] = (size, now)
+        self.delete(invalid)
+        self.flush()
+        return sorted(valid)
+
+    def _unindexed_files(self, info_hash_hex: str, indexed: Set[int]) -> Set[int]:
+        """トレントのディレクトリにある、索引に無いピースのファイルのインデックスを返します"""
+        try:
+            names = os.listdir(os.path.join(self.root_path, info_hash_hex))
+        except FileNotFoundError:
+            return set()
+        return {int(name) for name in names if name.isdigit()} - indexed
+
+    def add(self, info_hash_hex: str, piece_index: int, size: int) -> List[Tuple[str, int]]:
+        """
+        保存したピースを索引に追加し、上限を超えた分を古いものから取り除いて、その (info_hash_hex, piece_index) を返します。
+        ピースの完了ごとにイベントループから呼び出されるので、ここではメモリ上の索引だけを更新します。
+        索引への書き込みはflush()でまとめて行い、取り除いたピースのファイルはdelete()をスレッドで呼び出して削除してください。
+        """
+        key = (info_hash_hex, piece_index)
+        evicted = []
+        with self._lock:
+            old = self._pieces.pop(key, None)
+            if old is not None:
+                self.size -= old
+            self._pieces[key] = size
+            self.size += size
+            self._added[key] = (size, time.time())
+            self._accessed.pop(key, None)
+            self._deleted.discard(key)
+
+            while self.size > self.max_size:
+                victim = next(iter(self._pieces))
+                if victim == key:
+                    break  # 追加したピース自身は残す
+                self._forget(victim)
+                evicted.append(victim)
+        self.evictions += len(evicted)
+
+        for victim_hash, victim_index in evicted:
+            storage = self._storages.get(victim_hash)
+            if storage is not None:
+                storage.uncache_piece(victim_index)
+            listener = self._listeners.get(victim_hash)
+            if listener is not None:
+                listener(victim_index)
+        return evicted
+
+    def delete(self, keys: Iterable[Tuple[str, int]]):
+        """add()で取り除いたピースのファイルを削除します. ディスクを操作するため、イベントループの外で呼び出してください"""
+        for info_hash_hex, piece_index in keys:
+            with self._lock:
+                if (info_hash_hex, piece_index) in self._pieces:
+                    continue  # 削除するまでの間に再び追加された
+            path = os.path.join(self.root_path, info_hash_hex, str(piece_index))
+            storage = self._storages.get(info_hash_hex)
+            if storage is not None:
+                storage.file_cache.discard(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def touch(self, info_hash_hex: str, piece_index: int):
+        """ピースが参照されたことを記録します. 索引への書き込みはflush()でまとめて行います"""
+        key = (info_hash_hex, piece_index)
+        with self._lock:
+            if key in self._pieces:
+                self._pieces.move_to_end(key)
+                self._accessed[key] = time.time()
+
+    def __contains__(self, key: Tuple[str, int]) -> bool:
+        return key in self._pieces
+
+    def flush(self):
+        """追加・削除・参照時刻をまとめて索引に書き込みます. ディスクに書き込むため、実行中はイベントループの外で呼び出してください"""
+        with self._db_lock:
+            with self._lock:
+                deleted, self._deleted = self._deleted, set()
+                added, self._added = self._added, {}
+                accessed, self._accessed = self._accessed, {}
+            if deleted:
+                self._db.executemany('DELETE FROM pieces WHERE info_hash = ? AND piece_index = ?', deleted)
+            if added:
+                self._db.executemany('INSERT OR REPLACE INTO pieces VALUES (?, ?, ?, ?)',
+                                     [(h, i, size, t) for (h, i), (size, t) in added.items()])
+            if accessed:
+                self._db.executemany('UPDATE pieces SET last_access = ? WHERE info_hash = ? AND piece_index = ?',
+                                     [(t, h, i) for (h, i), t in accessed.items()])
+            self._db.commit()
+
+    def close(self):
+        self.flush()
+        for storage in self._storages.values():
+            storage.close()
+        with self._db_lock:
+            self._db.close()
+
+    def _forget(self, key: Tuple[str, int]):
+        """ピースをメモリ上の索引から取り除きます. 索引からの削除はflush()で行います. _lockを保持して呼び出してください"""
+        size = self._pieces.pop(key, None)
+        if size is None:
+            return
+        self.size -= size
+        self._accessed.pop(key, None)
+        self._added.pop(key, None)
+        self._deleted.add(key)
@@ -0,0 +1,130 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+from .storage import Storage
+
+# 書き込み待ちのデータの上限 (バイト). これを超えるとピースの要求を止める
+WRITE_QUEUE_SIZE = 32 * 2 ** 20
+# 書き込みを行うスレッド数
+WRITER_THREADS = 2
+# 1回の書き込みにまとめる連続したピースの最大数
+MAX_COALESCED_PIECES = 16
+
+
+class FsyncPolicy(Enum):
+    NONE = 0  # OSに任せる
+    EVERY_WRITE = 1  # 書き込みのたびにfsyncする
+    ON_CLOSE = 2  # 終了時にまとめてfsyncする
+
+
+class DiskWriter(object):
+    """
+    ピースの書き込みを受け付けるキュー。
+    固定数のスレッドで書き込み、キューに溜まった連続するピースは1回のpwritevにまとめます。
+    書き込み待ちのデータが上限を超えている間、is_full()がTrueになり、write()は空きができるまで待ちます。
+    """
+
+    def __init__(self, storage: Storage, max_queued_bytes: int = WRITE_QUEUE_SIZE,
+                 threads: int = WRITER_THREADS, fsync_policy: FsyncPolicy = FsyncPolicy.NONE):
+        self.storage = storage
+        self.max_queued_bytes = max_queued_bytes
+        self.threads = threads
+        self.fsync_policy = fsync_policy
+
+        # 書き込み待ちのピース: piece_index -> (data, 完了を通知するFuture)
+        self._pending: Dict[int, Tuple[object, asyncio.Future]] = {}
+        # 書き込み待ちと書き込み中のデータの合計サイズ
+        self.queued_bytes = 0
+        self._changed: Optional[asyncio.Condition] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._workers: List[asyncio.Task] = []
+
+        # 統計: 書き込んだピース数と書き込み回数
+        self.written_pieces = 0
+        self.write_count = 0
+
+    def is_full(self) -> bool:
+        return self.queued_bytes >= self.max_queued_bytes
+
+    async def write(self, piece_index: int, data):
+        """ピースのデータをキューに入れ、ファイルに書き込まれるまで待ちます"""
+        self._start()
+        async with self._changed:
+            # 書き込み中のデータも含めて1つも溜まっていない場合は、上限より大きいピースでも受け付ける
+            while self.queued_bytes and self.queued_bytes + len(data) > self.max_queued_bytes:
+                await self._changed.wait()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[piece_index] = (data, future)
+            self.queued_bytes += len(data)
+            self._changed.notify_all()
+        await future
+
+    async def close(self):
+        """書き込み待ちのピースを全て書き込んでからスレッドを停止します"""
+        if self._changed is not None:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.queued_bytes == 0)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._executor is not None:
+            if self.fsync_policy == FsyncPolicy.ON_CLOSE:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self.storage.sync)
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _start(self):
+        """最初の書き込み時にスレッドとワーカーを起動します"""
+        if self._executor is not None:
+            return
+        self._changed = asyncio.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='disk-writer')
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.threads)]
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._pending)
+                piece_indexes, buffers, futures = self._take_batch()
+
+            try:
+                await loop.run_in_executor(self._executor, self._write_batch, piece_indexes[0], buffers)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in futures:
+                    if not future.done():
+                        future.set_result(None)
+
+            async with self._changed:
+                self.queued_bytes -= sum(len(buffer) for buffer in buffers)
+                self.written_pieces += len(piece_indexes)
+                self.write_count += 1
+                self._changed.notify_all()
+
+    def _take_batch(self) -> Tuple[List[int], List, List[asyncio.Future]]:
+        """インデックスが最も小さいピースと、それに続く連続したピースを取り出します"""
+        piece_index = min(self._pending)
+        piece_indexes, buffers, futures = [], [], []
+        while piece_index in self._pending and len(piece_indexes) < MAX_COALESCED_PIECES:
+            data, future = self._pending.pop(piece_index)
+            piece_indexes.append(piece_index)
+            buffers.append(data)
+            futures.append(future)
+            # 最後のピース以外はpiece_lengthの長さなので、次のピースはそのまま続く
+            if len(data) != self.storage.piece_length:
+                break
+            piece_index += 1
+        return piece_indexes, buffers, futures
+
+    def _write_batch(self, piece_index: int, buffers: List):
+        """スレッドで実行され、連続したピースをまとめて書き込みます"""
+        self.storage.writev(piece_index * self.storage.piece_length, buffers)
+        if self.fsync_policy == FsyncPolicy.EVERY_WRITE:
+            self.storage.sync()
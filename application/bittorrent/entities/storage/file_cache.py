@@ -0,0 +1,110 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator
+
+# 同時に開いておくファイルディスクリプタの上限
+MAX_OPEN_FILES = 64
+
+
+class FileCache(object):
+    """
+    開いたファイルディスクリプタを保持するLRUキャッシュ。
+    複数のスレッドから使われるため、使用中のディスクリプタは追い出さずに上限を一時的に超えることを許します。
+    書き込みのために初めて開いたファイルのon_create (事前割り当てなど) はロックの外で呼び出し、
+    他のファイルの読み書きを止めません。同じファイルを開く他のスレッドは、on_createが終わるまで待ちます。
+    """
+
+    def __init__(self, max_open_files: int = MAX_OPEN_FILES, on_create: Callable[[str, int], None] = None):
+        self.max_open_files = max_open_files
+        # ファイルを初めて開いた時に呼び出される (事前割り当てなど)
+        self.on_create = on_create
+        self._lock = threading.Lock()
+        self._fds: 'OrderedDict[str, int]' = OrderedDict()
+        self._users: Dict[str, int] = {}
+        self._created = set()
+        # on_createを実行中のファイル: path -> 終了を通知するEvent
+        self._preparing: Dict[str, threading.Event] = {}
+        # 使用中に破棄されたため、使い終わった時に閉じるディスクリプタ
+        self._discarded: Dict[str, int] = {}
+
+    @contextmanager
+    def open(self, path: str, create: bool = True) -> Iterator[int]:
+        """
+        pathのファイルディスクリプタを返します. withブロックの間は閉じられません。
+        createがFalseの場合はファイルを作成せず、無ければFileNotFoundErrorを送出します
+        """
+        with self._lock:
+            fd = self._fds.get(path)
+            if fd is None:
+                fd = self._open(path, create)
+                self._fds[path] = fd
+            self._fds.move_to_end(path)
+            self._users[path] = self._users.get(path, 0) + 1
+            self._evict()
+            prepare = create and path not in self._created
+            if prepare:
+                self._created.add(path)
+                preparing = self._preparing[path] = threading.Event()
+            else:
+                preparing = self._preparing.get(path)
+        try:
+            if prepare:
+                try:
+                    if self.on_create:
+                        self.on_create(path, fd)
+                finally:
+                    with self._lock:
+                        del self._preparing[path]
+                    preparing.set()
+            elif preparing is not None:
+                preparing.wait()
+            yield fd
+        finally:
+            with self._lock:
+                self._users[path] -= 1
+                if not self._users[path]:
+                    del self._users[path]
+                    if path in self._discarded:
+                        os.close(self._discarded.pop(path))
+                self._evict()
+
+    def discard(self, path: str):
+        """pathのディスクリプタを閉じます (ファイルを削除する前に呼び出す)"""
+        with self._lock:
+            self._created.discard(path)
+            fd = self._fds.pop(path, None)
+            if fd is None:
+                return
+            if path in self._users:
+                self._discarded[path] = fd
+            else:
+                os.close(fd)
+
+    def close(self):
+        """使用中でない全てのファイルディスクリプタを閉じます"""
+        with self._lock:
+            for path in list(self._fds):
+                if path not in self._users:
+                    os.close(self._fds.pop(path))
+
+    def __len__(self):
+        return len(self._fds)
+
+    @staticmethod
+    def _open(path: str, create: bool) -> int:
+        if not create:
+            return os.open(path, os.O_RDWR)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def _evict(self):
+        """上限を超えた分を、使用中でないものから古い順に閉じます"""
+        if len(self._fds) <= self.max_open_files:
+            return
+        for path in list(self._fds):
+            if len(self._fds) <= self.max_open_files:
+                break
+            if path not in self._users:
+                os.close(self._fds.pop(path))
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+# プロセス全体で検証済みのピースをメモリに保持する上限 (バイト)
+PIECE_CACHE_SIZE = 128 * 2 ** 20
+
+
+class PieceCache(object):
+    """
+    検証済みのピースのデータを (info_hash, piece_index) をキーに保持するLRUキャッシュ。
+    合計サイズが budget を超えると、最も長く参照されていないピースから破棄します。
+    Ceforeのスレッドからも参照されるため、操作はロックで保護します。
+    """
+
+    def __init__(self, budget: int = PIECE_CACHE_SIZE):
+        self.budget = budget
+        self.size = 0
+        self._lock = threading.Lock()
+        self._pieces: 'OrderedDict[Hashable, bytes]' = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            data = self._pieces.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._pieces.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: Hashable, data: bytes) -> bool:
+        """dataを保持してTrueを返します. budgetより大きいデータは保持せずにFalseを返します"""
+        if len(data) > self.budget:
+            return False
+        with self._lock:
+            old = self._pieces.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._pieces[key] = data
+            self.size += len(data)
+            while self.size > self.budget:
+                _, evicted = self._pieces.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return True
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            data = self._pieces.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'pieces': len(self._pieces),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._pieces)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._pieces
+
+
+# 全てのトレントで共有するキャッシュ
+PIECE_CACHE = PieceCache()
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from .storage import Storage
+
+# ハッシュを計算するスレッド数. hashlibはハッシュ中にGILを解放するため、コア数まで並列に計算できる
+RECHECK_THREADS = os.cpu_count() or 1
+# 1つのタスクで検証するピース数
+RECHECK_BATCH_SIZE = 64
+
+
+class Recheck(object):
+    """
+    ディスク上のファイルをトレントのピースのハッシュと照合し、取得済みのピースのビットフィールドを作るクラス。
+    ピースのまとまりごとに、そのピースがかかるファイルをmmapし、スレッドプールで並列にハッシュを計算します。
+    """
+
+    def __init__(self, storage: Storage, piece_hashes: bytes, threads: int = RECHECK_THREADS):
+        self.storage = storage
+        self.piece_hashes = piece_hashes
+        self.threads = threads
+        self.number_of_pieces = (storage.total_length + storage.piece_length - 1) // storage.piece_length
+
+        # 進捗: 検証したピース数と、検証するピース数
+        self.checked = 0
+        self.total = 0
+
+    def check(self, candidates: Optional[np.ndarray] = None,
+              on_progress: Callable[[int, int], None] = None) -> np.ndarray:
+        """
+        candidates (ピースごとのbool配列. 省略時は全て) のピースを検証し、
+        ハッシュが一致したピースのビットフィールド (パックしたuint8配列) を返します
+        """
+        valid = np.zeros(self.number_of_pieces, dtype=bool)
+        batches = self._batches(candidates)
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='recheck') as executor:
+            for batch, ok in zip(batches, executor.map(self._check_batch, batches)):
+                valid[batch[ok]] = True
+                self._progress(len(batch), on_progress)
+        return np.packbits(valid)
+
+    async def run(self, candidates: Optional[np.ndarray] = None,
+                  on_progress: Callable[[int, int], None] = None) -> np.ndarray:
+        """check()をイベントループから使うための版. on_progressはイベントループ上で呼び出されます"""
+        loop = asyncio.get_running_loop()
+        valid = np.zeros(self.number_of_pieces, dtype=bool)
+        batches = self._batches(candidates)
+        executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='recheck')
+        try:
+            futures = [loop.run_in_executor(executor, self._check_batch, batch) for batch in batches]
+            for batch, future in zip(batches, futures):
+                ok = await future
+                valid[batch[ok]] = True
+                self._progress(len(batch), on_progress)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return np.packbits(valid)
+
+    def _batches(self, candidates: Optional[np.ndarray]) -> List[np.ndarray]:
+        if candidates is None:
+            indexes = np.arange(self.number_of_pieces)
+        else:
+            indexes = np.flatnonzero(candidates[:self.number_of_pieces])
+        self.checked = 0
+        self.total = len(indexes)
+        return [indexes[i:i + RECHECK_BATCH_SIZE] for i in range(0, len(indexes), RECHECK_BATCH_SIZE)]
+
+    def _progress(self, checked: int, on_progress: Optional[Callable[[int, int], None]]):
+        self.checked += checked
+        if on_progress is not None:
+            on_progress(self.checked, self.total)
+
+    def _check_batch(self, batch: np.ndarray) -> np.ndarray:
+        """スレッドで実行され、batchのピースのうちハッシュが一致したものをbool配列で返します"""
+        ok = np.zeros(len(batch), dtype=bool)
+        piece_length = self.storage.piece_length
+        # このバッチで開いたファイル. ファイルが無い場合はNone
+        maps: Dict[str, Optional[mmap.mmap]] = {}
+        try:
+            for i, piece_index in enumerate(batch.tolist()):
+                hasher = hashlib.sha1()
+                for file, file_offset, length in self.storage.segments(piece_index * piece_length,
+                                                                       self.storage.piece_size(piece_index)):
+                    if file.path not in maps:
+                        maps[file.path] = self._map(file.path)
+                    data = maps[file.path]
+                    # ファイルが無いか短い場合は、mmapの範囲外を読まずに不一致とする
+                    if data is None or file_offset + length > len(data):
+                        break
+                    with memoryview(data) as view:
+                        hasher.update(view[file_offset:file_offset + length])
+                else:
+                    ok[i] = hasher.digest() == self.piece_hashes[piece_index * 20:(piece_index + 1) * 20]
+        finally:
+            for data in maps.values():
+                if data is not None:
+                    data.close()
+        return ok
+
+    @staticmethod
+    def _map(path: str) -> Optional[mmap.mmap]:
+        """ファイルを読み込み専用でmmapします. 無いか空の場合はNoneを返します"""
+        try:
+            with open(path, 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return None
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        return data
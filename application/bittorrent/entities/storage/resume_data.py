@@ -0,0 +1,99 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .storage import Storage
+
+# レジュームデータを保存するディレクトリ名 (ダウンロード先のディレクトリ直下)
+RESUME_DIR_NAME = '.resume'
+# ダウンロード中にレジュームデータを保存する間隔 (秒)
+RESUME_SAVE_INTERVAL = 60
+
+
+class ResumeData(object):
+    """
+    再起動時にハッシュを再計算せずに取得済みのピースを復元するためのデータ。
+    取得済みピースのビットフィールドと、保存時の各ファイルのサイズと更新時刻、途中まで受信したピースのブロックの状態を持ちます。
+    読み込み時にサイズか更新時刻が変わっているファイルにかかるピースは信用しません。
+    """
+
+    def __init__(self, info_hash_hex: str, bit_field: bytes, file_stats: List[Tuple[int, int]],
+                 partial_pieces: Dict[int, bytes]):
+        self.info_hash_hex = info_hash_hex
+        self.bit_field = bit_field
+        # Storage.filesと同じ順の (サイズ, 更新時刻[ns]). ファイルが無い場合は (-1, -1)
+        self.file_stats = file_stats
+        # piece_index -> ブロックごとの状態 (受信済みはFULL)
+        self.partial_pieces = partial_pieces
+
+    @staticmethod
+    def path_for(root_path: str, info_hash_hex: str) -> str:
+        return os.path.join(root_path, RESUME_DIR_NAME, info_hash_hex + '.resume')
+
+    @classmethod
+    def capture(cls, storage: Storage, info_hash_hex: str, bit_field: bytes,
+                partial_pieces: Dict[int, bytes]) -> 'ResumeData':
+        """現在のファイルの状態を記録したResumeDataを作成します. ファイルをstatするのでスレッドで呼び出してください"""
+        return cls(info_hash_hex, bit_field, [cls._stat(file.path) for file in storage.files], partial_pieces)
+
+    def save(self, path: str):
+        """一時ファイルに書いてから置き換えるので、途中で停止しても古いデータが残ります"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {
+            'info_hash': self.info_hash_hex,
+            'pieces': self.bit_field.hex(),
+            'files': self.file_stats,
+            'partial': {str(piece_index): states.hex() for piece_index, states in self.partial_pieces.items()},
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['ResumeData']:
+        """レジュームデータを読み込みます. 無いか壊れている場合はNoneを返します"""
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            return cls(data['info_hash'], bytes.fromhex(data['pieces']),
+                       [tuple(stat) for stat in data['files']],
+                       {int(piece_index): bytes.fromhex(states) for piece_index, states in data['partial'].items()})
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def valid_pieces(self, storage: Storage,
+                     number_of_pieces: int) -> Tuple[np.ndarray, Dict[int, bytes], np.ndarray]:
+        """
+        変更されていないファイルだけにかかる取得済みのピースのビットフィールド (パックしたuint8配列) と、
+        途中まで受信したピース、サイズか更新時刻が変わったファイルにかかるピース (bool配列) を返します。
+        変わったピースだけはハッシュを検証し直す必要があります. ファイルをstatするのでスレッドで呼び出してください
+        """
+        size = (number_of_pieces + 7) // 8
+        if len(self.bit_field) != size or len(self.file_stats) != len(storage.files):
+            return np.zeros(size, dtype=np.uint8), {}, np.ones(number_of_pieces, dtype=bool)
+
+        valid = np.unpackbits(np.frombuffer(self.bit_field, dtype=np.uint8), count=number_of_pieces).astype(bool)
+        changed = np.zeros(number_of_pieces, dtype=bool)
+        for file, stat in zip(storage.files, self.file_stats):
+            if file.length > 0 and self._stat(file.path) != tuple(stat):
+                first = file.offset // storage.piece_length
+                last = (file.offset + file.length - 1) // storage.piece_length
+                changed[first:last + 1] = True
+        valid &= ~changed
+
+        partial_pieces = {piece_index: states for piece_index, states in self.partial_pieces.items()
+                          if 0 <= piece_index < number_of_pieces and not changed[piece_index] and not valid[piece_index]}
+        return np.packbits(valid), partial_pieces, changed
+
+    @staticmethod
+    def _stat(path: str) -> Tuple[int, int]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return -1, -1
+        return stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,264 @@
+import asyncio
+import bisect
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ..torrent import Torrent, FileMode
+from .file_cache import FileCache, MAX_OPEN_FILES
+from .piece_cache import PieceCache, PIECE_CACHE
+
+# ファイルを初めて開いた時にディスク領域を確保するかどうか. Falseの場合はスパースファイルにする
+PREALLOCATE_FILES = True
+# ディスクの読み書きを行うスレッド数
+STORAGE_THREADS = 4
+STORAGE_EXECUTOR = ThreadPoolExecutor(max_workers=STORAGE_THREADS, thread_name_prefix='storage')
+
+
+class InvalidPathException(Exception):
+    pass
+
+
+class StorageFile(object):
+    """トレント内の1ファイル. offsetはトレント全体を連結したバイト列での開始位置"""
+    __slots__ = ('path', 'offset', 'length')
+
+    def __init__(self, path: str, offset: int, length: int):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+
+class Storage(object):
+    """
+    トレントの全ファイルを1つの連続したバイト列とみなし、ピースの範囲を実際のファイルに対応付けて読み書きするクラス。
+    os.pwritev/os.preadvで位置を指定して読み書きするため、複数のピースを並行して書き込んでもシーク位置が競合しません。
+    検証済みのピースの読み込みは、(info_hash, piece_index) をキーにPieceCacheを通します。
+    """
+
+    def __init__(self, root_path: str, files: List[Tuple[List[str], int]], piece_length: int,
+                 preallocate: bool = PREALLOCATE_FILES, max_open_files: int = MAX_OPEN_FILES,
+                 info_hash: bytes = b'', piece_cache: Optional[PieceCache] = PIECE_CACHE):
+        self.piece_length = piece_length
+        self.preallocate = preallocate
+        self.info_hash = info_hash
+        self.piece_cache = piece_cache
+
+        self.files: List[StorageFile] = []
+        offset = 0
+        for path, length in files:
+            self.files.append(StorageFile(self._join_path(root_path, path), offset, length))
+            offset += length
+        self.total_length = offset
+        # オフセットからファイルを二分探索するための開始位置のリスト
+        self._offsets = [file.offset for file in self.files]
+        self._lengths = {file.path: file.length for file in self.files}
+
+        self.file_cache = FileCache(max_open_files, on_create=self._prepare_file)
+        # 書き込み後にfsyncしていないファイル
+        self._dirty = set()
+        # どのピースにもかからない長さ0のファイルは、最初の書き込みの時に作成する
+        self._empty_files_created = False
+        # キャッシュに無いピースの読み込み. 同じピースを同時に読む呼び出し元は、このタスクの結果を共有する
+        self._reading: Dict[int, asyncio.Task] = {}
+
+    @classmethod
+    def from_torrent(cls, root_path: str, torrent: Torrent, **kwargs) -> 'Storage':
+        """
+        トレントのメタデータからStorageを作成します。
+        シングルファイルは root_path/name に、複数ファイルは root_path/name/path... に保存します。
+        """
+        return cls(root_path, cls.torrent_files(torrent), torrent.info.piece_length,
+                   info_hash=torrent.info_hash, **kwargs)
+
+    @staticmethod
+    def torrent_files(torrent: Torrent) -> List[Tuple[List[str], int]]:
+        """トレントのファイルを (パスの要素のリスト, サイズ) のリストで返します"""
+        info = torrent.info
+        if torrent.file_mode == FileMode.single_file:
+            return [([info.name], info.length)]
+        files = []
+        for file in info.files:
+            path = [file.path] if isinstance(file.path, str) else list(file.path)
+            files.append(([info.name] + path, file.length))
+        return files
+
+    def piece_size(self, piece_index: int) -> int:
+        return min(self.piece_length, self.total_length - piece_index * self.piece_length)
+
+    def write(self, offset: int, data) -> None:
+        """トレント全体でのoffsetからdataを書き込みます"""
+        self.writev(offset, [data])
+
+    def writev(self, offset: int, buffers: List) -> None:
+        """トレント全体でのoffsetから、buffersを連結したデータをファイルごとに1回のpwritevで書き込みます"""
+        if not self._empty_files_created:
+            self._create_empty_files()
+        views = [memoryview(buffer) for buffer in buffers]
+        view_index = 0
+        position = 0  # views[view_index] の中の位置
+        for file, file_offset, length in self.segments(offset, sum(len(view) for view in views)):
+            # このファイルに書き込む範囲をbuffersから切り出す
+            chunks = []
+            while length > 0:
+                view = views[view_index]
+                size = min(length, len(view) - position)
+                chunks.append(view[position:position + size])
+                length -= size
+                position += size
+                if position == len(view):
+                    view_index += 1
+                    position = 0
+            with self.file_cache.open(file.path) as fd:
+                self._pwritev(fd, chunks, file_offset)
+            self._dirty.add(file.path)
+
+    def sync(self):
+        """書き込み後にまだ同期していないファイルの内容をディスクに同期します"""
+        while self._dirty:
+            path = self._dirty.pop()
+            with self.file_cache.open(path) as fd:
+                os.fsync(fd)
+
+    def read(self, offset: int, length: int) -> bytearray:
+        """
+        トレント全体でのoffsetからlengthバイトを読み込みます。
+        書き込まれていない範囲やまだ無いファイルの範囲は0になります. 読み込みではファイルを作成しません
+        """
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+        position = 0
+        for file, file_offset, segment_length in self.segments(offset, length):
+            try:
+                with self.file_cache.open(file.path, create=False) as fd:
+                    received = 0
+                    while received < segment_length:
+                        size = os.preadv(fd, [view[position + received:position + segment_length]],
+                                         file_offset + received)
+                        if size == 0:
+                            break
+                        received += size
+            except FileNotFoundError:
+                pass
+            position += segment_length
+        return buffer
+
+    async def write_piece(self, piece_index: int, data, offset: int = 0):
+        """ピースのデータをスレッドプールで書き込みます"""
+        await asyncio.get_running_loop().run_in_executor(
+            STORAGE_EXECUTOR, self.write, piece_index * self.piece_length + offset, data)
+
+    async def read_piece(self, piece_index: int, offset: int = 0, length: Optional[int] = None) -> bytes:
+        """
+        検証済みのピースのoffsetからlengthバイト (省略時はピースの最後まで) を返します。
+        キャッシュが無い場合は範囲だけを読み込みます。キャッシュに無い場合はピース全体をスレッドプールで読み込み、
+        キャッシュに入れます。同じピースを同時に要求された場合も、読み込みは1回だけ行います。
+        cache_piece() で入れたピースと、ピースの一部の範囲はコピーせずにmemoryviewで返します。
+        """
+        piece_size = self.piece_size(piece_index)
+        if length is None:
+            length = piece_size - offset
+
+        if self.piece_cache is None:
+            return bytes(await self._read_in_executor(piece_index * self.piece_length + offset, length))
+
+        data = self.piece_cache.get((self.info_hash, piece_index))
+        if data is None:
+            task = self._reading.get(piece_index)
+            if task is None:
+                task = asyncio.ensure_future(self._read_and_cache(piece_index, piece_size))
+                self._reading[piece_index] = task
+                task.add_done_callback(lambda done: self._read_done(piece_index, done))
+            # 待っている呼び出し元がキャンセルされても、他の呼び出し元のために読み込みは続ける
+            data = await asyncio.shield(task)
+        if offset == 0 and length == len(data):
+            return data
+        return memoryview(data)[offset:offset + length]
+
+    def cache_piece(self, piece_index: int, data) -> bool:
+        """
+        検証済みのピースのデータをコピーせずに読み取り専用のmemoryviewとしてキャッシュに入れ、入れた場合にTrueを返します。
+        キャッシュに入れたdataは、呼び出し側で変更しないでください
+        """
+        if self.piece_cache is None:
+            return False
+        return self.piece_cache.put((self.info_hash, piece_index), memoryview(data).toreadonly())
+
+    async def _read_and_cache(self, piece_index: int, piece_size: int) -> bytes:
+        data = bytes(await self._read_in_executor(piece_index * self.piece_length, piece_size))
+        self.piece_cache.put((self.info_hash, piece_index), data)
+        return data
+
+    def _read_done(self, piece_index: int, task: asyncio.Task):
+        self._reading.pop(piece_index, None)
+        # 待っている呼び出し元が全てキャンセルされていても、未取得の例外として警告しない
+        if not task.cancelled():
+            task.exception()
+
+    def uncache_piece(self, piece_index: int):
+        if self.piece_cache is not None:
+            self.piece_cache.discard((self.info_hash, piece_index))
+
+    async def _read_in_executor(self, offset: int, length: int) -> bytearray:
+        return await asyncio.get_running_loop().run_in_executor(STORAGE_EXECUTOR, self.read, offset, length)
+
+    def close(self):
+        self.file_cache.close()
+
+    def segments(self, offset: int, length: int) -> Iterator[Tuple[StorageFile, int, int]]:
+        """範囲 [offset, offset + length) を (ファイル, ファイル内のオフセット, 長さ) に分割します"""
+        if offset < 0 or offset + length > self.total_length:
+            raise ValueError('range is out of the torrent')
+        file_index = bisect.bisect_right(self._offsets, offset) - 1
+        while length > 0:
+            file = self.files[file_index]
+            file_offset = offset - file.offset
+            size = min(length, file.length - file_offset)
+            if size > 0:
+                yield file, file_offset, size
+                offset += size
+                length -= size
+            file_index += 1
+
+    @staticmethod
+    def _pwritev(fd: int, chunks: List[memoryview], offset: int):
+        """chunksを全て書き込むまでpwritevを繰り返します"""
+        while chunks:
+            written = os.pwritev(fd, chunks, offset)
+            offset += written
+            while chunks and written >= len(chunks[0]):
+                written -= len(chunks[0])
+                chunks.pop(0)
+            if written:
+                chunks[0] = chunks[0][written:]
+
+    def _create_empty_files(self):
+        for file in self.files:
+            if file.length == 0 and not os.path.exists(file.path):
+                os.makedirs(os.path.dirname(file.path), exist_ok=True)
+                open(file.path, 'ab').close()
+        self._empty_files_created = True
+
+    def _prepare_file(self, path: str, fd: int):
+        """
+        書き込むためにファイルを初めて開いた時に、トレントで指定されたサイズまで領域を確保します。
+        FileCacheのロックの外で呼び出されるので、ファイルシステムがfallocateを0の書き込みで代替しても他のファイルは止まりません
+        """
+        length = self._lengths[path]
+        if os.fstat(fd).st_size >= length:
+            return
+        if self.preallocate and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, length)
+                return
+            except OSError:
+                pass  # fallocateに対応していないファイルシステムではスパースファイルにする
+        os.ftruncate(fd, length)
+
+    @staticmethod
+    def _join_path(root_path: str, path: List[str]) -> str:
+        """トレント内のパスをroot_path以下のパスに変換します. root_pathの外を指すパスは拒否します"""
+        for component in path:
+            if not component or component in ('.', '..') or '/' in component or '\0' in component:
+                raise InvalidPathException(f'invalid path in torrent: {path}')
+        return os.path.join(root_path, *path)
@@ -5,13 +5,10 @@ import socket
 from urllib.parse import urlparse
 import errno
 
-from .peer import UdpTrackerConnection, UdpTrackerAnnounce, UdpTrackerAnnounceOutput
+from .peer import UdpTrackerConnection, UdpTrackerAnnounce, UdpTrackerAnnounceOutput, LISTEN_PORT, peer_id
 from .torrent import Torrent
 
 
-peer_id = '-AZ2200-6wfG2wk6wWLc'
-
-
 # TODO: 非同期化
 class SockAddr:
     def __init__(self, ip, port, allowed=True):
@@ -80,7 +77,7 @@ class Tracker(object):
             'peer_id': peer_id,
             'uploaded': 0,
             'downloaded': 0,
-            'port': 6881,
+            'port': LISTEN_PORT,
             'left': self.torrent.info.length,
             'event': 'started'
         }
@@ -151,7 +148,7 @@ class Tracker(object):
         tracker_connection_output.from_bytes(response)
 
         tracker_announce_input = UdpTrackerAnnounce(torrent.info_hash, tracker_connection_output.conn_id,
-                                                    torrent.peer_id)
+                                                    torrent.peer_id, LISTEN_PORT)
         response = self.send_message((ip, port), sock, tracker_announce_input)
 
         if not response:
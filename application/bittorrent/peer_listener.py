@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from typing import Optional
+
+from .entities.peer import Handshake, LISTEN_PORT
+from .entities.peer.peer import CONNECT_TIMEOUT
+
+logger = logging.getLogger()
+
+# 全てのトレントを合わせた接続数の上限 (ハンドシェイク中の接続を含む)
+MAX_GLOBAL_CONNECTIONS = 200
+
+
+class PeerListener(object):
+    """
+    リモートのピアからの接続を受け付けるサーバ。
+    ハンドシェイクを受信し、そのinfo_hashで登録されたトレントのCommunicationManagerに接続を振り分けます。
+    全トレント合計の接続数がmax_connectionsに達している場合や、トレントの接続数が上限に達している場合は接続を閉じます。
+    最初のトレントが登録された時に待ち受けを開始し、全てのトレントが登録を解除すると停止します。
+    """
+
+    def __init__(self, host: str = '0.0.0.0', port: int = LISTEN_PORT,
+                 max_connections: int = MAX_GLOBAL_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        # info_hash -> CommunicationManager
+        self.managers = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._handshaking = 0
+
+        # 受け付けた接続数と、閉じた接続数 (統計用)
+        self.accepted = 0
+        self.rejected = 0
+
+    async def register(self, comm_mgr):
+        """トレントへの接続を受け付けるようにします. 待ち受けていなければ開始します"""
+        self.managers[comm_mgr.bittorrent.info_hash] = comm_mgr
+        if self._server is None:
+            try:
+                self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            except OSError as e:
+                # ポートが使えなくても、こちらから接続するピアとは通信できる
+                logger.error(f"cannot listen on {self.host}:{self.port}: {e}")
+                return
+            # port=0の場合は割り当てられたポートを記録する
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    def unregister(self, comm_mgr):
+        """トレントへの接続を受け付けないようにします. 登録されたトレントが無くなれば待ち受けを停止します"""
+        if self.managers.get(comm_mgr.bittorrent.info_hash) is comm_mgr:
+            del self.managers[comm_mgr.bittorrent.info_hash]
+        if not self.managers:
+            self.close()
+
+    def close(self):
+        """待ち受けのソケットを閉じます. 受け付け済みの接続はそれぞれのピアが閉じます"""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def connection_count(self) -> int:
+        """全てのトレントの接続中のピアと、ハンドシェイク中の接続の合計を返します"""
+        return sum(len(comm_mgr.peers) for comm_mgr in self.managers.values()) + self._handshaking
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.connection_count() >= self.max_connections:
+            self._reject(writer)
+            return
+
+        self._handshaking += 1
+        try:
+            data = await asyncio.wait_for(reader.readexactly(Handshake.total_length), CONNECT_TIMEOUT)
+            handshake = Handshake.from_bytes(data)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            self._reject(writer)
+            return
+        finally:
+            self._handshaking -= 1
+
+        comm_mgr = self.managers.get(bytes(handshake.info_hash))
+        if comm_mgr is None or not await comm_mgr.accept_peer(reader, writer, handshake):
+            self._reject(writer)
+            return
+        self.accepted += 1
+
+    def _reject(self, writer: asyncio.StreamWriter):
+        self.rejected += 1
+        writer.close()
+
+
+# プロセス内の全てのトレントで共有する待ち受け
+PEER_LISTENER = PeerListener()
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from typing import Dict
+
+from .entities.peer import Peer
+
+logger = logging.getLogger()
+
+
+class Uploader(object):
+    """
+    ピアから受け付けたRequestに、取得済みのピースのブロックを返すクラス。
+    Requestを受け付けた時や送信キューに空きができた時にwake()されたピアについて、読み込みのタスクを起こします。
+    タスクは受け付けたRequestが無くなるか、送信キューのブロックがUPLOAD_QUEUE_SIZEに達すると終了します。
+    ブロックはPieceCacheに載ったピースのmemoryviewとして送信タスクに渡され、トランスポートに書き出すまでコピーされません。
+    """
+
+    def __init__(self, comm_mgr):
+        self.comm_mgr = comm_mgr
+        self._tasks: Dict[Peer, asyncio.Task] = {}
+
+        # 送信キューに積んだブロックの数 (統計用)
+        self.blocks = 0
+
+    def wake(self, peer: Peer):
+        """ピアの読み込みのタスクが動いていなければ開始します"""
+        if peer in self._tasks or peer.next_upload() is None:
+            return
+        self._tasks[peer] = asyncio.create_task(self._serve(peer))
+
+    def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    async def _serve(self, peer: Peer):
+        bittorrent = self.comm_mgr.bittorrent
+        try:
+            while True:
+                key = peer.next_upload()
+                if key is None:
+                    return
+                piece_index, block_offset, block_length = key
+                try:
+                    # ブロックをPieceCacheのピースから参照する. キャッシュに無い場合はスレッドプールで読み込む
+                    data = await bittorrent.storage.read_piece(piece_index, block_offset, block_length)
+                except OSError as e:
+                    logger.error(f"cannot read piece {piece_index}: {e}")
+                    peer.drop_upload(key)
+                    continue
+                # Proxyの場合、読み込み中にキャッシュディレクトリから削除されていることがある
+                if not bittorrent.has_piece(piece_index):
+                    peer.drop_upload(key)
+                    continue
+                if peer.send_block(key, memoryview(data)):
+                    self.blocks += 1
+        finally:
+            # 終了を判定してから取り除くまでの間に中断しないので、wake()が取りこぼされることはない
+            self._tasks.pop(peer, None)
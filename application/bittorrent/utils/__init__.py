@@ -0,0 +1 @@
+from .timer_wheel import Timer, TimerWheel, TIMER_TICK
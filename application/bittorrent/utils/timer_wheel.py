@@ -0,0 +1,184 @@
+import asyncio
+import math
+from typing import Callable, List, Optional, Set
+
+# 1目盛りの長さ (秒). タイマーは期限を過ぎた最初の目盛りで実行される
+TIMER_TICK = 0.1
+# 1階層のスロット数 (2のべき乗のビット数) と階層数. 0.1秒 x 64^3 で約7時間先までを直接配置できる
+WHEEL_BITS = 6
+WHEEL_LEVELS = 3
+
+
+class Timer(object):
+    """TimerWheel.call_later()が返すハンドル. cancel()で実行前のタイマーを取り消せます"""
+    __slots__ = ('wheel', 'tick', 'callback', 'args', 'slot')
+
+    def __init__(self, wheel: 'TimerWheel', tick: int, callback: Callable, args: tuple):
+        self.wheel = wheel
+        self.tick = tick
+        self.callback: Optional[Callable] = callback
+        self.args = args
+        # タイマーが置かれているスロット. 実行待ちから外れるとNone
+        self.slot: Optional[Set['Timer']] = None
+
+    def cancel(self):
+        if self.callback is None:
+            return
+        self.callback = None
+        self.args = ()
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel._count -= 1
+
+    def cancelled(self) -> bool:
+        return self.callback is None
+
+
+class TimerWheel(object):
+    """
+    階層型タイマーホイール。イベントループの単調時計 (loop.time()) を TIMER_TICK 単位の目盛りに区切り、
+    近いタイマーは下位の階層、遠いタイマーは上位の階層のスロットに置きます。上位のスロットは時間が進むと下位へ移されます。
+    登録と取り消しはO(1)で、時間を進める処理は期限が来たタイマーの数に比例します。
+    イベントループには次に処理が必要な目盛りのコールバックを1つだけ登録し、タイマーが無い間は何も登録しません。
+    loopを省略すると、最初にcall_later()を呼び出したイベントループを使います。
+    """
+
+    def __init__(self, tick: float = TIMER_TICK, bits: int = WHEEL_BITS, levels: int = WHEEL_LEVELS,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.tick = tick
+        self._bits = bits
+        self._mask = (1 << bits) - 1
+        self._levels = levels
+        self._wheels: List[List[Set[Timer]]] = [[set() for _ in range(1 << bits)] for _ in range(levels)]
+        # 最上位の階層にも収まらない遠いタイマー. 最上位の階層が一周するたびに置き直す
+        self._overflow: Set[Timer] = set()
+        self._loop = loop
+        # 処理済みの目盛り
+        self._current = 0
+        self._count = 0
+        # イベントループに登録したコールバックと、その目盛り
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._handle_tick = 0
+        # 期限が来たタイマーを実行している間. コールバックから登録されたタイマーでは登録し直さず、実行後にまとめて決める
+        self._running = False
+
+        # 実行したタイマーの数 (統計用)
+        self.fired = 0
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        """delay秒後にcallback(*args)をイベントループ上で呼び出します"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        now = self._loop.time()
+        if self._count == 0:
+            # 空の間は時間を進めていないので、現在の目盛りまで飛ばす
+            self._current = max(self._current, math.floor(now / self.tick))
+        tick = max(math.ceil((now + delay) / self.tick), self._current + 1)
+        timer = Timer(self, tick, callback, args)
+        self._insert(timer)
+        self._count += 1
+        if not self._running and (self._handle is None or tick < self._handle_tick):
+            self._arm(tick)
+        return timer
+
+    def close(self):
+        """全てのタイマーを取り消します"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for slot in [slot for wheel in self._wheels for slot in wheel] + [self._overflow]:
+            for timer in list(slot):
+                timer.cancel()
+
+    def _insert(self, timer: Timer):
+        """現在の目盛りと上位のビットが一致する最も下の階層に置きます"""
+        tick, current = timer.tick, self._current
+        for level in range(self._levels):
+            shift = self._bits * (level + 1)
+            if tick >> shift == current >> shift:
+                index = (tick >> (self._bits * level)) & self._mask
+                break
+        else:
+            self._overflow.add(timer)
+            timer.slot = self._overflow
+            return
+        slot = self._wheels[level][index]
+        slot.add(timer)
+        timer.slot = slot
+
+    def _arm(self, tick: int):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle_tick = tick
+        self._handle = self._loop.call_at(tick * self.tick, self._run)
+
+    def _run(self):
+        self._handle = None
+        self._running = True
+        try:
+            self._advance(max(math.floor(self._loop.time() / self.tick), self._handle_tick))
+        finally:
+            self._running = False
+        # コールバックから登録されたタイマーも含めて、次に処理が必要な目盛りで登録する
+        if self._count:
+            self._arm(self._next_tick())
+
+    def _next_tick(self) -> int:
+        """次に処理が必要な目盛りを返します. 最下位の階層が空の場合は、上位のスロットを移す目盛りまで進めます"""
+        boundary = (self._current | self._mask) + 1
+        wheel = self._wheels[0]
+        for tick in range(self._current + 1, boundary):
+            if wheel[tick & self._mask]:
+                return tick
+        return boundary
+
+    def _advance(self, target: int):
+        """目盛りをtargetまで進め、期限が来たタイマーを実行します"""
+        while self._current < target:
+            self._current += 1
+            tick = self._current
+            # 下位のビットが全て0になった階層のスロットを、上の階層から順に下位へ移す
+            level = 1
+            while level <= self._levels and not tick & ((1 << (self._bits * level)) - 1):
+                level += 1
+            if level > self._levels and self._overflow:
+                # 最上位の階層が一周した. 範囲に入った遠いタイマーを最上位の階層に置く
+                timers = list(self._overflow)
+                self._overflow.clear()
+                for timer in timers:
+                    self._insert(timer)
+            for upper in range(min(level, self._levels) - 1, 0, -1):
+                slot = self._wheels[upper][(tick >> (self._bits * upper)) & self._mask]
+                if slot:
+                    timers = list(slot)
+                    slot.clear()
+                    for timer in timers:
+                        self._insert(timer)
+
+            slot = self._wheels[0][tick & self._mask]
+            if not slot:
+                continue
+            expired = list(slot)
+            slot.clear()
+            for timer in expired:
+                timer.slot = None
+            self._count -= len(expired)
+            for timer in expired:
+                # 先に実行したタイマーのコールバックで取り消されている場合がある
+                callback, args = timer.callback, timer.args
+                if callback is None:
+                    continue
+                timer.callback = None
+                timer.args = ()
+                self.fired += 1
+                try:
+                    callback(*args)
+                except Exception as e:
+                    self._loop.call_exception_handler({
+                        'message': 'Exception in timer callback',
+                        'exception': e,
+                    })
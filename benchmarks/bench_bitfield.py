@@ -0,0 +1,96 @@
+"""
+ピアのビットフィールドを使う処理 (関心の判定、保有ピア数の更新、Have) を、
+以前の bitstring.BitArray による実装と、パックしたNumPy配列による現在の実装で比較します。
+
+    python -m benchmarks.bench_bitfield [ピース数] [ピア数]
+"""
+import random
+import sys
+import time
+
+import bitstring
+import numpy as np
+
+from application.bittorrent.entities.piece.piece_picker import PiecePicker
+
+# haveでは HAVE_STEP 個おきのピースのHaveを受け取る
+HAVE_STEP = 97
+
+
+def measure(function, repeat: int = 5) -> float:
+    """functionを repeat 回実行した中で最も短い秒数を返します"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bitstring_path(peers, ours, number_of_pieces):
+    """以前の実装: BitArrayをビットごとに参照する"""
+    def interest():
+        # ピアが持っていて自分が持っていないピースがあるか (bitstringのビット演算を使う)
+        return [(peer & ~ours).any(True) for peer in peers]
+
+    def availability():
+        # has_pieceと同じく1ビットずつ参照する
+        counts = [0] * number_of_pieces
+        for peer in peers:
+            for i in range(number_of_pieces):
+                if peer[i]:
+                    counts[i] += 1
+        return counts
+
+    def have():
+        for i in range(0, number_of_pieces, HAVE_STEP):
+            peers[0][i] = 1
+
+    return {'interest': interest, 'availability': availability, 'have': have}
+
+
+def numpy_path(peers, ours, number_of_pieces):
+    """現在の実装: Peer.bit_field と同じ並びのパックしたuint8配列"""
+    def interest():
+        return [bool((peer & ~ours).any()) for peer in peers]
+
+    def availability():
+        picker = PiecePicker(number_of_pieces)
+        for peer in peers:
+            picker.add_peer(np.unpackbits(peer, count=number_of_pieces))
+        return picker.availability
+
+    def have():
+        bit_field = peers[0]
+        for i in range(0, number_of_pieces, HAVE_STEP):
+            bit_field[i >> 3] |= 0x80 >> (i & 7)
+
+    return {'interest': interest, 'availability': availability, 'have': have}
+
+
+def main():
+    number_of_pieces = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    number_of_peers = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rng = random.Random(0)
+    # 自分は全体の90%を持ち、ピアはそれぞれ無作為に半分を持つ
+    masks = [np.array([rng.random() < 0.5 for _ in range(number_of_pieces)]) for _ in range(number_of_peers)]
+    our_mask = np.array([rng.random() < 0.9 for _ in range(number_of_pieces)])
+
+    old = bitstring_path([bitstring.BitArray(bytes=np.packbits(mask).tobytes(), length=number_of_pieces)
+                          for mask in masks],
+                         bitstring.BitArray(bytes=np.packbits(our_mask).tobytes(), length=number_of_pieces),
+                         number_of_pieces)
+    new = numpy_path([np.packbits(mask) for mask in masks], np.packbits(our_mask), number_of_pieces)
+    assert old['interest']() == new['interest']()
+    assert old['availability']() == list(new['availability']())
+
+    print(f'{number_of_pieces} pieces, {number_of_peers} peers')
+    for name in old:
+        # ビットごとの参照は遅いので1回だけ測る
+        before = measure(old[name], repeat=1 if name == 'availability' else 5)
+        after = measure(new[name])
+        print(f'{name:>12}: bitstring {before * 1e3:10.3f} ms   numpy {after * 1e3:8.3f} ms   x{before / after:8.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+高速なシーダ (別プロセス) と、各Requestに一定の遅延後に応答する低速なシーダからダウンロードし、
+エンドゲームモードの有無で全てのピースを取得するまでの時間を比較します。
+
+    python -m benchmarks.bench_endgame [MiB] [低速なシーダの遅延秒数]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+from struct import Struct
+
+from application.bittorrent.communication_manager import CommunicationManager
+from application.bittorrent.entities.peer.message import Handshake, BitField, UnChoke, Request, Piece, Cancel, \
+    HANDSHAKE_PROTOCOL_LEN
+from tests.loopback import Seeders, download, make_torrent, write_data
+
+REQUEST_STRUCT = Struct('>III')
+
+
+async def start_latency_seeder(torrent, data: bytes, latency: float):
+    """各Requestに latency 秒後に応答し、Cancelされた応答は送らないシーダを起動し、(サーバ, ポート, 統計) を返します"""
+    piece_length = torrent.info.piece_length
+    number_of_pieces = len(torrent.info.pieces) // 20
+    stats = {'requests': 0, 'cancels': 0}
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        pending = {}
+
+        def respond(piece_index, block_offset, block_length):
+            del pending[piece_index, block_offset]
+            if not writer.is_closing():
+                offset = piece_index * piece_length + block_offset
+                writer.write(Piece(block_length, piece_index, block_offset, data[offset:offset + block_length]).to_bytes())
+
+        try:
+            await reader.readexactly(49 + HANDSHAKE_PROTOCOL_LEN)
+            writer.write(Handshake(torrent.info_hash, b'-XX0000-latencyseedr').to_bytes())
+            bits = bytearray(b'\xff' * ((number_of_pieces + 7) // 8))
+            bits[-1] &= (0xff << (len(bits) * 8 - number_of_pieces)) & 0xff
+            writer.write(BitField(bytes(bits)).to_bytes() + UnChoke().to_bytes())
+            while True:
+                length = int.from_bytes(await reader.readexactly(4), 'big')
+                if length == 0:
+                    continue
+                body = await reader.readexactly(length)
+                if body[0] == Request.message_id:
+                    stats['requests'] += 1
+                    request = REQUEST_STRUCT.unpack(body[1:13])
+                    pending[request[:2]] = loop.call_later(latency, respond, *request)
+                elif body[0] == Cancel.message_id:
+                    handle = pending.pop(REQUEST_STRUCT.unpack(body[1:13])[:2], None)
+                    if handle is not None:
+                        stats['cancels'] += 1
+                        handle.cancel()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for handle in pending.values():
+                handle.cancel()
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1], stats
+
+
+async def run(torrent, directory: str, data: bytes, fast_addresses, latency: float):
+    server, port, stats = await start_latency_seeder(torrent, data, latency)
+    async with server:
+        _, elapsed, received = await download(torrent, directory, fast_addresses + [('127.0.0.1', port)], timeout=600)
+    return elapsed, received.get(port, 0), stats
+
+
+def main():
+    size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 32 * 2 ** 20
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    data = os.urandom(size)
+    update_endgame = CommunicationManager._update_endgame
+    with tempfile.TemporaryDirectory() as directory:
+        torrent, torrent_path = make_torrent(directory, data)
+        seed_directory = os.path.join(directory, 'seed')
+        write_data(seed_directory, torrent, data)
+        with Seeders(torrent_path, [seed_directory]) as seeders:
+            for endgame in (False, True):
+                if not endgame:
+                    CommunicationManager._update_endgame = lambda self: False
+                try:
+                    elapsed, slow_bytes, stats = asyncio.run(
+                        run(torrent, os.path.join(directory, f'leech{endgame}'), data, seeders.addresses(), latency))
+                finally:
+                    CommunicationManager._update_endgame = update_endgame
+                print(f'endgame {"on " if endgame else "off"}: {elapsed:6.2f} s  '
+                      f'(from the slow seeder: {slow_bytes / 2 ** 10:.0f} KiB, '
+                      f'{stats["requests"]} requests, {stats["cancels"]} cancelled)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+1 Gbit/s相当の速さでブロックを受信した時のイベントループの遅延を、
+ピースが揃った時にイベントループ上でまとめてハッシュする以前の方式と、
+受信のたびに少しずつハッシュし残りをスレッドで計算する現在の方式で比較します。
+
+    python -m benchmarks.bench_hash_latency [ピースのMiB] [秒数]
+"""
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import time
+
+from application.bittorrent.entities.piece.block import BLOCK_SIZE
+from application.bittorrent.entities.piece.piece import Piece
+
+# 1 Gbit/s = 125 MB/s は 1ミリ秒あたり約8ブロック
+BLOCKS_PER_MS = 8
+
+
+class NullStorage(object):
+    """書き込みの時間を測定に含めないためのStorage"""
+
+    def cache_piece(self, piece_index, data):
+        pass
+
+    def uncache_piece(self, piece_index):
+        pass
+
+    async def write_piece(self, piece_index, data):
+        pass
+
+
+class SynchronousPiece(Piece):
+    """以前の方式: 受信中はハッシュせず、揃った時にイベントループ上でピース全体をハッシュする"""
+    __slots__ = ()
+
+    def _update_hash(self):
+        pass
+
+    async def _validate_piece(self) -> bool:
+        if hashlib.sha1(self.buffer).digest() == self.piece_hash:
+            self.is_full = True
+            return True
+        self.reset()
+        return False
+
+
+async def run(piece_class, data: bytes, shuffle: bool, seconds: float):
+    piece_hash = hashlib.sha1(data).digest()
+    number_of_blocks = len(data) // BLOCK_SIZE
+    view = memoryview(data)
+    lags = []
+    completed = 0
+    stopped = False
+
+    async def monitor():
+        # 1ミリ秒ごとに起きて、予定より遅れた時間を記録する
+        while not stopped:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    async def on_complete(piece):
+        nonlocal completed
+        completed += 1
+
+    monitor_task = asyncio.create_task(monitor())
+    end = time.perf_counter() + seconds
+    piece_index = 0
+    while time.perf_counter() < end:
+        piece = piece_class(piece_index, len(data), piece_hash, NullStorage())
+        piece.on_complete = on_complete
+        piece_index += 1
+        # 全てのブロックを要求してから、順番に、または無作為な順に受信する
+        while piece.get_empty_block() is not None:
+            pass
+        order = list(range(number_of_blocks))
+        if shuffle:
+            random.shuffle(order)
+        for start in range(0, number_of_blocks, BLOCKS_PER_MS):
+            for block_index in order[start:start + BLOCKS_PER_MS]:
+                offset = block_index * BLOCK_SIZE
+                piece.set_block(offset, view[offset:offset + BLOCK_SIZE])
+            await asyncio.sleep(0.001)
+    await asyncio.sleep(0.05)
+    stopped = True
+    await monitor_task
+    lags.sort()
+    return completed, lags
+
+
+def main():
+    piece_size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 4 * 2 ** 20
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    data = os.urandom(piece_size)
+    print(f'{piece_size // 2 ** 20} MiB pieces, {BLOCKS_PER_MS} blocks per ms')
+    for piece_class, name in ((SynchronousPiece, 'synchronous'), (Piece, 'incremental')):
+        for shuffle in (False, True):
+            completed, lags = asyncio.run(run(piece_class, data, shuffle, seconds))
+            print(f'{name:>12} {"shuffled" if shuffle else "in order"}: {completed:4} pieces  '
+                  f'lag p50 {lags[len(lags) // 2] * 1e3:6.3f} ms  p99 {lags[int(len(lags) * 0.99)] * 1e3:6.3f} ms  '
+                  f'max {lags[-1] * 1e3:6.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""
+ループバック上の別プロセスのシーダから BitTorrent.run() でダウンロードし、シーダの数ごとの合計スループットを測ります。
+
+    python -m benchmarks.bench_loopback [MiB] [シーダの数...]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+from tests.loopback import Seeders, download, make_torrent, write_data
+
+
+def main():
+    size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 128 * 2 ** 20
+    counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4, 8]
+    data = os.urandom(size)
+    with tempfile.TemporaryDirectory() as directory:
+        torrent, torrent_path = make_torrent(directory, data)
+        seed_directory = os.path.join(directory, 'seed')
+        write_data(seed_directory, torrent, data)
+        for count in counts:
+            leech_directory = os.path.join(directory, f'leech{count}')
+            # 全てのシーダは同じファイルを読む
+            with Seeders(torrent_path, [seed_directory] * count) as seeders:
+                _, elapsed, received = asyncio.run(download(torrent, leech_directory, seeders.addresses(), timeout=600))
+            shares = sorted((received[port] * 100 // len(data) for port in received), reverse=True)
+            print(f'{count} seeders: {size / 2 ** 20 / elapsed:8.1f} MiB/s  ({elapsed:.2f} s, share % {shares})')
+
+
+if __name__ == '__main__':
+    main()
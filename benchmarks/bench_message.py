@@ -0,0 +1,109 @@
+"""
+受信したバイト列をメッセージに分解する処理の速度と、Pieceメッセージ1つあたりにコピーされるバイト数を、
+以前の実装 (read_bufferのスライスで切り出す方式) と MessageDecoder で比較します。
+
+    python -m benchmarks.bench_message [メッセージ数] [受信チャンクのバイト数]
+"""
+import os
+import sys
+import time
+from struct import unpack
+
+from application.bittorrent.entities.peer.message import Have, Piece, MessageDecoder, WrongMessageException
+
+BLOCK_LENGTH = 2 ** 14
+
+
+class LegacyDecoder(object):
+    """以前の Peer.get_messages と MessageDispatcher の処理の写し. copied にスライスでコピーしたバイト数を数えます"""
+
+    def __init__(self):
+        self.read_buffer = b''
+        self.copied = 0
+
+    def feed(self, data: bytes):
+        self.read_buffer += data
+        self.copied += len(self.read_buffer)
+
+    def get_messages(self):
+        while len(self.read_buffer) > 4:
+            payload_length, = unpack('>I', self.read_buffer[:4])
+            total_length = payload_length + 4
+            if len(self.read_buffer) < total_length:
+                break
+            payload = self.read_buffer[:total_length]
+            self.read_buffer = self.read_buffer[total_length:]
+            self.copied += len(payload) + len(self.read_buffer)
+            yield self.dispatch(payload)
+
+    def dispatch(self, payload: bytes):
+        payload_length, message_id = unpack('>IB', payload[:5])
+        # 以前の実装はメッセージごとに対応表を作り直していた
+        map_id_to_message = {4: self.have_from_bytes, 7: self.piece_from_bytes}
+        if message_id not in map_id_to_message:
+            raise WrongMessageException('Wrong message id')
+        return map_id_to_message[message_id](payload)
+
+    @staticmethod
+    def have_from_bytes(payload: bytes) -> Have:
+        payload_length, message_id, piece_index = unpack('>IBI', payload[:9])
+        return Have(piece_index)
+
+    def piece_from_bytes(self, payload: bytes) -> Piece:
+        block_length = len(payload) - 13
+        payload_length, message_id, piece_index, block_offset, block = \
+            unpack('>IBII{}s'.format(block_length), payload[:13 + block_length])
+        self.copied += 2 * (13 + block_length)
+        return Piece(block_length, piece_index, block_offset, block)
+
+
+def make_stream(count: int) -> bytes:
+    block = os.urandom(BLOCK_LENGTH)
+    messages = []
+    for i in range(count):
+        messages.append(Piece(BLOCK_LENGTH, i // 16, i % 16 * BLOCK_LENGTH, block).to_bytes())
+        if i % 16 == 15:
+            messages.append(Have(i // 16).to_bytes())
+    return b''.join(messages)
+
+
+def run_legacy(chunks):
+    decoder = LegacyDecoder()
+    received = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        decoder.feed(chunk)
+        for _ in decoder.get_messages():
+            received += 1
+    return received, time.perf_counter() - start, decoder.copied
+
+
+def run_decoder(chunks):
+    decoder = MessageDecoder(expect_handshake=False)
+    received = 0
+    copied = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        # feedは受信データを1度バッファへコピーし、詰め直すときは未処理の部分だけを移す.
+        # 毎回詰め直したとみなすので上限値になる
+        copied += len(chunk) + len(decoder)
+        decoder.feed(chunk)
+        while decoder.next_message() is not None:
+            received += 1
+    return received, time.perf_counter() - start, copied
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2 ** 16
+    stream = make_stream(count)
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    print(f'{count} Piece messages ({len(stream) / 2 ** 20:.0f} MiB) in {chunk_size} byte chunks')
+    for name, run in (('legacy', run_legacy), ('decoder', run_decoder)):
+        received, elapsed, copied = run(chunks)
+        print(f'{name:>8}: {received / elapsed:10.0f} msgs/s  {len(stream) / 2 ** 20 / elapsed:8.1f} MiB/s  '
+              f'{copied / count:10.0f} bytes copied per Piece')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+合成した数GBの複数ファイルのトレントを Recheck で検証し、スレッド数ごとの速度 (GB/s) を測ります。
+比較のため、ピースを順番にread()してハッシュする単純な方法も測ります。
+各測定の前に posix_fadvise でページキャッシュから追い出すので、ディスクから読む速度になります。
+
+    python -m benchmarks.bench_recheck [GiB] [スレッド数...] [--cached]
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from application.bittorrent.entities.storage.recheck import Recheck, RECHECK_THREADS
+from application.bittorrent.entities.storage.storage import Storage
+
+PIECE_LENGTH = 2 ** 20
+# 作成するファイルの数. ファイルの境界はピースの境界と揃えない
+NUMBER_OF_FILES = 7
+# 壊しておくピース
+CORRUPT_PIECES = (3, 1000)
+
+
+def create_files(directory: str, total_length: int):
+    """total_lengthバイトを NUMBER_OF_FILES 個のファイルに分けて書き込み、(ファイルのリスト, ピースのハッシュ) を返します"""
+    base = total_length // NUMBER_OF_FILES
+    lengths = [base + 12345 * i for i in range(NUMBER_OF_FILES - 1)]
+    lengths.append(total_length - sum(lengths))
+    files = [(['synthetic', f'f{i}'], length) for i, length in enumerate(lengths)]
+    storage = Storage(directory, files, PIECE_LENGTH, piece_cache=None)
+    hashes = bytearray()
+    chunk = 64 * PIECE_LENGTH
+    for offset in range(0, total_length, chunk):
+        data = os.urandom(min(chunk, total_length - offset))
+        storage.write(offset, data)
+        hashes += b''.join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH))
+    for piece_index in CORRUPT_PIECES:
+        if piece_index * PIECE_LENGTH < total_length:
+            storage.write(piece_index * PIECE_LENGTH, b'!')
+    storage.sync()
+    storage.close()
+    return files, bytes(hashes)
+
+
+def drop_cache(storage: Storage):
+    for file in storage.files:
+        fd = os.open(file.path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def sequential_check(storage: Storage, hashes: bytes) -> np.ndarray:
+    """以前のように1つずつピースを読んでハッシュする"""
+    number_of_pieces = len(hashes) // 20
+    valid = np.zeros(number_of_pieces, dtype=bool)
+    for piece_index in range(number_of_pieces):
+        data = storage.read(piece_index * PIECE_LENGTH, storage.piece_size(piece_index))
+        valid[piece_index] = hashlib.sha1(data).digest() == hashes[piece_index * 20:(piece_index + 1) * 20]
+    return np.packbits(valid)
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    cached = '--cached' in sys.argv
+    total_length = int(float(args[0]) * 2 ** 30) if args else 2 * 2 ** 30
+    thread_counts = [int(arg) for arg in args[1:]] or sorted({1, 2, 4, RECHECK_THREADS})
+    with tempfile.TemporaryDirectory(dir=os.environ.get('BENCH_DIR')) as directory:
+        files, hashes = create_files(directory, total_length)
+        storage = Storage(directory, files, PIECE_LENGTH, piece_cache=None)
+        number_of_pieces = len(hashes) // 20
+        print(f'{total_length / 2 ** 30:.1f} GiB, {number_of_pieces} pieces, {len(files)} files, '
+              f'{"page cache" if cached else "cold cache"}, {os.cpu_count()} CPUs')
+
+        runs = [('sequential read', lambda: sequential_check(storage, hashes))]
+        runs += [(f'recheck x{threads}', lambda threads=threads: Recheck(storage, hashes, threads=threads).check())
+                 for threads in thread_counts]
+        for name, run in runs:
+            if cached:
+                run()
+            else:
+                drop_cache(storage)
+            start = time.perf_counter()
+            bits = run()
+            elapsed = time.perf_counter() - start
+            invalid = np.flatnonzero(~np.unpackbits(bits, count=number_of_pieces).astype(bool)).tolist()
+            assert invalid == [i for i in CORRUPT_PIECES if i < number_of_pieces], invalid
+            print(f'{name:>16}: {total_length / elapsed / 1e9:6.2f} GB/s  ({elapsed:.2f} s)')
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+シーダの BitTorrent をこのプロセスで動かし、別プロセスのリーチャから全てのブロックを繰り返し要求させて、
+アップロードの速度 (MiB/s) と、シーダのCPU時間あたりの速度 (MiB/s per core) を測ります。
+リーチャはソケットに直接Requestを書き、受信したPieceを数えるだけです。
+--no-cache を付けると、シーダはPieceCacheを使わずにディスク (ページキャッシュ) からブロックを読みます。
+
+    python -m benchmarks.bench_upload [MiB] [接続数] [要求の深さ] [繰り返し回数] [--no-cache]
+"""
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from application.bittorrent import BitTorrent, Mode, PeerListener
+from application.bittorrent.entities.peer.message import Handshake, Interested, Request, UnChoke, Piece, \
+    HANDSHAKE_PROTOCOL_LEN, LENGTH_STRUCT
+from tests.loopback import make_torrent, write_data
+
+BLOCK_LENGTH = 2 ** 14
+
+
+async def leech(port: int, info_hash: bytes, number: int, piece_length: int, total_length: int, depth: int,
+                rounds: int):
+    """1つの接続で全てのブロックを rounds 回要求し、(受信したブロックのバイト数, 1回目のデータのSHA-1) を返します"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(Handshake(info_hash, b'-BN0000-%012d' % number).to_bytes())
+    await reader.readexactly(49 + HANDSHAKE_PROTOCOL_LEN)
+    writer.write(Interested().to_bytes())
+    while True:
+        length, = LENGTH_STRUCT.unpack(await reader.readexactly(4))
+        if length and (await reader.readexactly(length))[0] == UnChoke.message_id:
+            break
+
+    blocks = [(offset // piece_length, offset % piece_length, min(BLOCK_LENGTH, total_length - offset))
+              for offset in range(0, total_length, BLOCK_LENGTH)]
+    received = 0
+    hasher = hashlib.sha1()
+    for round_number in range(rounds):
+        requested = in_flight = 0
+        while requested < len(blocks) or in_flight:
+            while in_flight < depth and requested < len(blocks):
+                writer.write(Request(*blocks[requested]).to_bytes())
+                requested += 1
+                in_flight += 1
+            length, = LENGTH_STRUCT.unpack(await reader.readexactly(4))
+            body = await reader.readexactly(length)
+            if body[0] == Piece.message_id:
+                in_flight -= 1
+                received += length - 9
+                if round_number == 0:
+                    hasher.update(body[9:])
+    writer.close()
+    return received, hasher.hexdigest()
+
+
+async def run_leechers(port: int, info_hash: bytes, connections: int, piece_length: int, total_length: int,
+                       depth: int, rounds: int):
+    start = time.perf_counter()
+    results = await asyncio.gather(*(leech(port, info_hash, number, piece_length, total_length, depth, rounds)
+                                     for number in range(connections)))
+    print(sum(received for received, _ in results), time.perf_counter() - start, results[0][1])
+
+
+async def seed(torrent, directory: str, data: bytes, connections: int, depth: int, rounds: int, cached: bool):
+    bittorrent = BitTorrent(torrent, directory, Mode.BitTorrent, listener=PeerListener('127.0.0.1', 0))
+    if not cached:
+        bittorrent.storage.piece_cache = None
+    bittorrent.bit_field |= await bittorrent.recheck()
+    await bittorrent.listener.register(bittorrent.comm_mgr)
+    try:
+        cpu = time.process_time()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'benchmarks.bench_upload', '--leech', str(bittorrent.listener.port),
+            torrent.info_hash.hex(), str(connections), str(torrent.info.piece_length), str(len(data)), str(depth),
+            str(rounds), stdout=asyncio.subprocess.PIPE)
+        output, _ = await process.communicate()
+        cpu = time.process_time() - cpu
+    finally:
+        bittorrent.listener.unregister(bittorrent.comm_mgr)
+        await bittorrent.comm_mgr.close()
+        bittorrent.storage.close()
+    received, elapsed, digest = output.split()
+    received, elapsed = int(received), float(elapsed)
+    assert digest.decode() == hashlib.sha1(data).hexdigest()
+    print(f'{connections} connections, depth {depth}{"" if cached else ", no cache"}: {received / 2 ** 20 / elapsed:8.1f} MiB/s  '
+          f'{received / 2 ** 20 / cpu:8.1f} MiB/s per core  ({received / 2 ** 20:.0f} MiB in {elapsed:.2f} s, '
+          f'seeder CPU {cpu:.2f} s)')
+
+
+def main():
+    if sys.argv[1:2] == ['--leech']:
+        port, info_hash, connections, piece_length, total_length, depth, rounds = sys.argv[2:9]
+        asyncio.run(run_leechers(int(port), bytes.fromhex(info_hash), int(connections), int(piece_length),
+                                 int(total_length), int(depth), int(rounds)))
+        return
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    cached = '--no-cache' not in sys.argv
+    size = int(args[0]) * 2 ** 20 if len(args) > 0 else 32 * 2 ** 20
+    connections = int(args[1]) if len(args) > 1 else 4
+    depth = int(args[2]) if len(args) > 2 else 64
+    rounds = int(args[3]) if len(args) > 3 else 4
+    data = os.urandom(size)
+    with tempfile.TemporaryDirectory() as directory:
+        torrent, _ = make_torrent(directory, data)
+        seed_directory = os.path.join(directory, 'seed')
+        write_data(seed_directory, torrent, data)
+        asyncio.run(seed(torrent, seed_directory, data, connections, depth, rounds, cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+ループバック上でシーダとリーチャを動かすテスト・ベンチマーク用のヘルパー。
+シーダは別のプロセスで動かします (python -m tests.loopback <torrent> <directory>)。
+待ち受けたポートを標準出力に書き、標準入力が閉じられるまでピースを送信します。
+"""
+import asyncio
+import hashlib
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from bcoding import bencode
+
+from application.bittorrent import BitTorrent, Mode, PeerListener, Torrent
+
+PIECE_LENGTH = 2 ** 18
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_torrent(directory: str, data: bytes, piece_length: int = PIECE_LENGTH, name: str = 'data',
+                 file_lengths: Optional[Sequence[int]] = None) -> Tuple[Torrent, str]:
+    """
+    dataを共有するトレントファイルを directory に作成し、(Torrent, トレントファイルのパス) を返します。
+    file_lengthsを指定した場合は、dataをその長さで区切ったファイル f0, f1, ... を持つ複数ファイルのトレントにします
+    """
+    info = {
+        'name': name,
+        'piece length': piece_length,
+        'pieces': b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length)),
+    }
+    if file_lengths is None:
+        info['length'] = len(data)
+    else:
+        assert sum(file_lengths) == len(data)
+        info['files'] = [{'length': length, 'path': [f'f{i}']} for i, length in enumerate(file_lengths)]
+    path = os.path.join(directory, name + '.torrent')
+    with open(path, 'wb') as file:
+        file.write(bencode({'announce': 'http://127.0.0.1/announce', 'info': info}))
+    return Torrent(path), path
+
+
+def write_data(directory: str, torrent: Torrent, data: bytes):
+    """トレントのファイルの配置で data を directory に書き込みます"""
+    info = torrent.info
+    if hasattr(info, 'files'):
+        offset = 0
+        for file in info.files:
+            path = os.path.join(directory, info.name, *file.path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data[offset:offset + file.length])
+            offset += file.length
+    else:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, info.name), 'wb') as f:
+            f.write(data)
+
+
+def read_data(directory: str, torrent: Torrent) -> bytes:
+    """directory にあるトレントのファイルを連結して返します"""
+    info = torrent.info
+    if not hasattr(info, 'files'):
+        with open(os.path.join(directory, info.name), 'rb') as f:
+            return f.read()
+    chunks = []
+    for file in info.files:
+        with open(os.path.join(directory, info.name, *file.path), 'rb') as f:
+            chunks.append(f.read())
+    return b''.join(chunks)
+
+
+class Seeders(object):
+    """別のプロセスで動かすシーダ. withを抜けると全て停止します"""
+
+    def __init__(self, torrent_path: str, directories: List[str]):
+        self.torrent_path = torrent_path
+        self.directories = directories
+        self.processes: List[subprocess.Popen] = []
+        self.ports: List[int] = []
+
+    def __enter__(self) -> 'Seeders':
+        env = dict(os.environ, PYTHONPATH=ROOT_PATH)
+        try:
+            for directory in self.directories:
+                process = subprocess.Popen([sys.executable, '-m', 'tests.loopback', self.torrent_path, directory],
+                                           cwd=ROOT_PATH, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                           stderr=subprocess.DEVNULL)
+                self.processes.append(process)
+            for process in self.processes:
+                line = process.stdout.readline()
+                if not line:
+                    raise RuntimeError('seeder exited before listening')
+                self.ports.append(int(line))
+        except BaseException:
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        for process in self.processes:
+            process.stdin.close()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def addresses(self) -> List[Tuple[str, int]]:
+        return [('127.0.0.1', port) for port in self.ports]
+
+
+async def download(torrent: Torrent, directory: str, addresses: List[Tuple[str, int]],
+                   timeout: float = 60) -> Tuple[BitTorrent, float, Dict[int, int]]:
+    """
+    トラッカーの代わりに addresses のピアに接続して BitTorrent.run() でダウンロードし、
+    (終了したBitTorrent, 全てのピースを取得するまでの秒数, ピアのポート -> そのピアから受信したバイト数) を返します。
+    終了時の書き込みも済んでいます
+    """
+    bittorrent = BitTorrent(torrent, directory, Mode.BitTorrent, listener=PeerListener('127.0.0.1', 0))
+
+    async def add_local_peers():
+        bittorrent.comm_mgr.connections.add_candidates(addresses)
+    bittorrent.comm_mgr.add_peers_from_tracker = add_local_peers
+
+    start = time.monotonic()
+    task = asyncio.create_task(bittorrent.run())
+    try:
+        while not bittorrent.all_pieces_completed():
+            if task.done():
+                task.result()
+                raise RuntimeError('BitTorrent.run() exited before completing')
+            if time.monotonic() - start > timeout:
+                raise TimeoutError(f'download did not complete in {timeout} s')
+            await asyncio.sleep(0.005)
+        elapsed = time.monotonic() - start
+        received = {peer.port: peer.downloaded for peer in bittorrent.comm_mgr.peers}
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    return bittorrent, elapsed, received
+
+
+async def seed(torrent_path: str, directory: str):
+    bittorrent = BitTorrent(Torrent(torrent_path), directory, Mode.BitTorrent,
+                            listener=PeerListener('127.0.0.1', 0))
+    bittorrent.bit_field |= await bittorrent.recheck()
+    await bittorrent.listener.register(bittorrent.comm_mgr)
+    print(bittorrent.listener.port, flush=True)
+    # 標準入力が閉じられるまで送信する
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+    bittorrent.listener.unregister(bittorrent.comm_mgr)
+    await bittorrent.comm_mgr.close()
+    bittorrent.storage.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(seed(sys.argv[1], sys.argv[2]))
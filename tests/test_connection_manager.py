@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+from application.bittorrent import connection_manager
+from application.bittorrent.connection_manager import ConnectionManager, MAX_CONNECT_FAILURES
+from application.bittorrent.entities.peer import Peer
+from application.bittorrent.utils import TimerWheel
+
+
+class FakeCommunicationManager(object):
+    def __init__(self):
+        self.banned = set()
+        self.healthy = True
+        self.peers = []
+        self.bittorrent = SimpleNamespace(info_hash=bytes(20), number_of_pieces=8)
+        self.timers = TimerWheel()
+
+    def has_peer_id(self, peer_id: bytes) -> bool:
+        return False
+
+    async def add_peer(self, peer: Peer):
+        self.peers.append(peer)
+
+
+def run_ban_during_connect(monkeypatch, connected: bool, failures: int = 0):
+    """接続を試みている間にIPアドレスをbanし、(ConnectionManager, 閉じたピア) を返します"""
+    closed = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def connect(self, timeout=None):
+            await release.wait()
+            return connected
+
+        async def close(self):
+            closed.append(self)
+        monkeypatch.setattr(Peer, 'connect', connect)
+        monkeypatch.setattr(Peer, 'close', close)
+
+        comm_mgr = FakeCommunicationManager()
+        connections = ConnectionManager(comm_mgr, max_peers=4)
+        connections.add_candidates([('10.0.0.1', 6881)])
+        connections.candidates[('10.0.0.1', 6881)].failures = failures
+        await asyncio.sleep(0)
+        comm_mgr.banned.add('10.0.0.1')
+        connections.ban('10.0.0.1')
+        release.set()
+        await asyncio.gather(*connections._tasks)
+        connections.close()
+        return connections, comm_mgr
+
+    connections, comm_mgr = asyncio.run(main())
+    return connections, comm_mgr, closed
+
+
+def test_failed_connect_after_ban(monkeypatch):
+    # 最後の失敗で候補を外そうとしても、banで既に外されている
+    connections, comm_mgr, closed = run_ban_during_connect(monkeypatch, False, MAX_CONNECT_FAILURES - 1)
+    assert connections.candidates == {}
+    assert connections._retry_timer is None
+
+
+def test_peer_connected_after_ban_is_closed(monkeypatch):
+    connections, comm_mgr, closed = run_ban_during_connect(monkeypatch, True)
+    assert comm_mgr.peers == []
+    assert len(closed) == 1 and closed[0].ip == '10.0.0.1'
+    assert connections.candidates == {}
+
+
+def test_failures_back_off_then_drop_candidate(monkeypatch):
+    monkeypatch.setattr(connection_manager, 'MAX_CONNECT_FAILURES', 2)
+
+    async def main():
+        comm_mgr = FakeCommunicationManager()
+        connections = ConnectionManager(comm_mgr, max_peers=4)
+        candidate = connection_manager.PeerCandidate('10.0.0.2', 6881)
+        connections.candidates[('10.0.0.2', 6881)] = candidate
+        connections._failed(candidate)
+        assert candidate.retry_at > 0 and connections._retry_timer is not None
+        connections._failed(candidate)
+        assert connections.candidates == {}
+        connections.close()
+
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+
+import pytest
+
+from application.bittorrent.entities.storage.disk_writer import DiskWriter, FsyncPolicy
+from application.bittorrent.entities.storage.storage import Storage
+
+PIECE_LENGTH = 16
+
+
+class RecordingStorage(Storage):
+    """書き込みとfsyncの呼び出しを記録するStorage. blockをセットするとwritevを止めておける"""
+
+    def __init__(self, root, lengths):
+        super().__init__(str(root), [(['t', f'f{i}'], length) for i, length in enumerate(lengths)], PIECE_LENGTH,
+                         piece_cache=None)
+        self.writes = []
+        self.syncs = 0
+        self.block = None
+        self.error = None
+
+    def writev(self, offset, buffers):
+        if self.block is not None:
+            self.block.wait(5)
+        if self.error is not None:
+            raise self.error
+        self.writes.append((offset, [len(buffer) for buffer in buffers]))
+        super().writev(offset, buffers)
+
+    def sync(self):
+        self.syncs += 1
+        super().sync()
+
+
+def piece(index, length=PIECE_LENGTH):
+    return bytes([index]) * length
+
+
+def test_adjacent_pieces_are_coalesced(tmp_path):
+    storage = RecordingStorage(tmp_path, [40, 30])
+
+    async def main():
+        writer = DiskWriter(storage)
+        # キューに溜まった順番に関わらず、連続するピースは1回にまとめて書き込む
+        await asyncio.gather(*(writer.write(i, piece(i, 6 if i == 4 else PIECE_LENGTH)) for i in (3, 1, 4, 2, 0)))
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(main())
+    assert storage.writes == [(0, [16, 16, 16, 16, 6])]
+    assert (writer.written_pieces, writer.write_count, writer.queued_bytes) == (5, 1, 0)
+    assert storage.read(0, 70) == b''.join(piece(i) for i in range(4)) + piece(4, 6)
+    storage.close()
+
+
+def test_gaps_split_batches(tmp_path):
+    storage = RecordingStorage(tmp_path, [16 * 8])
+
+    async def main():
+        writer = DiskWriter(storage, threads=1)
+        await asyncio.gather(*(writer.write(i, piece(i)) for i in (0, 1, 5, 6, 3)))
+        await writer.close()
+
+    asyncio.run(main())
+    assert sorted(storage.writes) == [(0, [16, 16]), (48, [16]), (80, [16, 16])]
+    storage.close()
+
+
+def test_backpressure_and_flush_on_close(tmp_path):
+    storage = RecordingStorage(tmp_path, [16 * 8])
+    storage.block = threading.Event()
+
+    async def main():
+        writer = DiskWriter(storage, max_queued_bytes=32, threads=1, fsync_policy=FsyncPolicy.ON_CLOSE)
+        first = asyncio.gather(writer.write(0, piece(0)), writer.write(1, piece(1)))
+        await asyncio.sleep(0.05)
+        assert writer.is_full()
+        # 書き込み中のデータが上限に達しているので、次のピースは空きができるまで待つ
+        third = asyncio.create_task(writer.write(2, piece(2)))
+        await asyncio.sleep(0.05)
+        assert not third.done() and writer.queued_bytes == 32
+        storage.block.set()
+        await asyncio.wait_for(asyncio.gather(first, third), 5)
+        assert storage.syncs == 0
+        await writer.close()
+        assert writer.queued_bytes == 0 and not writer.is_full()
+
+    asyncio.run(main())
+    assert storage.writes == [(0, [16, 16]), (32, [16])]
+    assert storage.syncs == 1
+    assert storage.read(0, 48) == piece(0) + piece(1) + piece(2)
+    storage.close()
+
+
+def test_fsync_every_write(tmp_path):
+    storage = RecordingStorage(tmp_path, [16 * 4])
+
+    async def main():
+        writer = DiskWriter(storage, threads=1, fsync_policy=FsyncPolicy.EVERY_WRITE)
+        await writer.write(0, piece(0))
+        await writer.write(2, piece(2))
+        await writer.close()
+
+    asyncio.run(main())
+    assert storage.syncs == 2
+    storage.close()
+
+
+def test_write_errors_reach_every_piece_in_the_batch(tmp_path):
+    storage = RecordingStorage(tmp_path, [16 * 4])
+    storage.error = OSError(28, 'No space left on device')
+
+    async def main():
+        writer = DiskWriter(storage)
+        results = await asyncio.gather(writer.write(0, piece(0)), writer.write(1, piece(1)), return_exceptions=True)
+        await writer.close()
+        return writer, results
+
+    writer, results = asyncio.run(main())
+    assert all(result is storage.error for result in results)
+    assert writer.queued_bytes == 0
+    with pytest.raises(OSError):
+        raise results[0]
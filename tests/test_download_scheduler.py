@@ -0,0 +1,60 @@
+import asyncio
+import random
+
+import pytest
+
+from application.bittorrent import BitTorrent, Mode
+from application.bittorrent.download_scheduler import DownloadScheduler
+from application.bittorrent.entities.peer import Peer
+from application.bittorrent.entities.peer.message import Have, BitField, ProtocolError
+
+from .loopback import make_torrent, PIECE_LENGTH
+
+
+class FlakyCommunicationManager(object):
+    """最初の補充で例外を送出し、以降の補充を記録する"""
+
+    def __init__(self):
+        self.healthy = True
+        self.peers = []
+        self.filled = []
+
+    async def fill_requests(self, peers):
+        self.filled.append(peers)
+        if len(self.filled) == 1:
+            raise RuntimeError('boom')
+
+
+def test_scheduler_survives_fill_errors():
+    async def main():
+        comm_mgr = FlakyCommunicationManager()
+        scheduler = DownloadScheduler(comm_mgr)
+        task = scheduler.start()
+        scheduler.wake()
+        await asyncio.sleep(0.01)
+        scheduler.wake()
+        await asyncio.sleep(0.01)
+        assert not task.done()
+        assert len(comm_mgr.filled) == 2
+
+        scheduler.stop()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+
+
+def test_out_of_range_pieces_are_protocol_errors(tmp_path):
+    torrent, _ = make_torrent(str(tmp_path), random.Random(0).randbytes(10 * PIECE_LENGTH))
+
+    async def main():
+        bittorrent = BitTorrent(torrent, str(tmp_path / 'leech'), Mode.BitTorrent)
+        comm_mgr = bittorrent.comm_mgr
+        peer = Peer(bittorrent.info_hash, bittorrent.number_of_pieces, '10.0.0.1', 6881)
+        for msg in (Have(10), Have(2 ** 32 - 1), BitField(bytes(1)), BitField(bytes(3))):
+            with pytest.raises(ProtocolError):
+                await comm_mgr._process_new_message(msg, peer)
+        assert not comm_mgr.piece_picker.availability.any()
+        bittorrent.storage.close()
+
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+import asyncio
+import os
+import random
+
+from .loopback import Seeders, download, make_torrent, read_data, write_data, PIECE_LENGTH
+
+
+def run_swarm(tmp_path, data: bytes, seeders: int, file_lengths=None):
+    torrent, torrent_path = make_torrent(str(tmp_path), data, file_lengths=file_lengths)
+    directories = []
+    for i in range(seeders):
+        directory = str(tmp_path / f'seed{i}')
+        write_data(directory, torrent, data)
+        directories.append(directory)
+    leecher_directory = str(tmp_path / 'leech')
+    with Seeders(torrent_path, directories) as swarm:
+        bittorrent, elapsed, received = asyncio.run(download(torrent, leecher_directory, swarm.addresses()))
+        ports = swarm.ports
+    print(f'{seeders} seeders: {len(data) / 2 ** 20 / elapsed:.1f} MiB/s')
+    return torrent, leecher_directory, received, ports
+
+
+def test_download_from_loopback_seeders(tmp_path):
+    data = random.Random(0).randbytes(32 * PIECE_LENGTH - 1000)
+    torrent, directory, received, ports = run_swarm(tmp_path, data, seeders=3)
+
+    assert read_data(directory, torrent) == data
+    # 全てのシーダから並行して受信している
+    assert sorted(received) == sorted(ports)
+    assert all(received[port] > 0 for port in ports)
+    assert sum(received.values()) >= len(data)
+
+
+def test_download_multiple_files(tmp_path):
+    # ファイルの境界がピースやブロックの境界と揃わない配置
+    lengths = [1, PIECE_LENGTH - 1, 3 * PIECE_LENGTH + 12345, 0, 5 * PIECE_LENGTH - 12346]
+    data = random.Random(1).randbytes(sum(lengths))
+    torrent, directory, received, ports = run_swarm(tmp_path, data, seeders=2, file_lengths=lengths)
+
+    assert read_data(directory, torrent) == data
+    assert [os.path.getsize(os.path.join(directory, 'data', f'f{i}')) for i in range(len(lengths))] == lengths
@@ -0,0 +1,158 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from application.bittorrent.entities.peer import message
+from application.bittorrent.entities.peer.message import Handshake, KeepAlive, Choke, UnChoke, Interested, \
+    NotInterested, Have, BitField, Request, Piece, Cancel, Port, MessageDecoder, MessageEncoder, WrongMessageException, \
+    ProtocolError
+
+BLOCK = os.urandom(2 ** 14)
+
+
+def sample_messages():
+    return [
+        KeepAlive(), Choke(), UnChoke(), Interested(), NotInterested(), Have(123456),
+        BitField(bytes([0xff, 0x0f, 0x80])), Request(7, 2 ** 14, 2 ** 14), Piece(len(BLOCK), 7, 2 ** 14, BLOCK),
+        Piece(10, 1, 0, b'0123456789'), Cancel(7, 2 ** 14, 2 ** 14), Port(6881),
+    ]
+
+
+def fields(msg):
+    values = {key: value for key, value in vars(msg).items()}
+    if isinstance(msg, Piece):
+        values['block'] = bytes(msg.block)
+    return type(msg), values
+
+
+def decode_all(data: bytes, chunk_sizes, expect_handshake=False):
+    decoder = MessageDecoder(expect_handshake=expect_handshake)
+    messages = []
+    position = 0
+    for size in chunk_sizes:
+        decoder.feed(data[position:position + size])
+        position += size
+        while True:
+            msg = decoder.next_message()
+            if msg is None:
+                break
+            messages.append(msg)
+        if position >= len(data):
+            break
+    assert len(decoder) == 0
+    return messages
+
+
+@pytest.mark.parametrize('chunking', ['whole', 'bytewise', 'random'])
+def test_encoder_decoder_round_trip(chunking):
+    messages = sample_messages()
+    encoder = MessageEncoder(capacity=16)
+    for msg in messages:
+        encoder.encode(msg)
+    assert encoder.message_count == len(messages)
+    data = b''.join(bytes(chunk) for chunk in encoder.flush_chunks())
+    assert data == b''.join(msg.to_bytes() for msg in messages)
+    assert len(encoder) == 0
+
+    if chunking == 'whole':
+        sizes = [len(data)]
+    elif chunking == 'bytewise':
+        sizes = [1] * len(data)
+    else:
+        rng = random.Random(0)
+        sizes = [rng.randint(1, 5000) for _ in range(len(data))]
+    decoded = decode_all(data, sizes)
+    assert [fields(msg) for msg in decoded] == [fields(msg) for msg in messages]
+
+
+def test_handshake_then_messages():
+    info_hash, peer_id = b'i' * 20, b'-AZ2200-abcdefghijkl'
+    data = Handshake(info_hash, peer_id).to_bytes() + Have(3).to_bytes()
+    decoded = decode_all(data, [30, 30, 100], expect_handshake=True)
+    assert isinstance(decoded[0], Handshake)
+    assert (decoded[0].info_hash, decoded[0].peer_id) == (info_hash, peer_id)
+    assert isinstance(decoded[1], Have) and decoded[1].piece_index == 3
+
+
+def test_piece_block_is_not_copied():
+    decoder = MessageDecoder(expect_handshake=False)
+    decoder.feed(Piece(len(BLOCK), 1, 0, BLOCK).to_bytes())
+    msg = decoder.next_message()
+    assert isinstance(msg.block, memoryview)
+    assert msg.block == BLOCK
+    # 返却したブロックが参照している間に受信を続けても、ブロックの内容は変わらない
+    for _ in range(8):
+        decoder.feed(Piece(len(BLOCK), 2, 0, bytes(len(BLOCK))).to_bytes())
+        assert decoder.next_message().piece_index == 2
+    assert msg.block == BLOCK
+
+
+def test_encoder_passes_large_blocks_by_reference():
+    block = bytearray(BLOCK)
+    encoder = MessageEncoder()
+    encoder.encode(Have(1))
+    encoder.encode(Piece(len(block), 1, 0, block))
+    encoder.encode(Piece(4, 1, 0, b'abcd'))
+    chunks = encoder.flush_chunks()
+    assert any(chunk is block for chunk in chunks)
+    assert b''.join(bytes(chunk) for chunk in chunks) == \
+        Have(1).to_bytes() + Piece(len(block), 1, 0, block).to_bytes() + Piece(4, 1, 0, b'abcd').to_bytes()
+
+
+def test_unknown_message_id_is_skipped():
+    decoder = MessageDecoder(expect_handshake=False)
+    decoder.feed(b'\x00\x00\x00\x03\x14ab' + Have(9).to_bytes())
+    with pytest.raises(WrongMessageException):
+        decoder.next_message()
+    assert decoder.next_message().piece_index == 9
+
+
+def test_bitfield_accepts_packed_arrays():
+    bits = np.packbits(np.array([1, 0, 1, 1, 0, 0, 0, 0, 1], dtype=bool))
+    for value in (bits, bits.tobytes(), bytearray(bits.tobytes())):
+        assert BitField(value).to_bytes() == b'\x00\x00\x00\x03\x05' + bits.tobytes()
+    decoded = decode_all(BitField(bits).to_bytes(), [100])[0]
+    assert decoded.bitfield_as_bytes == bits.tobytes()
+
+
+def test_decoder_compacts_consumed_data():
+    decoder = MessageDecoder(expect_handshake=False)
+    frame = Piece(len(BLOCK), 1, 0, BLOCK).to_bytes()
+    for _ in range(message.DECODER_COMPACT_THRESHOLD // len(frame) * 4):
+        decoder.feed(frame[:100])
+        assert decoder.next_message() is None
+        decoder.feed(frame[100:])
+        assert decoder.next_message().block == BLOCK
+    assert len(decoder) == 0
+
+
+def test_oversized_frames_are_rejected_before_buffering():
+    decoder = MessageDecoder(expect_handshake=False, number_of_pieces=8)
+    # ブロックより大きいPieceは、ペイロードが届く前に拒否する
+    decoder.feed(b'\xff\xff\xff\xff\x07')
+    with pytest.raises(ProtocolError):
+        decoder.next_message()
+
+    block = bytes(message.MAX_BLOCK_LENGTH)
+    decoder = MessageDecoder(expect_handshake=False, number_of_pieces=8)
+    decoder.feed(Piece(len(block), 0, 0, block).to_bytes())
+    assert len(decoder.next_message().block) == len(block)
+    decoder.feed(Piece(len(block) + 1, 0, 0, block + b'x').to_bytes()[:5])
+    with pytest.raises(ProtocolError):
+        decoder.next_message()
+
+
+def test_frame_limit_covers_large_bitfields():
+    number_of_pieces = 8 * 2 ** 20
+    bits = np.zeros(number_of_pieces // 8, dtype=np.uint8)
+    decoder = MessageDecoder(expect_handshake=False, number_of_pieces=number_of_pieces)
+    decoder.feed(BitField(bits).to_bytes())
+    assert decoder.next_message().bitfield_as_bytes == bits.tobytes()
+
+    # ピース数が分からない場合は既定の上限を使う
+    decoder = MessageDecoder(expect_handshake=False)
+    decoder.feed(message.LENGTH_STRUCT.pack(message.MAX_PAYLOAD_LENGTH + 1))
+    with pytest.raises(ProtocolError):
+        decoder.next_message()
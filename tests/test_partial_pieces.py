@@ -0,0 +1,122 @@
+import asyncio
+import random
+from struct import Struct
+
+import numpy as np
+
+from application.bittorrent import bittorrent as bittorrent_module
+from application.bittorrent import BitTorrent, Mode, PeerListener
+from application.bittorrent.entities.peer.message import Handshake, BitField, UnChoke, Request, Piece, \
+    HANDSHAKE_PROTOCOL_LEN, LENGTH_STRUCT
+
+from .loopback import make_torrent, read_data
+
+PIECE_LENGTH = 2 ** 17
+BLOCK = 2 ** 14
+LAST_BLOCK = PIECE_LENGTH - BLOCK
+REQUEST_STRUCT = Struct('>III')
+
+
+class FakeSeeder(object):
+    """pieces のピースを持つと知らせ、serve(piece_index, block_offset) がTrueのRequestにだけ応答するピア"""
+
+    def __init__(self, torrent, data: bytes, pieces, serve=lambda piece_index, block_offset: True):
+        self.torrent = torrent
+        self.data = data
+        self.pieces = pieces
+        self.serve = serve
+        self.requests = []
+        self.server = None
+        self.writers = []
+
+    async def start(self) -> tuple:
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return '127.0.0.1', self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """待ち受けを止めて接続を切ります. 再接続も失敗します"""
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.append(writer)
+        number_of_pieces = len(self.torrent.info.pieces) // 20
+        try:
+            await reader.readexactly(49 + HANDSHAKE_PROTOCOL_LEN)
+            port = writer.get_extra_info('sockname')[1]
+            writer.write(Handshake(self.torrent.info_hash, b'-XX0000-%012d' % port).to_bytes())
+            mask = np.zeros(number_of_pieces, dtype=bool)
+            mask[list(self.pieces)] = True
+            writer.write(BitField(np.packbits(mask)).to_bytes() + UnChoke().to_bytes())
+            while True:
+                length, = LENGTH_STRUCT.unpack(await reader.readexactly(4))
+                body = await reader.readexactly(length)
+                if length and body[0] == Request.message_id:
+                    piece_index, block_offset, block_length = REQUEST_STRUCT.unpack(body[1:13])
+                    self.requests.append((piece_index, block_offset))
+                    if self.serve(piece_index, block_offset):
+                        offset = piece_index * PIECE_LENGTH + block_offset
+                        writer.write(Piece(block_length, piece_index, block_offset,
+                                           self.data[offset:offset + block_length]).to_bytes())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def wait_until(condition, timeout=20):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError
+
+
+def test_pieces_without_peers_release_their_buffers(tmp_path, monkeypatch):
+    # バッファは2ピース分しかない
+    monkeypatch.setattr(bittorrent_module, 'BUFFER_POOL_SIZE', 2 * PIECE_LENGTH)
+    data = random.Random(0).randbytes(4 * PIECE_LENGTH)
+    torrent, _ = make_torrent(str(tmp_path), data, piece_length=PIECE_LENGTH)
+    directory = str(tmp_path / 'leech')
+
+    async def main():
+        bittorrent = BitTorrent(torrent, directory, Mode.BitTorrent, listener=PeerListener('127.0.0.1', 0))
+
+        # トラッカーに問い合わせる時点では、ダウンロード対象のピースが決まっている
+        started = asyncio.Event()
+
+        async def no_tracker():
+            started.set()
+        bittorrent.comm_mgr.add_peers_from_tracker = no_tracker
+        task = asyncio.create_task(bittorrent.run())
+        await started.wait()
+
+        # ピース0と1の最後のブロック以外を送って切断するピア
+        partial = FakeSeeder(torrent, data, [0, 1], serve=lambda piece_index, block_offset: block_offset < LAST_BLOCK)
+        bittorrent.comm_mgr.connections.add_candidates([await partial.start()])
+        await wait_until(lambda: all(bittorrent.pieces[i].completed_blocks == LAST_BLOCK // BLOCK for i in (0, 1)))
+        assert not bittorrent.buffer_pool.can_acquire(PIECE_LENGTH)
+        await partial.stop()
+
+        # どのピアも持っていないピースのバッファを手放したので、他のピースを取得できる
+        other = FakeSeeder(torrent, data, [2, 3])
+        bittorrent.comm_mgr.connections.add_candidates([await other.start()])
+        await wait_until(lambda: bittorrent.has_piece(2) and bittorrent.has_piece(3))
+        assert set(bittorrent.parked_pieces) == {0, 1}
+
+        # 手放したピースは受信済みのブロックをディスクから読み込んで再開する
+        seeder = FakeSeeder(torrent, data, range(4))
+        bittorrent.comm_mgr.connections.add_candidates([await seeder.start()])
+        await wait_until(bittorrent.all_pieces_completed)
+        assert sorted(seeder.requests) == [(0, LAST_BLOCK), (1, LAST_BLOCK)]
+        assert bittorrent.parked_pieces == {}
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await other.stop()
+        await seeder.stop()
+
+    asyncio.run(main())
+    assert read_data(directory, torrent) == data
@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from application.bittorrent.entities.piece.buffer_pool import BufferPool
+from application.bittorrent.entities.piece.piece import Piece, BLOCK_SIZE
+from application.bittorrent.entities.storage.piece_cache import PieceCache
+from application.bittorrent.entities.storage.storage import Storage
+
+PIECE_LENGTH = 4 * BLOCK_SIZE
+DATA = os.urandom(PIECE_LENGTH)
+
+
+class FailingStorage(Storage):
+    """errorをセットするとwrite()が失敗するStorage"""
+
+    def __init__(self, root, cache):
+        super().__init__(str(root), [(['t', 'f0'], PIECE_LENGTH)], PIECE_LENGTH, piece_cache=cache)
+        self.error = None
+
+    def write(self, offset, data):
+        if self.error is not None:
+            raise self.error
+        super().write(offset, data)
+
+
+def make_piece(storage, pool):
+    """(Piece, 完了したピースのリスト, 失敗の例外のリスト) を返します"""
+    piece = Piece(0, PIECE_LENGTH, hashlib.sha1(DATA).digest(), storage, buffer_pool=pool)
+    completed, failed = [], []
+
+    async def on_complete(p):
+        completed.append(p)
+
+    async def on_failed(p, error):
+        failed.append(error)
+    piece.on_complete = on_complete
+    piece.on_failed = on_failed
+    return piece, completed, failed
+
+
+async def receive_all(piece):
+    """全てのブロックを要求して受信し、検証と書き込みのタスクが終わるまで待ちます"""
+    while piece.get_empty_block() is not None:
+        pass
+    running = asyncio.all_tasks()
+    for offset in range(0, PIECE_LENGTH, BLOCK_SIZE):
+        assert piece.set_block(offset, DATA[offset:offset + BLOCK_SIZE])
+    tasks = asyncio.all_tasks() - running
+    assert len(tasks) == 1
+    await asyncio.gather(*tasks)
+
+
+def test_cached_piece_shares_the_buffer(tmp_path):
+    cache = PieceCache()
+    storage = FailingStorage(tmp_path, cache)
+    pool = BufferPool(PIECE_LENGTH)
+
+    async def main():
+        piece, completed, _ = make_piece(storage, pool)
+        await receive_all(piece)
+        cached = cache.get((storage.info_hash, 0)).obj
+        assert completed == [piece] and piece.buffer is None
+        # キャッシュはプールのバッファをコピーせずに保持し、プールはそのバッファを予算から外す
+        assert isinstance(cached, bytearray)
+        assert (pool.in_use, pool.allocated) == (0, 0)
+        assert await storage.read_piece(0) == DATA
+        assert bytes(await storage.read_piece(0, BLOCK_SIZE, 10)) == DATA[BLOCK_SIZE:BLOCK_SIZE + 10]
+
+    asyncio.run(main())
+    assert storage.read(0, PIECE_LENGTH) == DATA
+    storage.close()
+
+
+def test_write_error_resets_the_piece(tmp_path):
+    cache = PieceCache()
+    storage = FailingStorage(tmp_path, cache)
+    storage.error = OSError('disk full')
+    pool = BufferPool(PIECE_LENGTH)
+
+    async def main():
+        piece, completed, failed = make_piece(storage, pool)
+        waiter = asyncio.ensure_future(piece.wait_complete())
+        # 書き込みのタスクは例外で終わらず、on_failedと待っている呼び出し元に知らせる
+        await receive_all(piece)
+        assert failed == [storage.error] and completed == []
+        with pytest.raises(OSError):
+            await waiter
+        assert not piece.is_full and piece.completed_blocks == 0 and piece.has_free_block()
+        assert len(cache) == 0 and pool.in_use == 0
+
+        # 取得し直したピースは保存できる
+        storage.error = None
+        await receive_all(piece)
+        assert completed == [piece]
+
+    asyncio.run(main())
+    storage.close()
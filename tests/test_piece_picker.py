@@ -0,0 +1,94 @@
+import random
+
+import numpy as np
+
+from application.bittorrent.entities.piece.piece_picker import PiecePicker
+
+
+def bits(*pieces, n=20):
+    mask = np.zeros(n, dtype=np.uint8)
+    mask[list(pieces)] = 1
+    return mask
+
+
+def packed(mask):
+    return np.packbits(mask.astype(np.bool_))
+
+
+def make_picker(peers, n=20):
+    picker = PiecePicker(n)
+    picker.want_all(np.ones(n, dtype=np.uint8))
+    for peer in peers:
+        picker.add_peer(peer)
+    return picker
+
+
+def test_picks_rarest_first():
+    n = 20
+    # ピースiを (i % 4) + 1 人のピアが持つ
+    peers = [np.array([1 if i % 4 >= k else 0 for i in range(n)], dtype=np.uint8) for k in range(4)]
+    picker = make_picker(peers, n)
+    seed = packed(np.ones(n, dtype=np.uint8))
+
+    order = [picker.pick_piece(seed) for _ in range(n)]
+    assert [picker.availability[i] for i in order] == sorted(picker.availability[i] for i in order)
+    assert sorted(order) == list(range(n))
+    assert len(picker) == 0
+    assert picker.pick_piece(seed) is None
+
+
+def test_only_picks_pieces_the_peer_has():
+    picker = make_picker([bits(1, 2, 3, 15)])
+    picker.increment(15)
+    peer = packed(bits(3, 15))
+    assert picker.pick_piece(peer) == 3
+    assert picker.pick_piece(peer) == 15
+    assert picker.pick_piece(peer) is None
+    # 保有ピースが対象に含まれないピアでは何も選ばず、対象も変わらない
+    assert picker.pick_piece(packed(bits(3))) is None
+    assert len(picker) == 18
+
+
+def test_ties_are_broken_randomly():
+    random.seed(0)
+    seen = set()
+    for _ in range(50):
+        picker = make_picker([bits(*range(20))])
+        seen.add(picker.pick_piece(packed(np.ones(20, dtype=np.uint8))))
+    assert len(seen) > 5
+
+
+def test_max_availability():
+    picker = make_picker([bits(0, 1), bits(0, 1), bits(1)])
+    peer = packed(bits(0, 1))
+    # ピース0は2人、ピース1は3人が持つ
+    assert picker.pick_piece(peer, max_availability=1) is None
+    assert picker.pick_piece(peer, max_availability=2) == 0
+    assert picker.pick_piece(peer, max_availability=2) is None
+    assert picker.pick_piece(peer) == 1
+
+
+def test_discard_and_want_all():
+    picker = PiecePicker(20)
+    picker.want_all(bits(0, 5, 19))
+    assert len(picker) == 3 and 5 in picker and 6 not in picker
+    picker.discard(5)
+    picker.discard(5)
+    picker.discard(6)
+    assert len(picker) == 2 and 5 not in picker
+    # 手放したピースを戻す
+    picker.want(5)
+    picker.want(5)
+    assert len(picker) == 3 and 5 in picker
+    picker.want_all(bits(5, 6))
+    assert len(picker) == 4 and 6 in picker
+
+
+def test_remove_peer_updates_availability():
+    first, second = bits(0, 1), bits(1)
+    picker = make_picker([first, second])
+    assert list(picker.availability[:3]) == [1, 2, 0]
+    picker.remove_peer(second)
+    assert list(picker.availability[:3]) == [1, 1, 0]
+    picker.remove_peer(second)
+    assert picker.availability.min() == 0
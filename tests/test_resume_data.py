@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+
+from application.bittorrent.entities.storage.resume_data import ResumeData
+from application.bittorrent.entities.storage.storage import Storage
+
+PIECE_LENGTH = 16
+INFO_HASH = 'ab' * 20
+
+
+def make_storage(tmp_path) -> Storage:
+    # ピース0-1はf0、ピース2はf0とf1、ピース3-4はf1にかかる
+    storage = Storage(str(tmp_path), [(['t', 'f0'], 40), (['t', 'f1'], 40)], PIECE_LENGTH, piece_cache=None)
+    storage.write(0, bytes(80))
+    storage.sync()
+    return storage
+
+
+def save_and_load(tmp_path, storage, bit_field=bytes([0b11011000]), partial=None) -> ResumeData:
+    path = ResumeData.path_for(str(tmp_path), INFO_HASH)
+    ResumeData.capture(storage, INFO_HASH, bit_field, partial or {}).save(path)
+    return ResumeData.load(path)
+
+
+def test_round_trip(tmp_path):
+    storage = make_storage(tmp_path)
+    resume_data = save_and_load(tmp_path, storage, partial={2: b'\x02\x00', 9: b'\x02'})
+    assert resume_data.info_hash_hex == INFO_HASH
+    assert resume_data.bit_field == bytes([0b11011000])
+    assert resume_data.partial_pieces == {2: b'\x02\x00', 9: b'\x02'}
+
+    valid, partial, changed = resume_data.valid_pieces(storage, 5)
+    assert list(np.unpackbits(valid, count=5)) == [1, 1, 0, 1, 1]
+    # 範囲外のピースは捨てる
+    assert partial == {2: b'\x02\x00'}
+    assert not changed.any()
+    assert not os.path.exists(ResumeData.path_for(str(tmp_path), INFO_HASH) + '.tmp')
+    storage.close()
+
+
+def test_changed_file_invalidates_only_its_pieces(tmp_path):
+    storage = make_storage(tmp_path)
+    resume_data = save_and_load(tmp_path, storage, bit_field=bytes([0b11111000]), partial={1: b'\x02'})
+    stat = os.stat(storage.files[0].path)
+    os.utime(storage.files[0].path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    valid, partial, changed = resume_data.valid_pieces(storage, 5)
+    assert list(changed) == [True, True, True, False, False]
+    assert list(np.unpackbits(valid, count=5)) == [0, 0, 0, 1, 1]
+    assert partial == {}
+    storage.close()
+
+
+def test_resized_or_missing_file_invalidates(tmp_path):
+    storage = make_storage(tmp_path)
+    resume_data = save_and_load(tmp_path, storage, bit_field=bytes([0b11111000]))
+    os.truncate(storage.files[1].path, 10)
+    valid, _, changed = resume_data.valid_pieces(storage, 5)
+    assert list(changed) == [False, False, True, True, True]
+    assert list(np.unpackbits(valid, count=5)) == [1, 1, 0, 0, 0]
+
+    storage.close()
+    os.remove(storage.files[0].path)
+    valid, _, changed = resume_data.valid_pieces(storage, 5)
+    assert changed.all() and not valid.any()
+
+
+def test_mismatched_torrent_invalidates_everything(tmp_path):
+    storage = make_storage(tmp_path)
+    resume_data = save_and_load(tmp_path, storage)
+    valid, partial, changed = resume_data.valid_pieces(storage, 20)
+    assert changed.all() and not valid.any() and partial == {}
+    storage.close()
+
+
+def test_missing_or_corrupt_file_loads_as_none(tmp_path):
+    path = ResumeData.path_for(str(tmp_path), INFO_HASH)
+    assert ResumeData.load(path) is None
+    os.makedirs(os.path.dirname(path))
+    for content in ('', '{"info_hash": "x"}', '{"info_hash": "x", "pieces": "zz", "files": [], "partial": {}}'):
+        with open(path, 'w') as file:
+            file.write(content)
+        assert ResumeData.load(path) is None
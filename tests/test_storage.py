@@ -0,0 +1,139 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from application.bittorrent.entities.storage import storage as storage_module
+from application.bittorrent.entities.storage.piece_cache import PieceCache
+from application.bittorrent.entities.storage.storage import Storage, InvalidPathException
+
+
+def make_storage(tmp_path, lengths, piece_length=16, **kwargs) -> Storage:
+    files = [(['t', f'f{i}'], length) for i, length in enumerate(lengths)]
+    return Storage(str(tmp_path), files, piece_length, piece_cache=None, **kwargs)
+
+
+def test_segments_across_file_boundaries(tmp_path):
+    storage = make_storage(tmp_path, [10, 0, 5, 20])
+    assert storage.total_length == 35
+
+    def segments(offset, length):
+        return [(os.path.basename(file.path), file_offset, size)
+                for file, file_offset, size in storage.segments(offset, length)]
+
+    assert segments(0, 10) == [('f0', 0, 10)]
+    # 長さ0のファイルは飛ばす
+    assert segments(8, 10) == [('f0', 8, 2), ('f2', 0, 5), ('f3', 0, 3)]
+    assert segments(10, 5) == [('f2', 0, 5)]
+    assert segments(34, 1) == [('f3', 19, 1)]
+    assert segments(35, 0) == []
+    with pytest.raises(ValueError):
+        list(storage.segments(30, 6))
+    with pytest.raises(ValueError):
+        list(storage.segments(-1, 1))
+
+
+def test_write_and_read_across_files(tmp_path):
+    storage = make_storage(tmp_path, [10, 0, 5, 20])
+    data = bytes(range(35))
+    # ピースの境界とファイルの境界が揃わない書き込み
+    storage.writev(0, [data[:7], data[7:16]])
+    storage.write(16, data[16:])
+    storage.sync()
+
+    assert storage.read(0, 35) == data
+    assert storage.read(9, 7) == data[9:16]
+    for i, (start, end) in enumerate([(0, 10), (10, 10), (10, 15), (15, 35)]):
+        with open(tmp_path / 't' / f'f{i}', 'rb') as file:
+            assert file.read() == data[start:end]
+    storage.close()
+
+
+
+class CountingStorage(Storage):
+    """readの呼び出しを (offset, length) で記録するStorage"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = []
+
+    def read(self, offset, length):
+        self.reads.append((offset, length))
+        return super().read(offset, length)
+
+
+def test_read_piece_reads_only_what_it_needs(tmp_path):
+    data = bytes(range(64))
+    files = [(['t', 'f0'], 64)]
+    storage = CountingStorage(str(tmp_path), files, 16, piece_cache=None)
+    storage.write(0, data)
+
+    async def blocks():
+        return await asyncio.gather(*(storage.read_piece(1, offset, 4) for offset in range(0, 16, 4)))
+
+    # キャッシュが無い場合は要求された範囲だけを読む
+    assert b''.join(asyncio.run(blocks())) == data[16:32]
+    assert sorted(storage.reads) == [(16, 4), (20, 4), (24, 4), (28, 4)]
+    storage.close()
+
+    # キャッシュに無いピースを同時に要求されても、ピース全体を1回だけ読む
+    storage = CountingStorage(str(tmp_path), files, 16, piece_cache=PieceCache())
+    assert b''.join(bytes(block) for block in asyncio.run(blocks())) == data[16:32]
+    assert asyncio.run(storage.read_piece(1)) == data[16:32]
+    assert storage.reads == [(16, 16)]
+    storage.close()
+
+def test_read_does_not_create_files(tmp_path):
+    storage = make_storage(tmp_path, [10, 10])
+    assert storage.read(5, 10) == bytes(10)
+    assert not (tmp_path / 't').exists()
+
+    storage.write(0, b'x' * 10)
+    assert storage.read(5, 10) == b'x' * 5 + bytes(5)
+    assert not (tmp_path / 't' / 'f1').exists()
+    storage.close()
+
+
+def test_files_are_preallocated(tmp_path):
+    storage = make_storage(tmp_path, [100, 50])
+    storage.write(0, b'a')
+    assert os.path.getsize(tmp_path / 't' / 'f0') == 100
+    storage.close()
+
+
+def test_preallocation_does_not_block_other_files(tmp_path, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_fallocate(fd, offset, length):
+        # 2つ目のファイルで、fallocateを0の書き込みで代替するファイルシステムを模擬する
+        calls.append(fd)
+        if len(calls) == 2:
+            started.set()
+            release.wait(5)
+        os.ftruncate(fd, length)
+    monkeypatch.setattr(storage_module.os, 'posix_fallocate', slow_fallocate, raising=False)
+
+    storage = make_storage(tmp_path, [16, 16])
+    storage.write(16, b'b' * 16)  # f1の事前割り当てはここで終わる
+
+    writer = threading.Thread(target=storage.write, args=(0, b'a' * 16))
+    writer.start()
+    assert started.wait(5)
+    # f0の事前割り当て中でもf1は読み書きできる
+    start = time.monotonic()
+    storage.write(16, b'c' * 16)
+    assert storage.read(16, 16) == b'c' * 16
+    assert time.monotonic() - start < 1
+    release.set()
+    writer.join()
+    assert storage.read(0, 32) == b'a' * 16 + b'c' * 16
+    storage.close()
+
+
+def test_rejects_paths_outside_root(tmp_path):
+    with pytest.raises(InvalidPathException):
+        Storage(str(tmp_path), [(['t', '..', 'x'], 1)], 16)
@@ -0,0 +1,158 @@
+import heapq
+
+import pytest
+
+from application.bittorrent.utils import TimerWheel, TIMER_TICK
+
+
+class FakeHandle(object):
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop(object):
+    """時刻を手動で進めるイベントループ. call_atで登録したコールバックを時刻順に実行する"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.errors = []
+        self._handles = []
+        self._seq = 0
+
+    def time(self) -> float:
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = FakeHandle()
+        self._seq += 1
+        heapq.heappush(self._handles, (when, self._seq, handle, callback))
+        return handle
+
+    def call_exception_handler(self, context):
+        self.errors.append(context)
+
+    def advance(self, until: float):
+        while self._handles and self._handles[0][0] <= until:
+            when, _, handle, callback = heapq.heappop(self._handles)
+            if handle.cancelled:
+                continue
+            self.now = max(self.now, when)
+            callback()
+        self.now = until
+
+    def armed(self) -> int:
+        return sum(1 for _, _, handle, _ in self._handles if not handle.cancelled)
+
+
+@pytest.fixture
+def loop():
+    return FakeLoop()
+
+
+def test_fires_in_order_at_deadline(loop):
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    for delay in (0.5, 0.2, 3.0, 1.0):
+        wheel.call_later(delay, lambda d=delay: fired.append((d, loop.now)))
+
+    loop.advance(2.0)
+    assert [d for d, _ in fired] == [0.2, 0.5, 1.0]
+    for delay, at in fired:
+        assert delay <= at < delay + 2 * TIMER_TICK
+    loop.advance(3.5)
+    assert [d for d, _ in fired] == [0.2, 0.5, 1.0, 3.0]
+    assert len(wheel) == 0
+    assert loop.armed() == 0
+
+
+def test_long_timer_from_callback_does_not_delay_due_timers(loop):
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    wheel.call_later(0.2, lambda: wheel.call_later(120, fired.append, 'long'))
+    wheel.call_later(1.0, fired.append, 'short')
+
+    loop.advance(1.0 + 2 * TIMER_TICK)
+    assert fired == ['short']
+    loop.advance(121)
+    assert fired == ['short', 'long']
+
+
+def test_rearming_callback_keeps_period(loop):
+    wheel = TimerWheel(loop=loop)
+    times = []
+
+    def periodic():
+        times.append(loop.now)
+        wheel.call_later(0.5, periodic)
+
+    wheel.call_later(0.5, periodic)
+    wheel.call_later(10, lambda: None)
+    loop.advance(5.05)
+    assert len(times) == 10
+
+
+def test_cancel(loop):
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    timer = wheel.call_later(1.0, fired.append, 1)
+    wheel.call_later(2.0, fired.append, 2)
+    timer.cancel()
+    assert timer.cancelled()
+    assert len(wheel) == 1
+
+    loop.advance(3)
+    assert fired == [2]
+
+
+def test_cancel_from_earlier_callback_in_same_tick(loop):
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    second = wheel.call_later(1.0, fired.append, 2)
+    wheel.call_later(1.0, lambda: (fired.append(1), second.cancel()))
+    loop.advance(2)
+    # 同じ目盛りのタイマーの実行順は決まっていないので、取り消された方が実行されていないことだけを確認する
+    assert fired in ([1], [2, 1])
+
+
+def test_timers_beyond_top_level(loop):
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    horizon = TIMER_TICK * 64 ** 3
+    wheel.call_later(horizon * 2.5, fired.append, 'far')
+    wheel.call_later(100, fired.append, 'near')
+
+    loop.advance(101)
+    assert fired == ['near']
+    loop.advance(horizon * 2.5 - 1)
+    assert fired == ['near']
+    loop.advance(horizon * 2.5 + 1)
+    assert fired == ['near', 'far']
+
+
+def test_callback_exception_is_reported(loop):
+    wheel = TimerWheel(loop=loop)
+    fired = []
+
+    def fail():
+        raise RuntimeError('boom')
+
+    wheel.call_later(1.0, fail)
+    wheel.call_later(1.0, fired.append, 'ok')
+    loop.advance(2)
+    assert fired == ['ok']
+    assert len(loop.errors) == 1
+    assert isinstance(loop.errors[0]['exception'], RuntimeError)
+
+
+def test_close_cancels_everything(loop):
+    wheel = TimerWheel(loop=loop)
+    fired = []
+    timers = [wheel.call_later(delay, fired.append, delay) for delay in (0.1, 10, 1000)]
+    wheel.close()
+    assert all(timer.cancelled() for timer in timers)
+    assert len(wheel) == 0
+    loop.advance(2000)
+    assert fired == []